@@ -2,10 +2,11 @@ from django.contrib.auth.models import User
 from rest_framework import status
 from rest_framework.test import APITestCase, APIRequestFactory
 
+from wallets.test.utils import QueryCountMixin
 from .views import UserViewSet
 
 
-class UserViewSetTest(APITestCase):
+class UserViewSetTest(QueryCountMixin, APITestCase):
     def setUp(self):
         self.factory = APIRequestFactory()
         self.view = UserViewSet.as_view({'get': 'list',
@@ -22,6 +23,14 @@ class UserViewSetTest(APITestCase):
         response = self.view(request)
         self.assertEqual(response.status_code, status.HTTP_200_OK)
 
+    def test_list_query_count(self):
+        def add_users(count):
+            for _ in range(count):
+                User.objects.create_user(username=f'user{User.objects.count()}')
+
+        self.assertConstantQueries(
+            lambda: self.view(self.factory.get('/client/users/?limit=50')), add_users)
+
     def test_create(self):
         self.new_user_data = {'username': 'newuser',
                           'email': 'testuser@example.com',
@@ -2,6 +2,7 @@ from django.contrib.auth.models import User
 from rest_framework import mixins
 from rest_framework.viewsets import GenericViewSet
 
+from wallets.pagination import ListPagination
 from .serializers import UserSerializer
 
 
@@ -24,6 +25,9 @@ class UserViewSet(mixins.CreateModelMixin,
     Attributes:
       - serializer_class: The serializer class to use for User objects.
       - queryset: The queryset to use for User objects.
+      - pagination_class: Lists are paginated with a limit and offset, or
+        with a cursor over "id" when asked for, see `ListPagination`.
     """
     serializer_class = UserSerializer
     queryset = User.objects.all()
+    pagination_class = ListPagination
@@ -7,12 +7,35 @@
   to make a deposit, and returns the response. In production, the request is
   sent to a real service using the requests library. In testing mode, a mock
   response is returned based on a predefined list of possible responses.
+
+- send_third_party_deposit: Sends the POST request itself through
+  `bank_client`. Any exception is turned into a 500 response. An
+  `idempotency_key` is sent as the `Idempotency-Key` header, so the third
+  party pays a retried request only once.
+
+- request_third_party_batch / send_third_party_batch: The same for many
+  payouts in one call to `THIRD_PARTY['BATCH_URL']`. Each item carries its
+  idempotency `key` and `amount`; the response holds a result per key under
+  `items`. A failed call is returned as a single 500 response for the batch.
+
+- BankClient: A long lived HTTP client holding a pool of keep-alive
+  connections, sized to the payout concurrency so every worker reuses an open
+  connection instead of paying a TCP handshake per payout. `run_withdrawals`
+  resizes it to its `--concurrency`. Calls get separate
+  connect and read timeouts. With `THIRD_PARTY['HTTP2']` and httpx (with its
+  `http2` extra) installed, calls are multiplexed over HTTP/2 instead.
 """
 
 from random import choices
 
 import requests
 from django.conf import settings
+from requests.adapters import HTTPAdapter
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
 
 RESPONSE_WEIGHT = [
     ({'data': 'success', 'status': 200}, 0.9),
@@ -22,12 +45,110 @@ RESPONSE_WEIGHT = [
 ]
 
 
-def request_third_party_deposit():
+class BankClient:
+    """
+    A pooled, keep-alive HTTP client for the third party service.
+
+    Attributes:
+        url (str): The endpoint payouts are posted to.
+        pool_size (int): The number of connections kept open.
+        connect_timeout (float): Seconds to wait for a connection.
+        read_timeout (float): Seconds to wait for the response.
+        http2 (bool): Whether calls go over HTTP/2, which needs httpx.
+    """
+
+    def __init__(self, url, pool_size, connect_timeout, read_timeout, http2=False):
+        self.url = url
+        self.pool_size = pool_size
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.http2 = bool(http2 and httpx is not None)
+        self._client = self._connect()
+
+    def _connect(self):
+        if self.http2:
+            limits = httpx.Limits(max_connections=self.pool_size,
+                                  max_keepalive_connections=self.pool_size)
+            return httpx.Client(http2=True, limits=limits)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+        client = requests.Session()
+        client.mount('http://', adapter)
+        client.mount('https://', adapter)
+        return client
+
+    def resize(self, pool_size) -> None:
+        """
+        Keeps `pool_size` connections open from now on, closing the current
+        ones if the size changes. Meant to be called before calls are made,
+        e.g. once the payout concurrency of the process is known.
+        """
+        if pool_size == self.pool_size:
+            return
+        self.pool_size = pool_size
+        previous, self._client = self._client, self._connect()
+        previous.close()
+
+    @classmethod
+    def from_settings(cls):
+        config = settings.THIRD_PARTY
+        return cls(url=config['URL'],
+                   pool_size=config['POOL_SIZE'] or settings.PAYOUT_DISPATCHER['CONCURRENCY'],
+                   connect_timeout=config['CONNECT_TIMEOUT'],
+                   read_timeout=config['READ_TIMEOUT'],
+                   http2=config['HTTP2'])
+
+    def post(self, headers=None, read_timeout=None, url=None, json=None) -> dict:
+        """
+        Posts `json` to `url`, by default the payout endpoint, and returns the
+        decoded JSON response.
+        """
+        read_timeout = read_timeout or self.read_timeout
+        if self.http2:
+            timeout = httpx.Timeout(read_timeout, connect=self.connect_timeout)
+        else:
+            timeout = (self.connect_timeout, read_timeout)
+        return self._client.post(url or self.url, headers=headers, json=json,
+                                 timeout=timeout).json()
+
+    def close(self) -> None:
+        self._client.close()
+
+
+bank_client = BankClient.from_settings()
+
+
+def request_third_party_deposit(timeout=None, idempotency_key=None):
     if settings.TEST_DEBUG_MODE:
         responses, weights = list(zip(*RESPONSE_WEIGHT))
         response = choices(responses, weights=weights).pop()
         return response
+    return send_third_party_deposit(timeout, idempotency_key)
+
+
+def request_third_party_batch(items, timeout=None):
+    if settings.TEST_DEBUG_MODE:
+        responses, weights = list(zip(*RESPONSE_WEIGHT))
+        drawn = choices(responses, weights=weights, k=len(items))
+        return {'data': 'success', 'status': 200,
+                'items': [{'key': item['key'], **response}
+                          for item, response in zip(items, drawn) if response]}
+    return send_third_party_batch(items, timeout)
+
+
+def send_third_party_deposit(timeout=None, idempotency_key=None, client=None):
+    client = client or bank_client
+    headers = {'Idempotency-Key': idempotency_key} if idempotency_key else {}
+    try:
+        return client.post(headers=headers, read_timeout=timeout)
+    except Exception as err:
+        return {'data': str(err), 'status': 500}
+
+
+def send_third_party_batch(items, timeout=None, client=None):
+    client = client or bank_client
     try:
-        return requests.post("http://localhost:8010/").json()
+        return client.post(url=settings.THIRD_PARTY['BATCH_URL'],
+                           json={'items': items},
+                           read_timeout=timeout)
     except Exception as err:
         return {'data': str(err), 'status': 500}
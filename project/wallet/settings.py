@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/3.2/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -45,6 +46,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # removes itself unless METRICS['ENABLED'] is set
+    'wallets.metrics.metrics_middleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -81,9 +84,16 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        # payout workers write concurrently, wait for the lock instead of failing
+        'OPTIONS': {'timeout': 20},
     }
 }
 
+# the processes of the torture test can only share a test database in a file:
+# WALLET_TORTURE_TEST=1 python3 ./manage.py test
+if os.environ.get('WALLET_TORTURE_TEST'):
+    DATABASES['default']['TEST'] = {'NAME': BASE_DIR / 'test_db.sqlite3'}
+
 # Password validation
 # https://docs.djangoproject.com/en/3.2/ref/settings/#auth-password-validators
 
@@ -131,11 +141,22 @@ REST_FRAMEWORK = {
     # pagination
     'DEFAULT_PAGINATION_CLASS': 'rest_framework.pagination.LimitOffsetPagination',
     'PAGE_SIZE': 10,
+    # encodes with orjson when installed (`pip install orjson`), see `wallets/renderers.py`
+    'DEFAULT_RENDERER_CLASSES': [
+        'wallets.renderers.FastJSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ],
     # swagger
     'DEFAULT_SCHEMA_CLASS': 'drf_spectacular.openapi.AutoSchema',
 
 }
 
+# list pagination, see `wallets/pagination.py`
+PAGINATION = {
+    # mode of lists that do not ask for one with `?pagination=offset|cursor`
+    'MODE': 'offset',
+}
+
 SPECTACULAR_SETTINGS = {
     'TITLE': 'wallet',
     'VERSION': '1.0.0',
@@ -144,3 +165,131 @@ SPECTACULAR_SETTINGS = {
 }
 
 TEST_DEBUG_MODE = True if DEBUG else False
+
+# third party (bank) service, see `utils.py`
+THIRD_PARTY = {
+    'URL': 'http://localhost:8010/',
+    # many payouts in one call, see `WITHDRAWAL_EXECUTOR['PAYOUT_BATCH_SIZE']`
+    'BATCH_URL': 'http://localhost:8010/batch',
+    # seconds to wait for a connection, and for the response of a payout call
+    'CONNECT_TIMEOUT': 2.0,
+    'READ_TIMEOUT': 5.0,
+    # keep-alive connections kept open, defaults to PAYOUT_DISPATCHER['CONCURRENCY'];
+    # run_withdrawals keeps at least one per payout in flight
+    'POOL_SIZE': None,
+    # multiplex calls over HTTP/2, needs `pip install httpx[http2]`
+    'HTTP2': False,
+}
+
+# retries and circuit breaking of payouts, see `wallets/payouts.py`
+PAYOUTS = {
+    # third party calls made for a withdrawal before it fails
+    'MAX_ATTEMPTS': 5,
+    # seconds of backoff, doubled per attempt and jittered
+    'RETRY_BASE_DELAY': 2.0,
+    'RETRY_MAX_DELAY': 300.0,
+    # the breaker opens when this share of the calls in the window fails
+    'BREAKER_ERROR_RATE': 0.5,
+    'BREAKER_WINDOW': 30.0,
+    'BREAKER_MIN_CALLS': 20,
+    # seconds the breaker stays open before a probe call
+    'BREAKER_RESET_TIMEOUT': 30.0,
+}
+
+# withdrawal executor, see `python manage.py run_withdrawals`
+WITHDRAWAL_EXECUTOR = {
+    'BATCH_SIZE': 100,
+    'POLL_INTERVAL': 1.0,
+    # payouts sent to the bank per batch call, 0 sends one call per payout
+    'PAYOUT_BATCH_SIZE': 0,
+    # seconds of upcoming withdrawals kept in the timing wheel, 0 polls the table instead
+    'WHEEL_WINDOW': 0,
+    # seconds covered by one bucket of the wheel
+    'WHEEL_TICK': 1.0,
+    # seconds between loads of new withdrawals into the wheel
+    'WHEEL_REFRESH': 5.0,
+    # seconds a worker's claim on a withdrawal lasts without a heartbeat
+    'LEASE_TTL': 30,
+    # seconds past its scheduled_time after which a processing withdrawal that no
+    # lease covers is taken for crashed and retried; longer than any bank call
+    'RECOVERY_GRACE': 300,
+}
+
+# Idempotency-Key handling of POST /wallets/transactions/
+IDEMPOTENCY = {
+    # responses kept in the in-process cache, older ones are read from the database
+    'CACHE_SIZE': 10000,
+    'CACHE_TTL': 24 * 60 * 60,
+}
+
+# read-through cache of GET /wallets/wallets/{uuid}/, see `wallets/cache.py`
+WALLET_CACHE = {
+    # the alias of a cache in CACHES, or 'lru' for a TTLCache in each process. Every process
+    # that changes balances, the web workers and run_withdrawals, invalidates wallets in it,
+    # so only a cache they share, such as memcached, keeps them all current; a per process
+    # cache serves withdrawals run elsewhere up to TTL seconds late.
+    'BACKEND': 'wallets',
+    # wallets kept by the cache
+    'SIZE': 10000,
+    # seconds a cached wallet is kept
+    'TTL': 300,
+}
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    # per process; to share it between the web workers and run_withdrawals use e.g.
+    # 'BACKEND': 'django.core.cache.backends.memcached.PyMemcacheCache',
+    # 'LOCATION': '127.0.0.1:11211',
+    'wallets': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'wallets',
+        # entry and version per wallet
+        'OPTIONS': {'MAX_ENTRIES': 2 * WALLET_CACHE['SIZE']},
+    },
+}
+
+# rows read per query by GET /wallets/wallets/{uuid}/statement/
+STATEMENT_CHUNK_SIZE = 2000
+
+# largest list accepted by POST /wallets/transactions/bulk/
+TRANSACTION_BULK_MAX_ITEMS = 50000
+
+# wallet ledger, see `python manage.py snapshot_balances` and `verify_ledger`
+LEDGER = {
+    # wallets processed per chunk
+    'CHUNK_SIZE': 1000,
+    # seconds a ledger entry must be old before a snapshot covers it
+    'SNAPSHOT_LAG': 60,
+}
+
+# opt-in batching of deposits created through the API, see `wallets/coalesce.py`
+DEPOSIT_COALESCING = {
+    'ENABLED': False,
+    # seconds a deposit waits for others to join its batch
+    'MAX_DELAY': 0.01,
+    # deposits applied per batch
+    'MAX_ITEMS': 100,
+}
+
+# opt-in balance shards for hot wallets, see `python manage.py shard_wallet`. They
+# only pay off where concurrent deposits wait on a row lock, as on PostgreSQL; SQLite
+# locks the whole database, so shards only add a statement there. Unshard every
+# wallet before turning this off again.
+BALANCE_SHARDS = {
+    'ENABLED': False,
+}
+
+# payouts in flight at once, and payouts allowed to wait for a free worker
+PAYOUT_DISPATCHER = {
+    'CONCURRENCY': 8,
+    'MAX_PENDING': 16,
+}
+
+# Prometheus metrics served on GET /metrics, see `wallets/metrics.py`
+METRICS = {
+    'ENABLED': False,
+    # upper bounds in seconds of the buckets of the latency histograms
+    'BUCKETS': (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0),
+}
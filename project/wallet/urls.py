@@ -3,11 +3,13 @@ from django.urls import path, include
 from drf_spectacular.views import (SpectacularAPIView,
                                    SpectacularRedocView,
                                    SpectacularSwaggerView)
+from wallets.metrics import metrics_view
 
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('wallets/', include("wallets.urls"), name='wallets'),
     path('client/', include("client.urls"), name='client'),
+    path('metrics', metrics_view, name='metrics'),
 ]
 
 urlpatterns += [
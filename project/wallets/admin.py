@@ -1,5 +1,47 @@
+from django.conf import settings
 from django.contrib import admin
+from django.db.transaction import atomic
+
 from .models import Wallet, Transaction
 
-admin.site.register(Wallet)
-admin.site.register(Transaction)
\ No newline at end of file
+
+@admin.register(Wallet)
+class WalletAdmin(admin.ModelAdmin):
+    list_display = ('uuid', 'owner', 'balance', 'held', 'shard_count', 'updated_at')
+    list_select_related = ('owner',)
+    raw_id_fields = ('owner',)
+    # only ever changed by withdrawals, see `WalletQuerySet.reserve`
+    readonly_fields = ('held',)
+
+    def get_readonly_fields(self, request, obj=None):
+        if settings.BALANCE_SHARDS['ENABLED']:
+            return self.readonly_fields
+        return (*self.readonly_fields, 'shard_count')
+
+    def save_model(self, request, obj, form, change):
+        """
+        Applies a changed `balance` of an existing wallet as a ledger
+        adjustment and a changed `shard_count` through `set_shards`, so the
+        ledger and the shards stay in step with the wallet. The balance of a
+        sharded wallet is set including its shards.
+        """
+        if not change:
+            return super().save_model(request, obj, form, change)
+        managed = ('balance', 'shard_count')
+        fields = [name for name in form.changed_data if name not in managed]
+        with atomic():
+            if fields:
+                obj.save(update_fields=[*fields, 'updated_at'])
+            if 'shard_count' in form.changed_data:
+                Wallet.objects.set_shards(obj.pk, obj.shard_count)
+            if 'balance' in form.changed_data:
+                Wallet.objects.adjust(obj.pk, obj.balance)
+        obj.refresh_from_db()
+
+
+@admin.register(Transaction)
+class TransactionAdmin(admin.ModelAdmin):
+    list_display = ('__str__', 'method', 'scheduled_time', 'executed_time')
+    list_select_related = ('wallet__owner',)
+    # a select of every wallet would run one owner query per option
+    raw_id_fields = ('wallet', 'counterparty')
@@ -0,0 +1,141 @@
+"""
+This module contains async views creating and retrieving wallets and
+transactions, served next to the DRF viewsets under `wallets/async/` and
+meant to run under ASGI (`wallet/asgi.py`).
+
+Django 3.2 has no async ORM, so each view crosses into a worker thread once,
+with `sync_to_async`, for all of its database work including validation and
+serialization, instead of once per query. Everything else runs on the event
+loop: parsing the body and answering a retried `Idempotency-Key` from
+`idempotency_cache`, which needs no thread at all. Creating a withdrawal only
+inserts a pending row; the bank is called by the withdrawal executor, so no
+request waits on it.
+
+Requests and responses are the same as those of the viewsets, which share
+their serializers and helpers with these views.
+
+`sync_to_async` is thread sensitive, so the database work of all async
+requests of a process runs on one shared thread, one request at a time:
+while a view waits on the database, the event loop only parses bodies and
+answers replays. A process serves no more database work than a WSGI worker
+with one thread; run more processes (`uvicorn --workers`) to scale.
+"""
+
+import json
+
+from asgiref.sync import sync_to_async
+from django.http import HttpResponseNotAllowed, JsonResponse
+from rest_framework import status
+from rest_framework.exceptions import ValidationError
+
+from . import views
+from .models import Transaction
+from .serializers import TransactionSerializer, WalletSerializer
+from .views import (IDEMPOTENCY_KEY_TOO_LONG, cached_wallet, idempotency_cache,
+                    valid_idempotency_key)
+
+NOT_FOUND = {'detail': "Not found."}
+
+
+def csrf_exempt(view):
+    """
+    Marks an async view as exempt from CSRF checks like the DRF viewsets;
+    Django's own decorator wraps views in a sync function.
+    """
+    view.csrf_exempt = True
+    return view
+
+
+def parse_body(request):
+    """
+    Returns the decoded JSON body of a request, or None if it is malformed.
+    """
+    try:
+        return json.loads(request.body or b'{}')
+    except ValueError:
+        return None
+
+
+def create_wallet(request, data) -> (dict, int):
+    serializer = WalletSerializer(data=data, context={'request': request})
+    if not serializer.is_valid():
+        return serializer.errors, status.HTTP_400_BAD_REQUEST
+    serializer.save()
+    return serializer.data, status.HTTP_201_CREATED
+
+
+def retrieve_wallet(request, uuid) -> (dict, int):
+    wallet = cached_wallet(uuid)
+    if wallet is None:
+        return NOT_FOUND, status.HTTP_404_NOT_FOUND
+    return WalletSerializer(wallet, context={'request': request}).data, status.HTTP_200_OK
+
+
+def create_transaction(data, key) -> (dict, int, bool):
+    serializer = TransactionSerializer(data=data)
+    try:
+        data, replayed = views.create_transaction(serializer, key)
+    except ValidationError:
+        return serializer.errors, status.HTTP_400_BAD_REQUEST, False
+    return data, status.HTTP_201_CREATED, replayed
+
+
+def retrieve_transaction(pk) -> (dict, int):
+    transaction = Transaction.objects.filter(pk=pk).first()
+    if transaction is None:
+        return NOT_FOUND, status.HTTP_404_NOT_FOUND
+    return TransactionSerializer(transaction).data, status.HTTP_200_OK
+
+
+def idempotent_response(data, replayed, status_code=status.HTTP_201_CREATED):
+    response = JsonResponse(data, status=status_code)
+    if replayed:
+        response['Idempotent-Replayed'] = 'true'
+    return response
+
+
+@csrf_exempt
+async def wallet_create(request):
+    if request.method != 'POST':
+        return HttpResponseNotAllowed(['POST'])
+    data = parse_body(request)
+    if data is None:
+        return JsonResponse({'detail': "JSON parse error."}, status=status.HTTP_400_BAD_REQUEST)
+    data, status_code = await sync_to_async(create_wallet)(request, data)
+    return JsonResponse(data, status=status_code)
+
+
+async def wallet_detail(request, uuid):
+    if request.method != 'GET':
+        return HttpResponseNotAllowed(['GET'])
+    data, status_code = await sync_to_async(retrieve_wallet)(request, uuid)
+    return JsonResponse(data, status=status_code)
+
+
+@csrf_exempt
+async def transaction_create(request):
+    """
+    Creates a transaction; a request carrying an `Idempotency-Key` header
+    creates at most one transaction per key.
+    """
+    if request.method != 'POST':
+        return HttpResponseNotAllowed(['POST'])
+    key = request.headers.get('Idempotency-Key')
+    if not valid_idempotency_key(key):
+        return JsonResponse(IDEMPOTENCY_KEY_TOO_LONG, status=status.HTTP_400_BAD_REQUEST)
+    if key is not None:
+        data = idempotency_cache.get(key)
+        if data is not None:
+            return idempotent_response(data, replayed=True)
+    data = parse_body(request)
+    if data is None:
+        return JsonResponse({'detail': "JSON parse error."}, status=status.HTTP_400_BAD_REQUEST)
+    data, status_code, replayed = await sync_to_async(create_transaction)(data, key)
+    return idempotent_response(data, replayed, status_code)
+
+
+async def transaction_detail(request, pk):
+    if request.method != 'GET':
+        return HttpResponseNotAllowed(['GET'])
+    data, status_code = await sync_to_async(retrieve_transaction)(pk)
+    return JsonResponse(data, status=status_code)
@@ -0,0 +1,94 @@
+"""
+Benchmark scenarios run by `python manage.py wallet_bench`.
+
+A scenario is a function registered with the `scenario` decorator. It takes
+its options as keyword arguments and returns a JSON-serializable dict with
+its measurements. Latencies are reported as p50/p95/p99 by `latency_summary`.
+Data for scenarios to run against is seeded by `seed.seed`.
+"""
+
+import time
+from contextlib import contextmanager
+from decimal import Decimal
+from uuid import uuid4
+
+from django.contrib.auth.models import User
+
+from wallets.models import Wallet
+
+SCENARIOS = {}
+
+
+def scenario(name):
+    def register(func):
+        SCENARIOS[name] = func
+        return func
+    return register
+
+
+def as_list(value) -> list:
+    """
+    Wraps a single option value in a list.
+    """
+    return list(value) if isinstance(value, (list, tuple)) else [value]
+
+
+def percentile(samples, q) -> float:
+    """
+    Returns the `q`-th percentile of `samples` by the nearest-rank method.
+    """
+    ordered = sorted(samples)
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, max(0, -(-len(ordered) * q // 100) - 1))]
+
+
+def latency_summary(samples) -> dict:
+    """
+    Returns the p50, p95, p99 and maximum of latencies in seconds, in ms.
+    """
+    return {
+        'p50_ms': round(percentile(samples, 50) * 1000, 2),
+        'p95_ms': round(percentile(samples, 95) * 1000, 2),
+        'p99_ms': round(percentile(samples, 99) * 1000, 2),
+        'max_ms': round(max(samples, default=0.0) * 1000, 2),
+    }
+
+
+def throughput(count, elapsed) -> float:
+    """
+    Returns operations per second, rounded for reporting.
+    """
+    return round(count / elapsed, 2) if elapsed else 0.0
+
+
+class Timer:
+    """
+    Context manager measuring wall-clock seconds in `elapsed`.
+    """
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.elapsed = time.perf_counter() - self.started
+
+
+@contextmanager
+def bench_wallets(count=1, balance="0.00"):
+    """
+    Creates throwaway users with one wallet each and deletes them on exit.
+    """
+    wallets = [
+        Wallet.objects.create(owner=User.objects.create(username=f"bench-{uuid4().hex}"),
+                              balance=Decimal(balance))
+        for _ in range(count)
+    ]
+    try:
+        yield wallets
+    finally:
+        User.objects.filter(pk__in=[wallet.owner_id for wallet in wallets]).delete()
+
+
+from . import balance, cache, deposits, http, ingest, listing, load, pagination, payouts, statement, torture, transfer, wheel, workers  # noqa: E402,F401
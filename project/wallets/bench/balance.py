@@ -0,0 +1,121 @@
+"""
+Contention on a single hot wallet.
+
+Every thread alternates deposits and withdrawals of `amount` on the same
+wallet. `mode=atomic` goes through `Wallet.deposit` / `Wallet.withdraw`,
+`mode=naive` replays the old read-modify-write on a fetched instance. The
+final balance is compared with the one implied by the successful operations;
+any difference is reported as lost updates.
+
+`shard_deposits` only deposits into the hot wallet, once for each number of
+balance shards in `shards`, and reports deposits per second for each. 0 runs
+with `BALANCE_SHARDS` disabled, the default.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+
+from django.db import connection
+from django.test import override_settings
+
+from wallets.models import Wallet
+
+from . import Timer, as_list, bench_wallets, scenario, throughput
+
+
+def bank_success():
+    return {'data': 'success', 'status': 200}
+
+
+def naive_deposit(pk, amount):
+    wallet = Wallet.objects.get(pk=pk)
+    wallet.balance += amount
+    wallet.save()
+    return True
+
+
+def naive_withdraw(pk, amount):
+    wallet = Wallet.objects.get(pk=pk)
+    if wallet.balance < amount:
+        return False
+    wallet.balance -= amount
+    wallet.save()
+    return True
+
+
+def atomic_deposit(pk, amount):
+    return Wallet(pk=pk).deposit(amount)[1]
+
+
+def atomic_withdraw(pk, amount):
+    return Wallet(pk=pk).withdraw(amount, bank_success)[1]
+
+
+MODES = {
+    'naive': (naive_deposit, naive_withdraw),
+    'atomic': (atomic_deposit, atomic_withdraw),
+}
+
+
+@scenario('balance_contention')
+def balance_contention(threads=8, operations=200, amount="1.00", mode='atomic'):
+    deposit, withdraw = MODES[mode]
+    amount = Decimal(amount)
+
+    def worker(_):
+        net = Decimal("0.00")
+        try:
+            for i in range(operations):
+                if i % 2 == 0:
+                    if deposit(pk, amount):
+                        net += amount
+                elif withdraw(pk, amount):
+                    net -= amount
+        finally:
+            connection.close()
+        return net
+
+    with bench_wallets() as (wallet,):
+        pk = wallet.pk
+        with Timer() as timer, ThreadPoolExecutor(max_workers=threads) as pool:
+            expected = sum(pool.map(worker, range(threads)), Decimal("0.00"))
+        final = Wallet.objects.get(pk=pk).balance
+    total = threads * operations
+    return {
+        'mode': mode,
+        'threads': threads,
+        'operations': total,
+        'seconds': round(timer.elapsed, 3),
+        'operations_per_second': throughput(total, timer.elapsed),
+        'expected_balance': str(expected),
+        'final_balance': str(final),
+        'lost_updates': int(abs(expected - final) / amount),
+    }
+
+
+@scenario('shard_deposits')
+def shard_deposits(threads=8, operations=200, amount="1.00", shards=(0, 4, 16)):
+    amount = Decimal(amount)
+    results = {'threads': threads, 'deposits': threads * operations}
+
+    def worker(_):
+        try:
+            for _ in range(operations):
+                Wallet(pk=pk).deposit(amount)
+        finally:
+            connection.close()
+
+    for count in as_list(shards):
+        with override_settings(BALANCE_SHARDS={'ENABLED': bool(count)}), \
+                bench_wallets() as (wallet,):
+            pk = wallet.pk
+            Wallet.objects.set_shards(pk, count)
+            with Timer() as timer, ThreadPoolExecutor(max_workers=threads) as pool:
+                list(pool.map(worker, range(threads)))
+            final = Wallet.objects.with_shard_balance().get(pk=pk).total_balance
+        results[f'shards_{count}'] = {
+            'seconds': round(timer.elapsed, 3),
+            'deposits_per_second': throughput(threads * operations, timer.elapsed),
+            'lost_updates': int(abs(amount * threads * operations - final) / amount),
+        }
+    return results
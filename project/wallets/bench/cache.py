@@ -0,0 +1,54 @@
+"""
+Wallet detail reads with and without the read-through cache.
+
+Reads `GET /wallets/wallets/{uuid}/` `reads` times spread over `wallets`
+wallets, depositing into one of them every `write_every` reads, first with
+`wallet_cache` bypassed, then through an in-process `TTLCache` and through
+the configured cache, and reports reads per second and hit rates.
+"""
+
+from decimal import Decimal
+from unittest import mock
+
+from django.test import RequestFactory
+
+from wallets.cache import TTLCache, WalletCache, build_wallet_cache
+from wallets.views import WalletViewSet
+
+from . import Timer, bench_wallets, scenario, throughput
+
+
+class NoCache(WalletCache):
+    def get(self, pk, load):
+        self._count(hit=False)
+        return load(pk)
+
+    def invalidate(self, pk):
+        pass
+
+
+def run(wallets, reads, write_every) -> float:
+    factory = RequestFactory(SERVER_NAME='localhost')
+    view = WalletViewSet.as_view({'get': 'retrieve'})
+    with Timer() as timer:
+        for i in range(reads):
+            wallet = wallets[i % len(wallets)]
+            if write_every and i % write_every == 0:
+                wallet.deposit(Decimal("1.00"))
+            response = view(factory.get(f'/wallets/wallets/{wallet.uuid}/'), uuid=str(wallet.uuid))
+            response.render()
+    return throughput(reads, timer.elapsed)
+
+
+@scenario('wallet_cache')
+def wallet_cache(reads=5000, wallets=100, write_every=100):
+    results = {'reads': reads, 'wallets': wallets, 'write_every': write_every}
+    with bench_wallets(wallets) as created:
+        for name, cache in (('uncached', NoCache(None)),
+                            ('lru', WalletCache(TTLCache(maxsize=2 * wallets, ttl=300))),
+                            ('configured', build_wallet_cache())):
+            with mock.patch('wallets.views.wallet_cache', cache), \
+                    mock.patch('wallets.models.wallet_cache', cache):
+                results[f'{name}_reads_per_second'] = run(created, reads, write_every)
+            results[f'{name}_hit_rate'] = cache.stats()['hit_rate']
+    return results
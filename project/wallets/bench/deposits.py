@@ -0,0 +1,63 @@
+"""
+Deposits executed one by one versus through the deposit coalescer.
+
+`threads` clients each post `requests` deposits spread over `wallets` wallets
+through `POST /wallets/transactions/`, first with `DEPOSIT_COALESCING`
+disabled and then enabled with `max_delay` and `max_items`, and report
+deposits per second and the p50, p95 and p99 latency of a request.
+"""
+
+import time
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+from django.db import connection
+from django.test import override_settings
+from rest_framework.test import APIRequestFactory
+
+from wallets.coalesce import DepositCoalescer
+from wallets.views import TransactionViewSet
+
+from . import Timer, bench_wallets, latency_summary, scenario, throughput
+
+PATH = '/wallets/transactions/'
+
+
+def run(wallets, threads, requests) -> dict:
+    factory = APIRequestFactory(SERVER_NAME='localhost')
+    view = TransactionViewSet.as_view({'post': 'create'})
+
+    def client(index):
+        latencies = []
+        try:
+            for i in range(requests):
+                wallet = wallets[(index + i) % len(wallets)]
+                started = time.perf_counter()
+                response = view(factory.post(PATH, {'wallet': str(wallet.uuid), 'amount': '1.00',
+                                                    'method': '0'}, format='json'))
+                latencies.append(time.perf_counter() - started)
+                assert response.status_code == 201, response.data
+        finally:
+            connection.close()
+        return latencies
+
+    with Timer() as timer, ThreadPoolExecutor(max_workers=threads) as pool:
+        latencies = [latency for client_latencies in pool.map(client, range(threads))
+                     for latency in client_latencies]
+    return {
+        'deposits_per_second': throughput(len(latencies), timer.elapsed),
+        **latency_summary(latencies),
+    }
+
+
+@scenario('deposit_coalescing')
+def deposit_coalescing(threads=16, requests=100, wallets=4, max_delay=0.01, max_items=100):
+    results = {'threads': threads, 'deposits': threads * requests, 'wallets': wallets}
+    with bench_wallets(wallets) as created:
+        results['direct'] = run(created, threads, requests)
+        coalescer = DepositCoalescer(max_delay=max_delay, max_items=max_items)
+        with override_settings(DEPOSIT_COALESCING={'ENABLED': True, 'MAX_DELAY': max_delay,
+                                                   'MAX_ITEMS': max_items}), \
+                mock.patch('wallets.serializers.deposit_coalescer', coalescer):
+            results['coalesced'] = run(created, threads, requests)
+    return results
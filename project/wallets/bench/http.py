@@ -0,0 +1,120 @@
+"""
+HTTP benchmarks.
+
+`bank_client` measures the per-call overhead of the pooled bank client.
+Start the stand-in first (`python third-party/app.py`). Calls are made with
+`?delay=0`, so the stand-in answers at once and what is measured is the cost
+of the call itself: `requests.post` opening a fresh connection per call
+versus `BankClient` reusing its keep-alive pool, first one call at a time and
+then `concurrency` calls at a time.
+
+`http_load` load-tests a running deployment of this project at `url`, e.g.
+gunicorn serving `wallet.wsgi` versus uvicorn serving `wallet.asgi`, with
+`concurrency` clients each reusing one keep-alive connection. Every level
+retrieves and creates deposit transactions through the DRF viewsets
+(`/wallets/transactions/`) and the async views
+(`/wallets/async/transactions/`). The server must use the same database as
+the benchmark.
+"""
+
+import threading
+
+import requests
+from django.conf import settings
+
+from utils import BankClient, send_third_party_deposit
+from wallets.dispatch import PayoutDispatcher
+
+from . import Timer, as_list, bench_wallets, scenario, throughput
+
+ENDPOINTS = {
+    'sync': '/wallets/transactions/',
+    'async': '/wallets/async/transactions/',
+}
+
+
+def fresh_connection(url, timeout):
+    try:
+        return requests.post(url, timeout=timeout).json()
+    except Exception as err:
+        return {'data': str(err), 'status': 500}
+
+
+def measure(call, calls, concurrency) -> dict:
+    with PayoutDispatcher(concurrency=concurrency, max_pending=concurrency) as dispatcher:
+        with Timer() as timer:
+            responses = dispatcher.map(lambda _: call(), range(calls))
+    return {
+        'calls_per_second': throughput(calls, timer.elapsed),
+        'ms_per_call': round(timer.elapsed * 1000 * concurrency / calls, 3),
+        'errors': sum(response.get('status') not in (200, 503) for response in responses),
+    }
+
+
+@scenario('bank_client')
+def bank_client(calls=500, concurrency=8, timeout=5.0):
+    url = f"{settings.THIRD_PARTY['URL']}?delay=0"
+    client = BankClient(url=url, pool_size=concurrency,
+                        connect_timeout=settings.THIRD_PARTY['CONNECT_TIMEOUT'],
+                        read_timeout=timeout, http2=settings.THIRD_PARTY['HTTP2'])
+    results = {'calls': calls, 'http2': client.http2}
+    try:
+        for level in (1, concurrency):
+            fresh = measure(lambda: fresh_connection(url, timeout), calls, level)
+            pooled = measure(lambda: send_third_party_deposit(client=client), calls, level)
+            results[f'concurrency_{level}'] = {
+                'fresh': fresh,
+                'pooled': pooled,
+                'saved_ms_per_call': round(fresh['ms_per_call'] - pooled['ms_per_call'], 3),
+            }
+    finally:
+        client.close()
+    return results
+
+
+def load(call, calls, concurrency) -> dict:
+    local = threading.local()
+
+    def request(index):
+        if not hasattr(local, 'session'):
+            local.session = requests.Session()
+        try:
+            return call(local.session, index).status_code
+        except requests.RequestException:
+            return None
+
+    with PayoutDispatcher(concurrency=concurrency, max_pending=concurrency) as dispatcher:
+        with Timer() as timer:
+            statuses = dispatcher.map(request, range(calls))
+    return {
+        'requests_per_second': throughput(calls, timer.elapsed),
+        'errors': sum(code not in (200, 201) for code in statuses),
+    }
+
+
+def send(url, path, data) -> dict:
+    response = requests.post(f'{url}{path}', json=data)
+    response.raise_for_status()
+    return response.json()
+
+
+@scenario('http_load')
+def http_load(url='http://localhost:8000', requests=1000, concurrency=(16, 128),
+              endpoint=('sync', 'async')):
+    url = url.rstrip('/')
+    results = {'url': url, 'requests': requests, 'levels': []}
+    with bench_wallets(1) as (wallet,):
+        deposit = {'wallet': str(wallet.uuid), 'amount': '1.00', 'method': '0'}
+        created = send(url, ENDPOINTS['sync'], deposit)
+        for level in as_list(concurrency):
+            for name in as_list(endpoint):
+                path = f'{url}{ENDPOINTS[name]}'
+                results['levels'].append({
+                    'endpoint': name,
+                    'concurrency': level,
+                    'retrieve': load(lambda session, _: session.get(f"{path}{created['id']}/"),
+                                     requests, level),
+                    'create': load(lambda session, _: session.post(path, json=deposit),
+                                   requests, level),
+                })
+    return results
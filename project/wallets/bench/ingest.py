@@ -0,0 +1,61 @@
+"""
+Single versus bulk transaction ingestion.
+
+Posts `items` deposits spread over `wallets` wallets one request at a time
+through `POST /wallets/transactions/`, then the same items in one request to
+`POST /wallets/transactions/bulk/`, and compares items per second. With
+`stack=view` requests go straight to the view; with `stack=full` they go
+through the middleware and URL routing too, as a client's requests do.
+"""
+
+import json
+
+from django.test import Client
+from rest_framework.test import APIRequestFactory
+
+from wallets.views import TransactionViewSet
+
+from . import Timer, bench_wallets, scenario, throughput
+
+PATH = '/wallets/transactions/'
+
+
+def senders(stack):
+    """
+    Returns functions posting one item and a list of items, through `stack`.
+    """
+    if stack == 'full':
+        client = Client(SERVER_NAME='localhost')
+        return (lambda item: client.post(PATH, item, 'application/json'),
+                lambda payload: client.post(f'{PATH}bulk/', json.dumps(payload),
+                                            'application/json'))
+    factory = APIRequestFactory(SERVER_NAME='localhost')
+    single_view = TransactionViewSet.as_view({'post': 'create'})
+    bulk_view = TransactionViewSet.as_view({'post': 'bulk'})
+    return (lambda item: single_view(factory.post(PATH, item, format='json')),
+            lambda payload: bulk_view(factory.post(f'{PATH}bulk/', json.dumps(payload),
+                                                   content_type='application/json')))
+
+
+@scenario('bulk_ingest')
+def bulk_ingest(items=2000, wallets=10, stack='view'):
+    send_single, send_bulk = senders(stack)
+    with bench_wallets(wallets) as created:
+        payload = [{'wallet': str(created[i % wallets].uuid), 'amount': '1.00', 'method': '0'}
+                   for i in range(items)]
+        with Timer() as single:
+            for item in payload:
+                send_single(item)
+        with Timer() as bulk:
+            response = send_bulk(payload)
+    single_rate = throughput(items, single.elapsed)
+    bulk_rate = throughput(items, bulk.elapsed)
+    return {
+        'items': items,
+        'wallets': wallets,
+        'stack': stack,
+        'bulk_status': response.status_code,
+        'single_items_per_second': single_rate,
+        'bulk_items_per_second': bulk_rate,
+        'speedup': round(bulk_rate / single_rate, 1) if single_rate else None,
+    }
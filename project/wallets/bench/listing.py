@@ -0,0 +1,86 @@
+"""
+Rows per second of the transaction and wallet lists on large pages.
+
+Seeds `rows` transactions and `wallets` wallets, then times the first page
+of `/wallets/transactions/` and `/wallets/wallets/` of each `page_size`,
+rendered to bytes, three ways: through the serializer with the stdlib JSON
+renderer as before, read as rows with the stdlib JSON renderer, and read as
+rows with `FastJSONRenderer`, which needs orjson for its speed. Reports the
+median rows per second of each, and whether all three gave the same bytes.
+"""
+
+import statistics
+import time
+from decimal import Decimal
+
+from django.contrib.auth.models import User
+from django.test import RequestFactory
+from rest_framework.renderers import JSONRenderer
+
+from wallets.models import Transaction, Wallet
+from wallets.renderers import FastJSONRenderer, orjson
+from wallets.views import TransactionViewSet, WalletViewSet
+
+from . import as_list, bench_wallets, scenario
+
+# variant, whether lists are read as rows, renderer
+VARIANTS = (
+    ('serializer', False, JSONRenderer),
+    ('rows', True, JSONRenderer),
+    ('rows_fast_json', True, FastJSONRenderer),
+)
+
+
+def rows_per_second(viewset, url, rows, repeat) -> (dict, bool):
+    """
+    Returns the median rows per second of each variant listing `url`, and
+    whether they all rendered the same bytes.
+    """
+    factory = RequestFactory(SERVER_NAME='localhost')
+    results, contents = {}, set()
+    for name, fast_list, renderer in VARIANTS:
+        view = viewset.as_view({'get': 'list'}, fast_list=fast_list, renderer_classes=[renderer])
+        timings = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            response = view(factory.get(url))
+            response.render()
+            timings.append(time.perf_counter() - started)
+        contents.add(response.content)
+        results[f'{name}_rows_per_second'] = round(rows / statistics.median(timings), 2)
+    results['speedup'] = round(results['rows_fast_json_rows_per_second']
+                               / results['serializer_rows_per_second'], 2)
+    return results, len(contents) == 1
+
+
+@scenario('list_rows')
+def list_rows(rows=20000, wallets=2000, page_size=(100, 1000), repeat=10):
+    page_sizes = as_list(page_size)
+    results = {'orjson': orjson is not None, 'identical': True}
+    with bench_wallets() as (wallet,):
+        Transaction.objects.bulk_create(
+            (Transaction(wallet=wallet, amount=Decimal(index % 10000) / 100,
+                         method=Transaction.Method.DEPOSIT, status=Transaction.Status.COMPLETED,
+                         status_description="deposited successfully",
+                         executed_time=1700000000 + index)
+             for index in range(rows)),
+            batch_size=5000)
+        owners = User.objects.bulk_create(User(username=f'list-rows-{index}', password='!')
+                                          for index in range(wallets))
+        if owners and owners[0].pk is None:
+            owners = list(User.objects.filter(username__startswith='list-rows-'))
+        try:
+            Wallet.objects.bulk_create((Wallet(owner=owner, balance=Decimal(index) / 100)
+                                        for index, owner in enumerate(owners)),
+                                       batch_size=5000)
+            for size in page_sizes:
+                for name, viewset, path, count in (
+                        ('transactions', TransactionViewSet, '/wallets/transactions/', rows),
+                        ('wallets', WalletViewSet, '/wallets/wallets/', wallets)):
+                    url = f'{path}?pagination=cursor&limit={size}'
+                    listed, identical = rows_per_second(viewset, url, min(size, count), repeat)
+                    results[f'{name}_{size}'] = listed
+                    results['identical'] &= identical
+        finally:
+            User.objects.filter(username__startswith='list-rows-').delete()
+    return results
@@ -0,0 +1,213 @@
+"""
+Synthetic load through the whole request stack and the withdrawal executor.
+
+Every scenario reports throughput and the p50/p95/p99 latency of its
+operations, so runs can be compared with `wallet_bench --baseline`. Seed
+data first with `wallet_bench --seed` to run them against large tables.
+
+`deposit_storm`: `threads` clients post `requests` deposits each to a single
+hot wallet. Reports deposits per second, request latency and lost updates,
+which must be none.
+
+`withdrawal_burst`: `withdrawals` withdrawals are all scheduled for the same
+second and drained by one executor paying `concurrency` at once. With
+`bank=mock` payouts are answered by the `TEST_DEBUG_MODE` mock of `utils.py`,
+which fails some of them; with `bank=stub` they go to the third party
+stand-in (`python third-party/app.py`). Reports withdrawals per second, the
+seconds from the burst to each payout and the resulting statuses.
+
+`mixed_api`: `threads` clients each send `requests` requests, a share
+`reads` of them reads (a wallet, a transaction or the first page of the
+transaction list) and the rest writes (a deposit or a withdrawal scheduled
+for later), over `wallets` wallets. Reports requests per second and the
+latency of every kind of request.
+
+`deep_pagination`: adds `rows` transactions and follows the `next` cursor
+of the transaction list for `pages` pages of `page_size`. Reports pages per
+second, the latency of a page and of the first and last page.
+"""
+
+import random
+import time
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+
+from django.db import connection
+from django.test import Client, override_settings
+from django.utils import timezone
+
+from wallets.dispatch import PayoutDispatcher
+from wallets.models import Transaction, Wallet
+from wallets.payouts import payout_client
+from wallets.scheduler import WithdrawalExecutor
+
+from . import Timer, bench_wallets, latency_summary, scenario, throughput
+
+TRANSACTIONS = '/wallets/transactions/'
+WALLETS = '/wallets/wallets/'
+
+# TEST_DEBUG_MODE per bank
+BANKS = {'mock': True, 'stub': False}
+
+
+def client():
+    return Client(SERVER_NAME='localhost')
+
+
+def timed(send, *args) -> (float, int):
+    started = time.perf_counter()
+    response = send(*args)
+    return time.perf_counter() - started, response.status_code
+
+
+def mixed_request(api, rng, wallet, ids, reads) -> (str, float, bool):
+    """
+    Sends one request of the mix, and returns its kind, latency and whether
+    it failed.
+    """
+    if rng.random() < reads:
+        kind = rng.choice(('wallet', 'transaction', 'list'))
+        path = {'wallet': f'{WALLETS}{wallet.uuid}/',
+                'transaction': f'{TRANSACTIONS}{rng.choice(ids)}/',
+                'list': TRANSACTIONS}[kind]
+        latency, status_code = timed(api.get, path)
+        return kind, latency, status_code != 200
+    kind = rng.choice(('deposit', 'withdrawal'))
+    data = {'wallet': str(wallet.uuid), 'amount': '1.00',
+            'method': '0' if kind == 'deposit' else '1'}
+    latency, status_code = timed(api.post, TRANSACTIONS, data, 'application/json')
+    return kind, latency, status_code != 201
+
+
+@scenario('deposit_storm')
+def deposit_storm(threads=16, requests=100, amount="1.00"):
+    amount = Decimal(amount)
+
+    def work(_):
+        api = client()
+        latencies, errors = [], 0
+        try:
+            for _ in range(requests):
+                latency, status_code = timed(api.post, TRANSACTIONS, data, 'application/json')
+                latencies.append(latency)
+                errors += status_code != 201
+        finally:
+            connection.close()
+        return latencies, errors
+
+    with bench_wallets() as (wallet,):
+        data = {'wallet': str(wallet.uuid), 'amount': str(amount), 'method': '0'}
+        with Timer() as timer, ThreadPoolExecutor(max_workers=threads) as pool:
+            results = list(pool.map(work, range(threads)))
+        final = Wallet.objects.with_shard_balance().get(pk=wallet.pk).total_balance
+    latencies = [latency for latencies, _ in results for latency in latencies]
+    errors = sum(errors for _, errors in results)
+    return {
+        'threads': threads,
+        'deposits': len(latencies),
+        'errors': errors,
+        'deposits_per_second': throughput(len(latencies), timer.elapsed),
+        **latency_summary(latencies),
+        'lost_updates': int(abs(amount * (len(latencies) - errors) - final) / amount),
+    }
+
+
+@scenario('withdrawal_burst')
+def withdrawal_burst(withdrawals=500, concurrency=8, batch_size=100, bank='mock'):
+    payout_client.reset()
+    with bench_wallets(balance=withdrawals) as (wallet,), \
+            override_settings(TEST_DEBUG_MODE=BANKS[bank]):
+        burst = int(timezone.now().timestamp())
+        Transaction.objects.bulk_create(
+            Transaction(wallet=wallet, amount=Decimal("1.00"), method=Transaction.Method.WITHDRAW,
+                        scheduled_time=burst)
+            for _ in range(withdrawals))
+        with PayoutDispatcher(concurrency=concurrency, max_pending=concurrency) as dispatcher:
+            executor = WithdrawalExecutor(batch_size=batch_size, dispatcher=dispatcher)
+            execute, latencies = executor.execute, []
+
+            def execute_timed(transaction):
+                execute(transaction)
+                latencies.append(time.perf_counter() - timer.started)
+
+            executor.execute = execute_timed
+            with Timer() as timer:
+                while executor.run_once():
+                    pass
+        labels = dict(Transaction.Status.choices)
+        statuses = Counter(labels[status] for status in Transaction.objects.filter(
+            wallet=wallet).values_list('status', flat=True))
+    return {
+        'withdrawals': withdrawals,
+        'bank': bank,
+        'concurrency': concurrency,
+        'withdrawals_per_second': throughput(len(latencies), timer.elapsed),
+        **latency_summary(latencies),
+        'statuses': {str(label): count for label, count in sorted(statuses.items())},
+    }
+
+
+@scenario('mixed_api')
+def mixed_api(threads=8, requests=200, reads=0.8, wallets=50):
+    def work(index):
+        rng = random.Random(index)
+        api = client()
+        latencies, errors = defaultdict(list), 0
+        try:
+            for _ in range(requests):
+                kind, latency, failed = mixed_request(api, rng, rng.choice(created), ids, reads)
+                latencies[kind].append(latency)
+                errors += failed
+        finally:
+            connection.close()
+        return latencies, errors
+
+    with bench_wallets(wallets, balance="1000.00") as created:
+        Transaction.objects.bulk_create(
+            Transaction(wallet=wallet, amount=Decimal("1.00"), method=Transaction.Method.DEPOSIT)
+            for wallet in created)
+        ids = list(Transaction.objects.filter(wallet__in=created).values_list('id', flat=True))
+        with Timer() as timer, ThreadPoolExecutor(max_workers=threads) as pool:
+            results = list(pool.map(work, range(threads)))
+    latencies = defaultdict(list)
+    for thread_latencies, _ in results:
+        for kind, samples in thread_latencies.items():
+            latencies[kind] += samples
+    total = sum(len(samples) for samples in latencies.values())
+    return {
+        'threads': threads,
+        'requests': total,
+        'reads': reads,
+        'errors': sum(errors for _, errors in results),
+        'requests_per_second': throughput(total, timer.elapsed),
+        **latency_summary([latency for samples in latencies.values() for latency in samples]),
+        'kinds': {kind: {'requests': len(samples), **latency_summary(samples)}
+                  for kind, samples in sorted(latencies.items())},
+    }
+
+
+@scenario('deep_pagination')
+def deep_pagination(rows=20000, page_size=100, pages=50):
+    api = client()
+    with bench_wallets() as (wallet,):
+        Transaction.objects.bulk_create(
+            (Transaction(wallet=wallet, amount=1, method=Transaction.Method.DEPOSIT)
+             for _ in range(rows)),
+            batch_size=5000)
+        url, latencies = f'{TRANSACTIONS}?pagination=cursor&limit={page_size}', []
+        with Timer() as timer:
+            while url and len(latencies) < pages:
+                started = time.perf_counter()
+                response = api.get(url)
+                latencies.append(time.perf_counter() - started)
+                url = response.json()['next']
+    return {
+        'rows': rows,
+        'page_size': page_size,
+        'pages': len(latencies),
+        'pages_per_second': throughput(len(latencies), timer.elapsed),
+        **latency_summary(latencies),
+        'first_page_ms': round(latencies[0] * 1000, 2),
+        'last_page_ms': round(latencies[-1] * 1000, 2),
+    }
@@ -0,0 +1,68 @@
+"""
+First versus deep page latency of the transaction list.
+
+Seeds `rows` transactions, then times page 1 and page `deep_page` of
+`/wallets/transactions/` with the default `LimitOffsetPagination` and with
+the cursor pagination of `?pagination=cursor`. Offset pages get slower with depth
+and always pay for a `COUNT(*)`; cursor pages should not.
+"""
+
+import statistics
+import time
+
+from django.test import RequestFactory
+from rest_framework.pagination import Cursor, LimitOffsetPagination
+
+from wallets.models import Transaction
+from wallets.pagination import KeysetPagination
+from wallets.views import TransactionViewSet
+
+from . import bench_wallets, scenario
+
+PATH = '/wallets/transactions/'
+
+
+def median_ms(view, url, repeat):
+    factory = RequestFactory(SERVER_NAME='localhost')
+    timings = []
+    for _ in range(repeat):
+        request = factory.get(url)
+        started = time.perf_counter()
+        response = view(request)
+        response.render()
+        timings.append(time.perf_counter() - started)
+    return round(statistics.median(timings) * 1000, 3)
+
+
+def cursor_url(position):
+    paginator = KeysetPagination()
+    paginator.base_url = PATH
+    return paginator.encode_cursor(Cursor(offset=0, reverse=False, position=str(position)))
+
+
+@scenario('pagination')
+def pagination(rows=1000000, page_size=10, deep_page=1000, repeat=20):
+    offset_view = TransactionViewSet.as_view({'get': 'list'},
+                                             pagination_class=LimitOffsetPagination)
+    cursor_view = TransactionViewSet.as_view({'get': 'list'}, pagination_class=KeysetPagination)
+    deep_offset = page_size * (deep_page - 1)
+    with bench_wallets() as (wallet,):
+        Transaction.objects.bulk_create(
+            (Transaction(wallet=wallet, amount=1, method=Transaction.Method.DEPOSIT)
+             for _ in range(rows)),
+            batch_size=5000)
+        # the cursor of a deep page holds the last id of the page before it
+        last_id = Transaction.objects.order_by('-id').values_list('id', flat=True)[deep_offset - 1]
+        results = {
+            'rows': Transaction.objects.count(),
+            'page_size': page_size,
+            'deep_page': deep_page,
+            'offset_first_ms': median_ms(offset_view, f'{PATH}?limit={page_size}', repeat),
+            'offset_deep_ms': median_ms(offset_view,
+                                        f'{PATH}?limit={page_size}&offset={deep_offset}',
+                                        repeat),
+            'cursor_first_ms': median_ms(cursor_view, f'{PATH}?limit={page_size}', repeat),
+            'cursor_deep_ms': median_ms(cursor_view,
+                                        f'{cursor_url(last_id)}&limit={page_size}', repeat),
+        }
+    return results
@@ -0,0 +1,63 @@
+"""
+Payout throughput against the third party stand-in.
+
+Start the stand-in first (`python third-party/app.py`); every call takes
+about one second there, so throughput should grow with concurrency.
+
+`payout_batch` sends the same payouts as `batch_size` items per bank call,
+which pays the one second once per batch instead of once per payout.
+"""
+
+from uuid import uuid4
+
+from utils import send_third_party_batch, send_third_party_deposit
+from wallets.dispatch import PayoutDispatcher
+
+from . import Timer, as_list, scenario, throughput
+
+
+@scenario('payout_dispatch')
+def payout_dispatch(requests=32, concurrency=(1, 4, 16), timeout=5.0):
+    levels = []
+    for level in as_list(concurrency):
+        with PayoutDispatcher(concurrency=level, max_pending=level) as dispatcher:
+            with Timer() as timer:
+                responses = dispatcher.map(lambda _: send_third_party_deposit(timeout),
+                                           range(requests))
+        levels.append({
+            'concurrency': level,
+            'requests': requests,
+            'seconds': round(timer.elapsed, 3),
+            'payouts_per_second': throughput(requests, timer.elapsed),
+            'errors': sum(response.get('status') != 200 for response in responses),
+        })
+    return {'levels': levels}
+
+
+@scenario('payout_batch')
+def payout_batch(requests=256, concurrency=8, batch_size=(1, 16, 64), timeout=30.0):
+    levels = []
+    for size in as_list(batch_size):
+        batches = [[{'key': uuid4().hex, 'amount': "1.00"}
+                    for _ in range(min(size, requests - start))]
+                   for start in range(0, requests, size)]
+        with PayoutDispatcher(concurrency=concurrency, max_pending=concurrency) as dispatcher:
+            with Timer() as timer:
+                if size == 1:
+                    responses = dispatcher.map(lambda _: send_third_party_deposit(timeout),
+                                               batches)
+                else:
+                    calls = dispatcher.map(lambda items: send_third_party_batch(items, timeout),
+                                           batches)
+                    # a failed call fails each of its items
+                    responses = [result
+                                 for items, response in zip(batches, calls)
+                                 for result in response.get('items') or [response] * len(items)]
+        levels.append({
+            'batch_size': size,
+            'bank_calls': len(batches),
+            'seconds': round(timer.elapsed, 3),
+            'payouts_per_second': throughput(requests, timer.elapsed),
+            'errors': sum(response.get('status') != 200 for response in responses),
+        })
+    return {'requests': requests, 'concurrency': concurrency, 'levels': levels}
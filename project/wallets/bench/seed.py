@@ -0,0 +1,97 @@
+"""
+Bulk seeding of benchmark data, see `wallet_bench --seed`.
+
+Creates `users` users with one wallet each and `transactions` transactions
+per wallet with `bulk_create`, `batch_size` rows per insert, instead of one
+`save` per row. Most transactions are completed deposits, some completed
+withdrawals, and every tenth a withdrawal pending within the next day, so
+tables, indexes and the executor see realistic sizes. The balance of every
+wallet matches its transactions and is recorded as its opening ledger
+entry, so `verify_ledger` passes. Seeded users are named `seed-*` and are
+removed again by `unseed`.
+"""
+
+import random
+from decimal import Decimal
+from uuid import uuid4
+
+from django.contrib.auth.models import User
+from django.db.transaction import atomic
+from django.utils import timezone
+
+from wallets.models import LedgerEntry, Transaction, Wallet
+
+from . import Timer, throughput
+
+PREFIX = 'seed-'
+DAY = 24 * 60 * 60
+
+
+def seed_transactions(wallet, count, now, rng):
+    """
+    Returns `count` unsaved transactions of `wallet` and its resulting balance.
+    """
+    balance = Decimal("0.00")
+    transactions = []
+    for index in range(count):
+        amount = Decimal(rng.randint(100, 10000)) / 100
+        if index % 10 == 9:
+            transactions.append(Transaction(wallet=wallet, amount=amount,
+                                            method=Transaction.Method.WITHDRAW,
+                                            scheduled_time=now + rng.randint(60, DAY)))
+            continue
+        executed_time = now - rng.randint(60, 30 * DAY)
+        if index % 5 == 4 and balance >= amount:
+            balance -= amount
+            method = Transaction.Method.WITHDRAW
+        else:
+            balance += amount
+            method = Transaction.Method.DEPOSIT
+        transactions.append(Transaction(wallet=wallet, amount=amount, method=method,
+                                        status=Transaction.Status.COMPLETED,
+                                        status_description='success',
+                                        scheduled_time=executed_time,
+                                        executed_time=executed_time))
+    return transactions, balance
+
+
+def seed(users=1000, transactions=20, batch_size=5000, random_seed=0) -> dict:
+    """
+    Seeds `users` users, wallets and `transactions` transactions per wallet,
+    and returns the counts and rows inserted per second.
+    """
+    rng = random.Random(random_seed)
+    now = int(timezone.now().timestamp())
+    tag = uuid4().hex[:8]
+    with Timer() as timer, atomic():
+        owners = User.objects.bulk_create(
+            (User(username=f'{PREFIX}{tag}-{index}', password='!') for index in range(users)),
+            batch_size=batch_size)
+        if owners and owners[0].pk is None:
+            owners = list(User.objects.filter(username__startswith=f'{PREFIX}{tag}-'))
+        wallets = [Wallet(owner=owner) for owner in owners]
+        rows = []
+        for wallet in wallets:
+            wallet_rows, wallet.balance = seed_transactions(wallet, transactions, now, rng)
+            rows += wallet_rows
+        Wallet.objects.bulk_create(wallets, batch_size=batch_size)
+        LedgerEntry.objects.bulk_create(
+            (LedgerEntry(wallet=wallet, amount=wallet.balance, kind=LedgerEntry.Kind.ADJUSTMENT)
+             for wallet in wallets if wallet.balance),
+            batch_size=batch_size)
+        Transaction.objects.bulk_create(rows, batch_size=batch_size)
+    inserted = 2 * len(wallets) + len(rows)
+    return {
+        'users': len(wallets),
+        'transactions': len(rows),
+        'seconds': round(timer.elapsed, 3),
+        'rows_per_second': throughput(inserted, timer.elapsed),
+    }
+
+
+def unseed() -> int:
+    """
+    Deletes every seeded user with its wallet and transactions, and returns
+    the number of users deleted.
+    """
+    return User.objects.filter(username__startswith=PREFIX).delete()[1].get('auth.User', 0)
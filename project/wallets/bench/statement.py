@@ -0,0 +1,46 @@
+"""
+Memory and speed of streaming a wallet statement.
+
+Seeds one wallet with each of `rows` transactions in turn and streams
+`GET /wallets/wallets/{uuid}/statement/` in `output` format, measuring rows
+per second and the peak memory allocated while streaming, which should not
+grow with the number of rows.
+"""
+
+import tracemalloc
+from decimal import Decimal
+
+from django.test import RequestFactory
+
+from wallets.models import Transaction
+from wallets.views import WalletViewSet
+
+from . import Timer, as_list, bench_wallets, scenario, throughput
+
+
+@scenario('statement')
+def statement(rows=(10000, 100000), output='csv'):
+    factory = RequestFactory(SERVER_NAME='localhost')
+    view = WalletViewSet.as_view({'get': 'statement'})
+    levels = []
+    for count in as_list(rows):
+        with bench_wallets(1) as (wallet,):
+            Transaction.objects.bulk_create(
+                (Transaction(wallet=wallet, amount=Decimal("1.00"), method="0", status="1",
+                             executed_time=1700000000 + i)
+                 for i in range(count)),
+                batch_size=5000)
+            request = factory.get(f'/wallets/wallets/{wallet.uuid}/statement/?output={output}')
+            tracemalloc.start()
+            with Timer() as timer:
+                response = view(request, uuid=str(wallet.uuid))
+                size = sum(len(part) for part in response.streaming_content)
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+        levels.append({
+            'rows': count,
+            'bytes': size,
+            'rows_per_second': throughput(count, timer.elapsed),
+            'peak_memory_kib': round(peak / 1024),
+        })
+    return {'output': output, 'levels': levels}
@@ -0,0 +1,217 @@
+"""
+Concurrency torture of the balance invariants.
+
+`processes` forked processes each run `operations` random operations on
+`wallets` shared wallets: deposits, withdrawals executed through the payout
+path against a bank that fails a share `failures` of the calls (with a 503,
+a 400 or an empty body, in turns), and transfers between the wallets.
+Withdrawals and transfers ask for more than deposits bring in, so wallets
+keep running dry and the insufficient-funds path is taken often.
+
+Every process has its own database connection, so unlike the thread-bound
+`TestCase`s the writes really interleave. The database must be shared
+between processes: a file-backed SQLite database or PostgreSQL, not an
+in-memory one.
+
+While the load runs, a monitor polls the wallets for a negative balance or
+held amount. Afterwards every wallet is checked: its balance must equal its
+opening balance plus its completed deposits and incoming transfers, minus
+its completed outgoing transfers and its completed or still processing
+withdrawals; its held amount must equal its processing withdrawals; and its
+ledger must agree with it. `run` returns the violations found, which must be
+none, with the operations per second achieved.
+"""
+
+import multiprocessing
+import random
+import threading
+from collections import Counter
+from decimal import Decimal
+from unittest import mock
+from uuid import uuid4
+
+from django.contrib.auth.models import User
+from django.db import connection, connections
+from django.db.models import Q, Sum
+from django.utils import timezone
+
+from wallets import ledger
+from wallets.models import Transaction, Wallet
+from wallets.payouts import payout_client
+
+from . import Timer, as_list, scenario, throughput
+
+ZERO = Decimal("0.00")
+
+# bank responses by failure, see `utils.RESPONSE_WEIGHT`
+FAILURES = (
+    {'data': 'failed', 'status': 503},
+    {'data': 'failed', 'status': 400},
+    {},
+)
+SUCCESS = {'data': 'success', 'status': 200}
+
+
+def operate(rng, pks) -> str:
+    """
+    Runs one random operation on the wallets `pks` and returns its name.
+    """
+    pk = rng.choice(pks)
+    amount = Decimal(rng.randint(100, 5000)) / 100
+    name = rng.choice(('deposit', 'withdraw', 'withdraw', 'transfer'))
+    if name == 'deposit':
+        Transaction.objects.create(wallet_id=pk, amount=amount,
+                                   method=Transaction.Method.DEPOSIT).execute_deposit()
+    elif name == 'withdraw':
+        Transaction.objects.create(wallet_id=pk, amount=amount * 2,
+                                   method=Transaction.Method.WITHDRAW,
+                                   scheduled_time=timezone.now().timestamp() - 1,
+                                   ).execute_withdraw()
+    else:
+        counterparty = rng.choice([other for other in pks if other != pk])
+        Transaction.objects.create(wallet_id=pk, counterparty_id=counterparty, amount=amount,
+                                   method=Transaction.Method.TRANSFER).execute_transfer()
+    return name
+
+
+def work(args) -> Counter:
+    """
+    Runs `operations` operations in a forked process and counts them by
+    name, and the errors by type.
+    """
+    index, pks, operations, failures, seed = args
+    rng = random.Random(seed * 1000 + index)
+
+    def bank(idempotency_key=None, **kwargs):
+        if rng.random() < failures:
+            return FAILURES[rng.randrange(len(FAILURES))]
+        return SUCCESS
+
+    counts = Counter()
+    # a failing bank must not open the breaker this process inherited
+    payout_client.reset()
+    try:
+        with mock.patch('wallets.models.request_third_party_deposit', bank), \
+                mock.patch.object(payout_client.breaker, 'min_calls', operations + 1):
+            for _ in range(operations):
+                try:
+                    counts[operate(rng, pks)] += 1
+                except Exception as err:
+                    counts[f'error:{type(err).__name__}'] += 1
+    finally:
+        connection.close()
+    return counts
+
+
+def monitor(pks, stopped, found) -> None:
+    """
+    Polls the wallets for a negative balance or held amount until `stopped`
+    is set, counting polls and negative sightings in `found`.
+    """
+    negative = Wallet.objects.filter(pk__in=pks).filter(Q(balance__lt=0) | Q(held__lt=0))
+    try:
+        while not stopped.wait(0.005):
+            found['polls'] += 1
+            found['negative'] += negative.exists()
+    finally:
+        connection.close()
+
+
+def expected_balances(pks, opening) -> dict:
+    """
+    Returns the balance and held amount of each wallet implied by its
+    transactions.
+    """
+    def total(**lookups):
+        return {pk: amount.quantize(ZERO) for pk, amount in Transaction.objects.filter(**lookups)
+                .order_by().values_list('wallet_id').annotate(total=Sum('amount'))}
+
+    completed = Transaction.Status.COMPLETED
+    deposits = total(wallet__in=pks, method=Transaction.Method.DEPOSIT, status=completed)
+    withdrawn = total(wallet__in=pks, method=Transaction.Method.WITHDRAW, status=completed)
+    held = total(wallet__in=pks, method=Transaction.Method.WITHDRAW,
+                 status=Transaction.Status.PROCESSING)
+    sent = total(wallet__in=pks, method=Transaction.Method.TRANSFER, status=completed)
+    received = {pk: amount.quantize(ZERO) for pk, amount in Transaction.objects.filter(
+        counterparty__in=pks, method=Transaction.Method.TRANSFER, status=completed,
+    ).order_by().values_list('counterparty_id').annotate(total=Sum('amount'))}
+    return {pk: (opening + deposits.get(pk, ZERO) + received.get(pk, ZERO)
+                 - sent.get(pk, ZERO) - withdrawn.get(pk, ZERO) - held.get(pk, ZERO),
+                 held.get(pk, ZERO))
+            for pk in pks}
+
+
+def violations(pks, opening) -> list:
+    """
+    Returns a description of every broken invariant of the wallets `pks`.
+    """
+    found = []
+    expected = expected_balances(pks, opening)
+    for wallet in Wallet.objects.with_shard_balance().filter(pk__in=pks):
+        balance, held = expected[wallet.pk]
+        if wallet.total_balance < 0 or wallet.held < 0:
+            found.append(f"{wallet.pk}: negative balance {wallet.total_balance} "
+                         f"or held {wallet.held}")
+        if wallet.total_balance != balance:
+            found.append(f"{wallet.pk}: balance {wallet.total_balance}, "
+                         f"transactions imply {balance}")
+        if wallet.held != held:
+            found.append(f"{wallet.pk}: held {wallet.held}, processing withdrawals hold {held}")
+    found += [f"{pk}: balance {balance}, ledger {ledger_balance}"
+              for pk, balance, ledger_balance in ledger.verify()
+              if pk in expected]
+    return found
+
+
+def run(processes=4, operations=500, wallets=3, opening="100.00", failures=0.2, seed=0) -> dict:
+    """
+    Runs the torture on new wallets and returns its counts, throughput and
+    the violations found. The wallets are left in place.
+    """
+    opening = Decimal(opening)
+    pks = [Wallet.objects.create(owner=User.objects.create(username=f'torture-{uuid4().hex}'),
+                                 balance=opening).pk
+           for _ in range(wallets)]
+    # forked processes must not share the connection of this one
+    connections.close_all()
+    context = multiprocessing.get_context('fork')
+    found, stopped = Counter(), threading.Event()
+    with context.Pool(processes) as pool:
+        watcher = threading.Thread(target=monitor, args=(pks, stopped, found))
+        watcher.start()
+        try:
+            with Timer() as timer:
+                results = pool.map(work, [(index, pks, operations, failures, seed)
+                                          for index in range(processes)])
+        finally:
+            stopped.set()
+            watcher.join()
+    counts = sum(results, Counter())
+    errors = {name: count for name, count in counts.items() if name.startswith('error:')}
+    done = sum(counts.values()) - sum(errors.values())
+    statuses = Counter(Transaction.objects.filter(wallet__in=pks)
+                       .values_list('status', flat=True))
+    labels = dict(Transaction.Status.choices)
+    return {
+        'processes': processes,
+        'operations': done,
+        'errors': errors,
+        'seconds': round(timer.elapsed, 3),
+        'operations_per_second': throughput(done, timer.elapsed),
+        'statuses': {str(labels[status]): count for status, count in sorted(statuses.items())},
+        'negative_sightings': found['negative'],
+        'polls': found['polls'],
+        'violations': violations(pks, opening),
+        'wallets': pks,
+    }
+
+
+@scenario('torture')
+def torture(processes=(1, 2, 4), operations=500, wallets=3, failures=0.2):
+    results = {'operations_per_process': operations, 'wallets': wallets}
+    for seed, count in enumerate(as_list(processes)):
+        result = run(count, operations, wallets, failures=failures, seed=seed)
+        pks = result.pop('wallets')
+        User.objects.filter(wallet__in=pks).delete()
+        results[f'processes_{count}'] = result
+    return results
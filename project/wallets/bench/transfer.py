@@ -0,0 +1,63 @@
+"""
+Concurrent transfers among a few hot wallets.
+
+Every thread moves `amount` between random pairs of `wallets` wallets, in
+both directions, through `Wallet.objects.transfer`. Reports transfers per
+second, transfers refused for lack of funds, errors such as deadlocks or
+lock timeouts, and checks that the total balance is conserved and that the
+ledger still matches every wallet.
+"""
+
+import random
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+
+from django.db import connection
+
+from wallets import ledger
+from wallets.models import Wallet
+
+from . import Timer, bench_wallets, scenario, throughput
+
+
+@scenario('transfer_contention')
+def transfer_contention(threads=8, transfers=200, wallets=4, balance="100.00", amount="1.00"):
+    amount = Decimal(amount)
+
+    def worker(seed):
+        rng = random.Random(seed)
+        moved = refused = errors = 0
+        try:
+            for _ in range(transfers):
+                source, target = rng.sample(ids, 2)
+                try:
+                    if Wallet.objects.transfer(source, target, amount):
+                        moved += 1
+                    else:
+                        refused += 1
+                except Exception:
+                    errors += 1
+        finally:
+            connection.close()
+        return moved, refused, errors
+
+    with bench_wallets(wallets, balance) as created:
+        ids = [wallet.pk for wallet in created]
+        with Timer() as timer, ThreadPoolExecutor(max_workers=threads) as pool:
+            counts = list(pool.map(worker, range(threads)))
+        balances = Wallet.objects.filter(pk__in=ids).values_list('balance', flat=True)
+        total = sum(balances, Decimal("0.00"))
+        mismatches = [wallet_id for wallet_id, *_ in ledger.verify() if wallet_id in ids]
+    moved, refused, errors = (sum(column) for column in zip(*counts))
+    return {
+        'threads': threads,
+        'wallets': wallets,
+        'transfers': threads * transfers,
+        'seconds': round(timer.elapsed, 3),
+        'transfers_per_second': throughput(moved, timer.elapsed),
+        'moved': moved,
+        'refused': refused,
+        'errors': errors,
+        'balance_conserved': total == Decimal(balance) * wallets,
+        'ledger_mismatches': len(mismatches),
+    }
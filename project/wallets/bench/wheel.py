@@ -0,0 +1,54 @@
+"""
+Startup and idle cost of the timing wheel.
+
+For every count in `far`, schedules that many withdrawals days ahead plus
+`near` withdrawals within the next `window` seconds, then measures how long
+the first load of a `TimingWheel` takes and how many withdrawals it keeps in
+memory, and the cost of one idle poll of the table versus one idle fetch of
+the wheel, averaged over `polls`.
+"""
+
+from decimal import Decimal
+
+from django.utils import timezone
+
+from wallets.models import Transaction
+from wallets.scheduler import TimingWheel
+
+from . import Timer, as_list, bench_wallets, scenario
+
+
+def schedule(wallet, count, start, spread):
+    Transaction.objects.bulk_create(
+        (Transaction(wallet=wallet, amount=Decimal("1.00"),
+                     method=Transaction.Method.WITHDRAW,
+                     scheduled_time=start + i % spread)
+         for i in range(count)),
+        batch_size=5000)
+
+
+@scenario('timing_wheel')
+def timing_wheel(far=(0, 100000), near=1000, window=300, polls=200):
+    results = {'near': near, 'window': window}
+    for count in as_list(far):
+        with bench_wallets() as (wallet,):
+            now = int(timezone.now().timestamp())
+            schedule(wallet, count, now + 86400, 30 * 86400)
+            schedule(wallet, near, now + 60, window - 60)
+            wheel = TimingWheel(tick=1.0, window=window, refresh=5)
+            with Timer() as load:
+                wheel.load(now)
+            with Timer() as polled:
+                for _ in range(polls):
+                    list(Transaction.objects.due_withdrawals(now)[:100])
+            wheel.fetch(100, now=now)
+            with Timer() as fetched:
+                for _ in range(polls):
+                    wheel.fetch(100, now=now)
+        results[f'far_{count}'] = {
+            'load_ms': round(load.elapsed * 1000, 2),
+            'loaded': len(wheel),
+            'poll_ms': round(polled.elapsed * 1000 / polls, 3),
+            'wheel_fetch_ms': round(fetched.elapsed * 1000 / polls, 3),
+        }
+    return results
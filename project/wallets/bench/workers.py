@@ -0,0 +1,69 @@
+"""
+Withdrawal executors sharing the table through leases.
+
+For every count in `workers`, schedules `withdrawals` due withdrawals and
+runs that many `WithdrawalExecutor`s at once, each with its own `Leases`,
+until nothing is left. The bank is replaced by a stub answering after
+`delay` seconds, so the run measures claiming and execution. Reports
+withdrawals per second, how many completed, and how many were paid out more
+than once, which must be none.
+"""
+
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+from unittest import mock
+
+from django.db import connection
+from django.utils import timezone
+
+from wallets.models import Transaction
+from wallets.payouts import payout_client
+from wallets.scheduler import Leases, WithdrawalExecutor
+
+from . import Timer, as_list, bench_wallets, scenario, throughput
+
+
+@scenario('lease_workers')
+def lease_workers(withdrawals=400, workers=(1, 2, 4, 8), delay=0.02, batch_size=10):
+    results = {'withdrawals': withdrawals, 'delay': delay}
+    for count in as_list(workers):
+        calls = Counter()
+        lock = threading.Lock()
+
+        def bank(idempotency_key=None, **kwargs):
+            time.sleep(delay)
+            with lock:
+                calls[idempotency_key] += 1
+            return {'data': 'success', 'status': 200}
+
+        def work(executor):
+            try:
+                while executor.run_once():
+                    pass
+            finally:
+                connection.close()
+
+        payout_client.reset()
+        with bench_wallets(balance=withdrawals) as (wallet,):
+            Transaction.objects.bulk_create(
+                Transaction(wallet=wallet, amount=Decimal("1.00"),
+                            method=Transaction.Method.WITHDRAW,
+                            scheduled_time=timezone.now().timestamp() - 1)
+                for _ in range(withdrawals))
+            executors = [WithdrawalExecutor(batch_size=batch_size, leases=Leases())
+                         for _ in range(count)]
+            with mock.patch('wallets.models.request_third_party_deposit', bank), \
+                    Timer() as timer, ThreadPoolExecutor(max_workers=count) as pool:
+                list(pool.map(work, executors))
+            completed = Transaction.objects.filter(
+                wallet=wallet, status=Transaction.Status.COMPLETED).count()
+        results[f'workers_{count}'] = {
+            'seconds': round(timer.elapsed, 3),
+            'withdrawals_per_second': throughput(completed, timer.elapsed),
+            'completed': completed,
+            'paid_twice': sum(1 for paid in calls.values() if paid > 1),
+        }
+    return results
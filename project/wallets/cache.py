@@ -0,0 +1,185 @@
+"""
+This module contains the caches of the service.
+
+`TTLCache` is a small in-process LRU cache whose entries expire.
+`WalletCache` is the read-through cache of wallet details served by
+`GET /wallets/wallets/{uuid}/`, stored in a Django cache backend shared by
+every process, or in a `TTLCache`, see `settings.WALLET_CACHE`.
+
+Every cached wallet is stored with the version token of the wallet at the
+time it was read, and is only served while that token is still current.
+Balance mutations replace the token both when they run and when their
+database transaction commits, so a reader that loaded the wallet just before
+a write committed stores an entry that is already stale and never served.
+Tokens expire with the entries they guard; a missing token only costs a miss.
+
+Withdrawals settle and release in the `run_withdrawals` process, and every
+web worker is a process of its own, so the tokens are only replaced for all
+of them when the store is shared, such as memcached. With a `TTLCache` or a
+locmem Django cache, the default, a web worker serves a balance changed by
+another process for up to `ttl` seconds.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+from uuid import uuid4
+
+from django.conf import settings
+from django.core.cache import CacheHandler, caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.signals import setting_changed
+from django.db.transaction import on_commit
+from django.dispatch import receiver
+
+
+class TTLCache:
+    """
+    A thread-safe in-process LRU cache whose entries expire `ttl` seconds
+    after they were set.
+
+    Attributes:
+        maxsize (int): The number of entries kept before the least recently
+            used one is evicted.
+        ttl (float): Seconds an entry stays valid.
+        hits (int): The number of lookups answered from the cache.
+        misses (int): The number of lookups that were not.
+    """
+
+    def __init__(self, maxsize, ttl, timer=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._timer = timer
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] <= self._timer():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value) -> None:
+        with self._lock:
+            self._entries[key] = (self._timer() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def delete(self, key) -> None:
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class WalletCache:
+    """
+    A read-through cache of wallet details with exact invalidation.
+
+    Attributes:
+        backend: The store entries are kept in, a `TTLCache` or a Django cache.
+        hits (int): The number of lookups answered from the cache.
+        misses (int): The number of lookups that read the database.
+    """
+
+    def __init__(self, backend, ttl=None):
+        self.backend = backend
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    @property
+    def shared(self) -> bool:
+        """
+        Whether other processes see the entries and invalidations of this one.
+        """
+        return not isinstance(self.backend, (TTLCache, LocMemCache))
+
+    def _set(self, key, value, timeout) -> None:
+        if isinstance(self.backend, TTLCache):
+            self.backend.set(key, value)
+        else:
+            self.backend.set(key, value, timeout)
+
+    def _count(self, hit) -> None:
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def get(self, pk, load):
+        """
+        Returns the cached details of wallet `pk`, or the result of
+        `load(pk)`, which is cached unless it is None.
+        """
+        entry_key, version_key = f'wallet:{pk}', f'wallet-version:{pk}'
+        version = self.backend.get(version_key)
+        if version is None:
+            version = uuid4().hex
+            # an expired or evicted version only costs a miss
+            self._set(version_key, version, self.ttl)
+        else:
+            entry = self.backend.get(entry_key)
+            if entry is not None and entry[0] == version:
+                self._count(hit=True)
+                return entry[1]
+        self._count(hit=False)
+        value = load(pk)
+        if value is not None:
+            self._set(entry_key, (version, value), self.ttl)
+        return value
+
+    def invalidate(self, pk) -> None:
+        """
+        Makes the cached details of wallet `pk` stale, now and once the
+        current database transaction commits.
+        """
+        self._set(f'wallet-version:{pk}', uuid4().hex, self.ttl)
+        on_commit(lambda: self._set(f'wallet-version:{pk}', uuid4().hex, self.ttl))
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+            }
+
+
+def build_wallet_cache(handler=caches) -> WalletCache:
+    config = settings.WALLET_CACHE
+    if config['BACKEND'] == 'lru':
+        # entry and version per wallet
+        backend = TTLCache(maxsize=2 * config['SIZE'], ttl=config['TTL'])
+    else:
+        backend = handler[config['BACKEND']]
+    return WalletCache(backend, ttl=config['TTL'])
+
+
+wallet_cache = build_wallet_cache()
+
+
+@receiver(setting_changed)
+def rebuild_wallet_cache(setting, **kwargs):
+    # `override_settings` of the cache settings also moves `wallet_cache`; a new handler, as
+    # `caches` may not have seen the new CACHES yet
+    if setting in ('WALLET_CACHE', 'CACHES'):
+        rebuilt = build_wallet_cache(CacheHandler())
+        wallet_cache.backend, wallet_cache.ttl = rebuilt.backend, rebuilt.ttl
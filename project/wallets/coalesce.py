@@ -0,0 +1,153 @@
+"""
+This module contains the `DepositCoalescer`, an opt-in write-behind stage for
+deposits created through the API, see `settings.DEPOSIT_COALESCING`.
+
+Executing a deposit on its own commits a balance UPDATE with its ledger entry
+and then an UPDATE of the transaction. The coalescer instead collects the
+deposits submitted by concurrent requests for up to `max_delay` seconds or
+`max_items` deposits and applies them in a single database transaction: one
+balance UPDATE per wallet, the ledger entries of every deposit, linked to
+their transactions, like a bulk create, and one `bulk_update` of the
+transactions.
+
+Durability is unchanged. A request inserts its transaction row before
+submitting it and waits on a future that only completes once the batch has
+committed, so the API still answers after the deposit is stored. A batch
+that fails marks its transactions failed, in a database transaction of its
+own, and fails every request in it.
+
+A request already inside a database transaction, such as one carrying an
+`Idempotency-Key`, executes its deposit directly: its transaction row is not
+visible to the coalescer until it commits.
+"""
+
+import logging
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import Future
+
+from django.conf import settings
+from django.db import close_old_connections, connection
+from django.db.transaction import atomic
+from django.utils import timezone
+
+from .models import Transaction, Wallet
+
+logger = logging.getLogger(__name__)
+
+
+class DepositCoalescer:
+    """
+    Applies the deposits submitted by concurrent threads in batches, on a
+    background thread started by the first submit.
+
+    Attributes:
+        max_delay (float): Seconds the first deposit of a batch waits for
+            others to join it.
+        max_items (int): The number of deposits that flush a batch at once.
+    """
+
+    def __init__(self, max_delay=None, max_items=None):
+        config = settings.DEPOSIT_COALESCING
+        self.max_delay = config['MAX_DELAY'] if max_delay is None else max_delay
+        self.max_items = max_items or config['MAX_ITEMS']
+        self._pending = []
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def submit(self, transaction) -> Future:
+        """
+        Queues a saved pending deposit and returns a future completing with
+        the transaction once its batch has committed.
+        """
+        future = Future()
+        with self._cond:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='deposit-coalescer',
+                                                daemon=True)
+                self._thread.start()
+            self._pending.append((transaction, future))
+            self._cond.notify()
+        return future
+
+    def execute(self, transaction) -> None:
+        """
+        Executes a saved pending deposit, batched with concurrent ones unless
+        the caller is inside a database transaction.
+        """
+        if connection.in_atomic_block:
+            transaction.execute_deposit()
+        else:
+            self.submit(transaction).result()
+
+    def _next_batch(self) -> list:
+        with self._cond:
+            while not self._pending:
+                self._cond.wait()
+            deadline = time.monotonic() + self.max_delay
+            while len(self._pending) < self.max_items:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            batch = self._pending[:self.max_items]
+            del self._pending[:self.max_items]
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            try:
+                self.apply([transaction for transaction, _ in batch])
+            except Exception as err:
+                self.fail([transaction for transaction, _ in batch], err)
+                for _, future in batch:
+                    future.set_exception(err)
+            else:
+                for transaction, future in batch:
+                    future.set_result(transaction)
+            finally:
+                close_old_connections()
+
+    @staticmethod
+    def apply(transactions) -> None:
+        """
+        Executes pending deposits in one database transaction, crediting
+        each wallet once, in `uuid` order.
+        """
+        deposits = defaultdict(list)
+        for transaction in transactions:
+            deposits[transaction.wallet_id].append(transaction)
+        now = timezone.now().timestamp()
+        with atomic():
+            credited = {wallet_id for wallet_id in sorted(deposits)
+                        if Wallet.objects.credit_all(wallet_id, deposits[wallet_id])}
+            for transaction in transactions:
+                done = transaction.wallet_id in credited
+                transaction.status = (Transaction.Status.COMPLETED if done
+                                      else Transaction.Status.FAILED)
+                transaction.status_description = ("deposited successfully" if done
+                                                  else "Wallet does not exist.")
+                transaction.executed_time = now
+            Transaction.objects.bulk_update(
+                transactions, ['status', 'status_description', 'executed_time'])
+
+    @staticmethod
+    def fail(transactions, err) -> None:
+        """
+        Marks the deposits of a failed batch that are still pending as
+        failed, so none is left pending without a request waiting on it.
+        """
+        try:
+            Transaction.objects.filter(
+                pk__in=[transaction.pk for transaction in transactions],
+                status=Transaction.Status.PENDING,
+            ).update(status=Transaction.Status.FAILED,
+                     status_description=f"Deposit failed: {err}",
+                     executed_time=timezone.now().timestamp())
+        except Exception:
+            logger.exception("Marking %s failed deposits failed", len(transactions))
+
+
+deposit_coalescer = DepositCoalescer()
@@ -0,0 +1,78 @@
+"""
+This module contains the `PayoutDispatcher`, a bounded worker pool for calls
+to the third party service.
+
+A payout spends nearly all of its time waiting on the bank, so running them
+one after the other caps throughput at one payout per bank round trip. The
+dispatcher keeps up to `concurrency` payouts in flight on a thread pool. At
+most `max_pending` further payouts may wait for a free worker; once that queue
+is full `submit` blocks the caller, which keeps a producer such as the
+withdrawal executor from loading more work than the bank can absorb.
+
+Per-call timeouts are enforced by the bank client itself
+(`settings.THIRD_PARTY['READ_TIMEOUT']`), so a stuck call frees its worker instead
+of pinning it.
+"""
+
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from django.conf import settings
+from django.db import close_old_connections
+
+
+class PayoutDispatcher:
+    """
+    Runs callables on a bounded thread pool with backpressure.
+
+    Attributes:
+        concurrency (int): The number of calls allowed in flight at once.
+        max_pending (int): The number of calls allowed to wait for a worker.
+    """
+
+    def __init__(self, concurrency=None, max_pending=None):
+        config = settings.PAYOUT_DISPATCHER
+        self.concurrency = concurrency or config['CONCURRENCY']
+        self.max_pending = config['MAX_PENDING'] if max_pending is None else max_pending
+        self._slots = threading.BoundedSemaphore(self.concurrency + self.max_pending)
+        self._pool = ThreadPoolExecutor(max_workers=self.concurrency,
+                                        thread_name_prefix='payout')
+
+    def submit(self, fn, *args, **kwargs):
+        """
+        Schedules `fn(*args, **kwargs)` and returns its future, blocking
+        while the pool is saturated.
+        """
+        self._slots.acquire()
+        try:
+            future = self._pool.submit(self._run, fn, *args, **kwargs)
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        return future
+
+    def map(self, fn, items) -> list:
+        """
+        Calls `fn(item)` for every item and returns the results in order.
+        """
+        futures = [self.submit(fn, item) for item in items]
+        wait(futures)
+        return [future.result() for future in futures]
+
+    def shutdown(self, wait=True) -> None:
+        self._pool.shutdown(wait=wait)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+
+    @staticmethod
+    def _run(fn, *args, **kwargs):
+        # worker threads hold their own database connections
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            close_old_connections()
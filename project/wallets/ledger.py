@@ -0,0 +1,150 @@
+"""
+This module computes wallet balances from the ledger.
+
+The balance of a wallet according to its ledger is its latest
+`BalanceSnapshot` plus the `LedgerEntry` rows after the snapshot, so the
+cost of a lookup is bounded by the entries since the last snapshot instead
+of the whole history. Wallets are processed in chunks of `chunk_size`, read
+by keyset on `uuid`, so memory stays bounded however many wallets exist.
+
+Every snapshot of one `take_snapshots` run covers the entries up to the same
+id, which keeps the number of distinct snapshot boundaries, and therefore
+the number of aggregate queries per chunk, small. Entries younger than
+`SNAPSHOT_LAG` seconds are left for the next run, so an entry whose id was
+allocated before but committed after the run can not be skipped.
+"""
+
+from collections import defaultdict
+from datetime import timedelta
+from decimal import Decimal
+
+from django.conf import settings
+from django.db.models import Max, Sum
+from django.db.transaction import atomic
+from django.utils import timezone
+
+from .models import BalanceSnapshot, LedgerEntry, Wallet
+
+ZERO = Decimal("0.00")
+
+
+def wallet_chunks(chunk_size=None):
+    """
+    Yields lists of `(uuid, balance)` of all wallets, `chunk_size` at a time.
+    The balance of a sharded wallet includes its shards.
+    """
+    chunk_size = chunk_size or settings.LEDGER['CHUNK_SIZE']
+    queryset = (Wallet.objects.with_shard_balance().order_by('uuid')
+                .values_list('uuid', 'balance', 'shard_balance'))
+    last = None
+    while True:
+        page = queryset if last is None else queryset.filter(uuid__gt=last)
+        chunk = [(uuid, balance + shard_balance) for uuid, balance, shard_balance
+                 in page[:chunk_size]]
+        if not chunk:
+            return
+        yield chunk
+        last = chunk[-1][0]
+
+
+def latest_snapshots(wallet_ids, before=None) -> dict:
+    """
+    Returns `(balance, last_entry_id)` of the latest snapshot of each wallet
+    that has one, optionally only considering snapshots taken before `before`.
+    """
+    snapshots = BalanceSnapshot.objects.filter(wallet_id__in=wallet_ids)
+    if before is not None:
+        snapshots = snapshots.filter(created_at__lte=before)
+    latest = snapshots.values('wallet_id').annotate(latest=Max('id')).values('latest')
+    rows = BalanceSnapshot.objects.filter(id__in=latest).values_list(
+        'wallet_id', 'balance', 'last_entry_id')
+    return {wallet_id: (balance, last_entry_id) for wallet_id, balance, last_entry_id in rows}
+
+
+def ledger_deltas(wallet_ids, upto=None, before=None) -> (dict, dict):
+    """
+    Returns the snapshot balance of each wallet and the sum of its entries
+    after the snapshot, up to entry id `upto` and creation time `before`.
+    Wallets without new entries are missing from the second dict.
+    """
+    snapshots = latest_snapshots(wallet_ids, before)
+    bases = {}
+    boundaries = defaultdict(list)
+    for wallet_id in wallet_ids:
+        balance, last_entry_id = snapshots.get(wallet_id, (ZERO, 0))
+        bases[wallet_id] = balance
+        boundaries[last_entry_id].append(wallet_id)
+    deltas = {}
+    for last_entry_id, ids in boundaries.items():
+        entries = LedgerEntry.objects.filter(wallet_id__in=ids, id__gt=last_entry_id)
+        if upto is not None:
+            entries = entries.filter(id__lte=upto)
+        if before is not None:
+            entries = entries.filter(created_at__lte=before)
+        # SQLite sums decimals as floats, round them back to cents
+        deltas.update((wallet_id, total.quantize(ZERO)) for wallet_id, total
+                      in entries.order_by().values('wallet_id')
+                      .annotate(total=Sum('amount'))
+                      .values_list('wallet_id', 'total'))
+    return bases, deltas
+
+
+def ledger_balances(wallet_ids) -> dict:
+    """
+    Returns the current balance of each wallet according to its ledger.
+    """
+    bases, deltas = ledger_deltas(wallet_ids)
+    return {wallet_id: bases[wallet_id] + deltas.get(wallet_id, ZERO)
+            for wallet_id in wallet_ids}
+
+
+def balance_at(wallet_id, when) -> Decimal:
+    """
+    Returns the balance of a wallet at the datetime `when`.
+    """
+    bases, deltas = ledger_deltas([wallet_id], before=when)
+    return bases[wallet_id] + deltas.get(wallet_id, ZERO)
+
+
+def take_snapshots(chunk_size=None, lag=None) -> int:
+    """
+    Snapshots every wallet with ledger entries since its last snapshot and
+    returns the number of snapshots taken.
+    """
+    lag = settings.LEDGER['SNAPSHOT_LAG'] if lag is None else lag
+    cutoff = timezone.now() - timedelta(seconds=lag)
+    upto = LedgerEntry.objects.filter(created_at__lte=cutoff).aggregate(upto=Max('id'))['upto']
+    if upto is None:
+        return 0
+    taken = 0
+    for chunk in wallet_chunks(chunk_size):
+        bases, deltas = ledger_deltas([wallet_id for wallet_id, _ in chunk], upto=upto)
+        BalanceSnapshot.objects.bulk_create(
+            BalanceSnapshot(wallet_id=wallet_id,
+                            balance=bases[wallet_id] + delta,
+                            last_entry_id=upto)
+            for wallet_id, delta in deltas.items())
+        taken += len(deltas)
+    return taken
+
+
+def verify(chunk_size=None):
+    """
+    Compares the balance of every wallet with its ledger and yields
+    `(uuid, balance, ledger_balance)` for each wallet that differs.
+
+    A wallet that differs is checked once more inside a transaction, so a
+    write landing between the two reads of a chunk is not reported.
+    """
+    for chunk in wallet_chunks(chunk_size):
+        expected = ledger_balances([wallet_id for wallet_id, _ in chunk])
+        for wallet_id, balance in chunk:
+            if balance == expected[wallet_id]:
+                continue
+            with atomic():
+                wallet = Wallet.objects.select_for_update().only(
+                    'balance', 'shard_count').get(pk=wallet_id)
+                balance = wallet.total_balance
+                ledger_balance = ledger_balances([wallet_id])[wallet_id]
+            if balance != ledger_balance:
+                yield wallet_id, balance, ledger_balance
@@ -0,0 +1,81 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from wallets import metrics
+from wallets.cache import wallet_cache
+from wallets.dispatch import PayoutDispatcher
+from wallets.payouts import payout_client
+from wallets.scheduler import Leases, TimingWheel, WithdrawalExecutor, build_wheel
+from utils import bank_client
+
+
+class Command(BaseCommand):
+    help = ("Runs the withdrawal executor, which executes due withdrawals in batches. "
+            "Any number of executors may run at once.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int,
+                            help="Maximum number of withdrawals fetched per poll.")
+        parser.add_argument('--interval', type=float,
+                            help="Seconds to sleep when no withdrawal is due.")
+        parser.add_argument('--concurrency', type=int,
+                            help="Number of payouts kept in flight at once.")
+        parser.add_argument('--payout-batch-size', type=int,
+                            help="Withdrawals paid out per bank call, 0 for one call each.")
+        parser.add_argument('--wheel-window', type=float,
+                            help="Seconds of upcoming withdrawals kept in a timing wheel, "
+                                 "0 to poll the table.")
+        parser.add_argument('--once', action='store_true',
+                            help="Execute a single batch and exit.")
+        parser.add_argument('--metrics-port', type=int,
+                            help="Port to serve the metrics of the executor on, "
+                                 "at /metrics in the Prometheus format.")
+
+    def handle(self, *args, **options):
+        if not wallet_cache.shared:
+            # settled and released withdrawals only reach the caches of the web workers on expiry
+            self.stderr.write(f"WALLET_CACHE['BACKEND'] is not shared between processes: web "
+                              f"workers may serve balances changed by withdrawals for up to "
+                              f"{wallet_cache.ttl} seconds. Use a shared cache such as memcached.")
+        if options['metrics_port'] is not None and not metrics.registry.enabled:
+            raise CommandError("Set METRICS['ENABLED'] to serve metrics.")
+        dispatcher = PayoutDispatcher(concurrency=options['concurrency'])
+        # one open connection per payout in flight
+        bank_client.resize(max(settings.THIRD_PARTY['POOL_SIZE'] or 0, dispatcher.concurrency))
+        if options['wheel_window'] is None:
+            wheel = build_wheel()
+        elif options['wheel_window']:
+            config = settings.WITHDRAWAL_EXECUTOR
+            wheel = TimingWheel(tick=config['WHEEL_TICK'], window=options['wheel_window'],
+                                refresh=config['WHEEL_REFRESH'])
+        else:
+            wheel = None
+        executor = WithdrawalExecutor(batch_size=options['batch_size'],
+                                      poll_interval=options['interval'],
+                                      dispatcher=dispatcher,
+                                      payout_batch_size=options['payout_batch_size'],
+                                      wheel=wheel,
+                                      leases=Leases())
+        server = None
+        if options['metrics_port'] is not None:
+            server = metrics.serve(options['metrics_port'])
+            self.stdout.write(f"Serving metrics on port {server.server_port}.")
+        try:
+            self.run_executor(executor, dispatcher, options['once'])
+        finally:
+            if server is not None:
+                server.shutdown()
+                server.server_close()
+
+    def run_executor(self, executor, dispatcher, once):
+        with dispatcher:
+            if once:
+                executed = executor.run_once()
+                self.stdout.write(f"Executed {executed} withdrawals.")
+                self.stdout.write(f"Payouts: {payout_client.metrics()}")
+                return
+            self.stdout.write("Starting withdrawal executor...")
+            try:
+                executor.run_forever()
+            except KeyboardInterrupt:
+                executor.stop()
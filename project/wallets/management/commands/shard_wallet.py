@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from wallets.models import Wallet
+
+
+class Command(BaseCommand):
+    help = "Spreads the deposits of a hot wallet over balance shards."
+
+    def add_arguments(self, parser):
+        parser.add_argument('wallet', help="UUID of the wallet.")
+        parser.add_argument('shards', type=int,
+                            help="Number of shards, 0 to keep the balance on the wallet row.")
+
+    def handle(self, *args, **options):
+        if options['shards'] < 0:
+            raise CommandError("The number of shards can not be negative.")
+        try:
+            exists = Wallet.objects.set_shards(options['wallet'], options['shards'])
+        except ValueError as err:
+            raise CommandError(f"{err}, set BALANCE_SHARDS['ENABLED'] first.")
+        if not exists:
+            raise CommandError(f"Wallet {options['wallet']} does not exist.")
+        self.stdout.write(f"Wallet {options['wallet']} has {options['shards']} shards.")
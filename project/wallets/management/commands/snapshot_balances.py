@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from wallets.ledger import take_snapshots
+
+
+class Command(BaseCommand):
+    help = "Snapshots the ledger balance of every wallet with new ledger entries."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int,
+                            help="Number of wallets processed per chunk.")
+        parser.add_argument('--lag', type=float,
+                            help="Seconds an entry must be old to be covered.")
+
+    def handle(self, *args, **options):
+        taken = take_snapshots(chunk_size=options['chunk_size'], lag=options['lag'])
+        self.stdout.write(f"Took {taken} snapshots.")
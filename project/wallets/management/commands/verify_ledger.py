@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from wallets.ledger import verify
+
+
+class Command(BaseCommand):
+    help = "Verifies the balance of every wallet against its ledger."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int,
+                            help="Number of wallets processed per chunk.")
+
+    def handle(self, *args, **options):
+        mismatches = 0
+        for wallet_id, balance, ledger_balance in verify(chunk_size=options['chunk_size']):
+            mismatches += 1
+            self.stdout.write(f"{wallet_id}: balance {balance}, ledger {ledger_balance}")
+        if mismatches:
+            raise CommandError(f"{mismatches} wallets do not match their ledger.")
+        self.stdout.write("All wallets match their ledger.")
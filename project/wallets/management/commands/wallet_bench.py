@@ -0,0 +1,120 @@
+import inspect
+import json
+import platform
+
+import django
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.utils import timezone
+
+from wallets.bench import SCENARIOS, seed
+
+
+def parse_value(value):
+    """
+    Parses an option value: comma separated values become a list, numbers
+    become int or float, anything else stays a string.
+    """
+    if ',' in value:
+        return [parse_value(item) for item in value.split(',') if item]
+    try:
+        return json.loads(value)
+    except ValueError:
+        return value
+
+
+def numbers(results, prefix='') -> dict:
+    """
+    Returns the numeric values of nested `results` by their dotted path.
+    """
+    found = {}
+    for key, value in results.items():
+        path = f'{prefix}{key}'
+        if isinstance(value, dict):
+            found.update(numbers(value, f'{path}.'))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            found[path] = value
+    return found
+
+
+def compare(baseline, current) -> dict:
+    """
+    Returns the change of every number of `current` that `baseline` has too.
+    """
+    before = numbers(baseline)
+    changes = {}
+    for path, value in numbers(current).items():
+        if path not in before:
+            continue
+        change = {'baseline': before[path], 'current': value}
+        if before[path]:
+            change['change_pct'] = round((value - before[path]) / abs(before[path]) * 100, 1)
+        changes[path] = change
+    return changes
+
+
+class Command(BaseCommand):
+    help = ("Seeds benchmark data, runs benchmark scenarios and prints their results as "
+            "JSON.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('scenarios', nargs='*',
+                            help="Scenarios to run, all of them when omitted.")
+        parser.add_argument('-o', '--option', action='append', default=[],
+                            metavar='KEY=VALUE',
+                            help="Scenario option, e.g. -o concurrency=1,4,16.")
+        parser.add_argument('--list', action='store_true',
+                            help="List the available scenarios and exit.")
+        parser.add_argument('--seed', type=int, default=0, metavar='USERS',
+                            help="Seed this many users with a wallet each before running.")
+        parser.add_argument('--seed-transactions', type=int, default=20, metavar='COUNT',
+                            help="Transactions seeded per wallet.")
+        parser.add_argument('--unseed', action='store_true',
+                            help="Delete the seeded users, wallets and transactions.")
+        parser.add_argument('--output', metavar='FILE',
+                            help="Also write the results to this file.")
+        parser.add_argument('--baseline', metavar='FILE',
+                            help="Results of an earlier run to report the changes against.")
+
+    def handle(self, *args, **options):
+        if options['list']:
+            self.stdout.write("\n".join(sorted(SCENARIOS)))
+            return
+        seeding = options['seed'] or options['unseed']
+        # seeding alone runs no scenarios
+        names = options['scenarios'] or ([] if seeding else sorted(SCENARIOS))
+        unknown = set(names) - set(SCENARIOS)
+        if unknown:
+            raise CommandError(f"Unknown scenarios: {', '.join(sorted(unknown))}")
+        kwargs = {}
+        for option in options['option']:
+            key, sep, value = option.partition('=')
+            if not sep:
+                raise CommandError(f"Options must look like KEY=VALUE, got {option!r}")
+            kwargs[key] = parse_value(value)
+        results = {'meta': {
+            'started': timezone.now().isoformat(),
+            'database': connection.vendor,
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'options': kwargs,
+        }}
+        if options['unseed']:
+            results['unseeded'] = seed.unseed()
+        if options['seed']:
+            results['seed'] = seed.seed(options['seed'], options['seed_transactions'])
+        results['scenarios'] = {}
+        for name in names:
+            func = SCENARIOS[name]
+            accepted = inspect.signature(func).parameters
+            results['scenarios'][name] = func(**{key: value for key, value in kwargs.items()
+                                                 if key in accepted})
+        if options['baseline']:
+            with open(options['baseline']) as baseline:
+                results['changes'] = compare(json.load(baseline).get('scenarios', {}),
+                                             results['scenarios'])
+        output = json.dumps(results, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as file:
+                file.write(output + '\n')
+        self.stdout.write(output)
@@ -0,0 +1,310 @@
+"""
+This module collects the performance metrics of the service and serves them
+on `GET /metrics` in the Prometheus text format.
+
+`metrics_middleware` records the latency and the number of ORM queries of
+every request, by method, view and status. The payout client records the
+latency of every bank call and the outcomes of payouts, and the withdrawal
+executor records the lag of every withdrawal it finishes, the seconds
+between its `scheduled_time` and its `executed_time`.
+
+Metrics are off unless `settings.METRICS['ENABLED']` is set. Then the
+middleware removes itself from the stack, queries are not wrapped, every
+`observe` and `inc` returns at once and `/metrics` answers 404, so scraping
+being off costs next to nothing. Values are kept per process, like the
+counters of `payout_client`.
+
+Bank calls, payouts and withdrawal lag are recorded in the process of
+`run_withdrawals`, which answers no HTTP requests. `serve` exposes them on a
+port of their own, see `run_withdrawals --metrics-port`.
+"""
+
+import asyncio
+import contextvars
+import threading
+import time
+from abc import ABC, abstractmethod
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connection
+from django.db.backends.signals import connection_created
+from django.http import Http404, HttpResponse
+from django.utils.decorators import sync_and_async_middleware
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+QUERY_BUCKETS = (1, 2, 3, 5, 10, 20, 50, 100)
+LAG_BUCKETS = (0.5, 1, 2.5, 5, 10, 30, 60, 300, 900, 3600)
+
+
+def format_value(value) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def format_labels(names, values) -> str:
+    if not names:
+        return ''
+    pairs = ','.join('{}="{}"'.format(
+        name, str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n'))
+        for name, value in zip(names, values))
+    return '{' + pairs + '}'
+
+
+class Metric(ABC):
+    """
+    A family of values of one metric, one per combination of label values.
+
+    Attributes:
+        registry (Registry): The registry the metric belongs to.
+        name (str): The name of the metric.
+        help (str): The description of the metric.
+        labels (tuple): The names of its labels.
+    """
+    kind = None
+
+    def __init__(self, registry, name, help, labels=()):
+        self.registry = registry
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def clear(self) -> None:
+        with self._lock:
+            self._values.clear()
+
+    def render(self) -> list:
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}']
+        with self._lock:
+            values = sorted(self._values.items())
+            lines += self.samples(values)
+        return lines
+
+    @abstractmethod
+    def samples(self, values) -> list:
+        """
+        Returns the sample lines of `values`, sorted `(labels, value)` pairs.
+        """
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, *labels, value=1) -> None:
+        if not self.registry.enabled:
+            return
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + value
+
+    def value(self, *labels):
+        return self._values.get(labels, 0)
+
+    def samples(self, values) -> list:
+        return [f'{self.name}_total{format_labels(self.labels, labels)} {format_value(value)}'
+                for labels, value in values]
+
+
+class Histogram(Metric):
+    """
+    Counts observations in buckets of upper bounds `buckets`.
+    """
+    kind = 'histogram'
+
+    def __init__(self, registry, name, help, labels=(), buckets=None):
+        super().__init__(registry, name, help, labels)
+        self.buckets = tuple(sorted(buckets or settings.METRICS['BUCKETS']))
+
+    def observe(self, value, *labels) -> None:
+        if not self.registry.enabled:
+            return
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(labels)
+            if entry is None:
+                # per bucket counts, with a last one for +Inf, then the sum
+                entry = self._values[labels] = [[0] * (len(self.buckets) + 1), 0]
+            entry[0][index] += 1
+            entry[1] += value
+
+    def count(self, *labels) -> int:
+        entry = self._values.get(labels)
+        return sum(entry[0]) if entry else 0
+
+    def samples(self, values) -> list:
+        lines = []
+        names = self.labels + ('le',)
+        for labels, (counts, total) in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                bucket = format_labels(names, labels + (format_value(bound),))
+                lines.append(f'{self.name}_bucket{bucket} {cumulative}')
+            suffix = format_labels(self.labels, labels)
+            lines.append(f'{self.name}_sum{suffix} {format_value(total)}')
+            lines.append(f'{self.name}_count{suffix} {cumulative}')
+        return lines
+
+
+class Registry:
+    """
+    The metrics of the process.
+
+    Attributes:
+        enabled (bool): Whether values are recorded and served.
+    """
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self._metrics = []
+
+    def counter(self, name, help, labels=()) -> Counter:
+        metric = Counter(self, name, help, labels)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name, help, labels=(), buckets=None) -> Histogram:
+        metric = Histogram(self, name, help, labels, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        """
+        Returns every metric in the Prometheus text format.
+        """
+        return ''.join(line + '\n' for metric in self._metrics for line in metric.render())
+
+    def reset(self) -> None:
+        for metric in self._metrics:
+            metric.clear()
+
+
+registry = Registry(enabled=settings.METRICS['ENABLED'])
+
+request_seconds = registry.histogram(
+    'wallet_http_request_duration_seconds', "Seconds spent answering a request.",
+    ('method', 'view', 'status'))
+request_queries = registry.histogram(
+    'wallet_http_request_queries', "ORM queries made while answering a request.",
+    ('method', 'view'), buckets=QUERY_BUCKETS)
+bank_call_seconds = registry.histogram(
+    'wallet_bank_call_duration_seconds', "Seconds spent waiting on a third party call.",
+    ('call', 'outcome'))
+payouts = registry.counter(
+    'wallet_payouts', "Payout outcomes, and scheduled and exhausted retries.", ('outcome',))
+withdrawal_lag_seconds = registry.histogram(
+    'wallet_withdrawal_lag_seconds',
+    "Seconds between the scheduled and the executed time of a finished withdrawal.",
+    ('status',), buckets=LAG_BUCKETS)
+
+# queries of the current request, a one item list shared with worker threads
+request_query_count = contextvars.ContextVar('request_query_count', default=None)
+
+
+def count_query(execute, sql, params, many, context):
+    count = request_query_count.get()
+    if count is not None:
+        count[0] += 1
+    return execute(sql, params, many, context)
+
+
+def watch_queries(db_connection) -> None:
+    if count_query not in db_connection.execute_wrappers:
+        db_connection.execute_wrappers.append(count_query)
+
+
+def watch_new_connection(sender, connection, **kwargs):
+    if registry.enabled:
+        watch_queries(connection)
+
+
+connection_created.connect(watch_new_connection)
+
+
+def view_name(request) -> str:
+    match = getattr(request, 'resolver_match', None)
+    return match.view_name if match is not None else 'unmatched'
+
+
+@sync_and_async_middleware
+def metrics_middleware(get_response):
+    """
+    Records the latency and the number of queries of every request.
+    """
+    if not registry.enabled:
+        raise MiddlewareNotUsed
+
+    def record(request, response, start, count) -> None:
+        view = view_name(request)
+        request_seconds.observe(time.perf_counter() - start,
+                                request.method, view, response.status_code)
+        request_queries.observe(count[0], request.method, view)
+
+    if asyncio.iscoroutinefunction(get_response):
+        async def middleware(request):
+            count = [0]
+            token = request_query_count.set(count)
+            start = time.perf_counter()
+            try:
+                response = await get_response(request)
+            finally:
+                request_query_count.reset(token)
+            record(request, response, start, count)
+            return response
+    else:
+        def middleware(request):
+            # connections opened before metrics were enabled are not wrapped yet
+            watch_queries(connection)
+            count = [0]
+            token = request_query_count.set(count)
+            start = time.perf_counter()
+            try:
+                response = get_response(request)
+            finally:
+                request_query_count.reset(token)
+            record(request, response, start, count)
+            return response
+    return middleware
+
+
+def metrics_view(request):
+    """
+    Serves the metrics of this process in the Prometheus text format.
+    """
+    if not registry.enabled:
+        raise Http404
+    return HttpResponse(registry.render(), content_type=CONTENT_TYPE)
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.partition('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = registry.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # scrapes are not worth a line each
+        pass
+
+
+def serve(port, address='') -> ThreadingHTTPServer:
+    """
+    Serves `GET /metrics` of this process on `port` from a background thread,
+    for processes that answer no HTTP requests themselves. Call `shutdown()`
+    on the returned server to stop it.
+    """
+    server = ThreadingHTTPServer((address, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics-server', daemon=True).start()
+    return server
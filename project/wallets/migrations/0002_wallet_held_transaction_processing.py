@@ -0,0 +1,24 @@
+# Generated by Django 3.2 on 2026-10-18 07:19
+
+from decimal import Decimal
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wallets', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='wallet',
+            name='held',
+            field=models.DecimalField(decimal_places=2, default=Decimal('0.00'), max_digits=12),
+        ),
+        migrations.AlterField(
+            model_name='transaction',
+            name='status',
+            field=models.CharField(choices=[('0', 'PENDING'), ('1', 'COMPLETED'), ('2', 'FAILED'), ('3', 'PROCESSING')], default='0', max_length=1),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 3.2 on 2026-10-18 07:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wallets', '0002_wallet_held_transaction_processing'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='transaction',
+            index=models.Index(fields=['status', 'method', 'scheduled_time'], name='transaction_due_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='transaction',
+            index=models.Index(fields=['wallet', 'scheduled_time'], name='transaction_wallet_time_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='transaction',
+            index=models.Index(condition=models.Q(status='0'), fields=['method', 'scheduled_time'], name='transaction_pending_idx'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.2 on 2026-10-18 07:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wallets', '0003_transaction_indexes'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='wallet',
+            name='created_at',
+            field=models.DateTimeField(auto_now_add=True, db_index=True),
+        ),
+    ]
@@ -0,0 +1,61 @@
+# Generated by Django 3.2 on 2026-10-18 07:25
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+def open_ledgers(apps, schema_editor):
+    """
+    Records the balance of every existing wallet as its opening entry.
+    """
+    Wallet = apps.get_model('wallets', 'Wallet')
+    LedgerEntry = apps.get_model('wallets', 'LedgerEntry')
+    wallets = Wallet.objects.exclude(balance=0).values_list('uuid', 'balance')
+    LedgerEntry.objects.bulk_create(
+        (LedgerEntry(wallet_id=uuid, amount=balance, kind='3') for uuid, balance in wallets.iterator()),
+        batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wallets', '0004_wallet_created_at_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LedgerEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('amount', models.DecimalField(decimal_places=2, max_digits=12)),
+                ('kind', models.CharField(choices=[('0', 'DEPOSIT'), ('1', 'WITHDRAW'), ('2', 'RELEASE'), ('3', 'ADJUSTMENT')], max_length=1)),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('transaction', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, to='wallets.transaction')),
+                ('wallet', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='wallets.wallet')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='BalanceSnapshot',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('balance', models.DecimalField(decimal_places=2, max_digits=12)),
+                ('last_entry_id', models.BigIntegerField()),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('wallet', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='wallets.wallet')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='ledgerentry',
+            index=models.Index(fields=['wallet', 'id'], name='ledger_wallet_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='ledgerentry',
+            index=models.Index(fields=['wallet', 'created_at'], name='ledger_wallet_time_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='balancesnapshot',
+            index=models.Index(fields=['wallet', 'created_at'], name='snapshot_wallet_time_idx'),
+        ),
+        migrations.RunPython(open_ledgers, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.2 on 2026-10-18 07:26
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wallets', '0005_ledger'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='transaction',
+            name='idempotency_key',
+            field=models.CharField(max_length=64, null=True, unique=True),
+        ),
+    ]
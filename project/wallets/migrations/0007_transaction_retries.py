@@ -0,0 +1,27 @@
+# Generated by Django 3.2 on 2026-10-18 07:28
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wallets', '0006_transaction_idempotency_key'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='transaction',
+            name='attempts',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='transaction',
+            name='retry_at',
+            field=models.PositiveIntegerField(null=True),
+        ),
+        migrations.AddIndex(
+            model_name='transaction',
+            index=models.Index(condition=models.Q(status='3'), fields=['retry_at'], name='transaction_retry_idx'),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 3.2 on 2026-10-18 07:47
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wallets', '0007_transaction_retries'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='transaction',
+            name='counterparty',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='incoming_transfers', to='wallets.wallet'),
+        ),
+        migrations.AlterField(
+            model_name='ledgerentry',
+            name='kind',
+            field=models.CharField(choices=[('0', 'DEPOSIT'), ('1', 'WITHDRAW'), ('2', 'RELEASE'), ('3', 'ADJUSTMENT'), ('4', 'TRANSFER')], max_length=1),
+        ),
+        migrations.AlterField(
+            model_name='transaction',
+            name='method',
+            field=models.CharField(choices=[('0', 'DEPOSIT'), ('1', 'WITHDRAW'), ('2', 'TRANSFER')], max_length=1),
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 3.2 on 2026-10-18 08:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wallets', '0009_wallet_balance_shards'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='transaction',
+            name='lease_expires',
+            field=models.PositiveIntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name='transaction',
+            name='lease_owner',
+            field=models.CharField(max_length=64, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='transaction',
+            index=models.Index(condition=models.Q(lease_owner__isnull=False), fields=['lease_owner'], name='transaction_lease_idx'),
+        ),
+    ]
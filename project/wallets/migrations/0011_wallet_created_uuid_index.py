@@ -0,0 +1,22 @@
+# Generated by Django 3.2 on 2026-10-18 08:37
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wallets', '0010_transaction_lease'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='wallet',
+            name='created_at',
+            field=models.DateTimeField(auto_now_add=True),
+        ),
+        migrations.AddIndex(
+            model_name='wallet',
+            index=models.Index(fields=['created_at', 'uuid'], name='wallet_created_idx'),
+        ),
+    ]
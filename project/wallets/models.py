@@ -1,12 +1,259 @@
+import random
 import uuid
 from decimal import Decimal
 
+from django.conf import settings
 from django.contrib.auth.models import User
 from django.db import models
+from django.db.models import (Case, DecimalField, ExpressionWrapper, F, Func, OuterRef, Q,
+                              Subquery, Sum, Value, When)
+from django.db.models.functions import Coalesce, Mod, NullIf
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
+from django.db.transaction import atomic, set_rollback
 from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 
 from utils import request_third_party_deposit
+from .cache import wallet_cache
+from .payouts import Outcome, classify, payout_client
+
+
+class Cents(Func):
+    """
+    Rounds a computed amount to cents. SQLite stores decimals as floats and
+    adds them as floats, so without it repeated updates drift off the cent,
+    e.g. 0.30 - 0.10 is stored as 0.19999999999999998 and no longer covers a
+    0.20 settlement. A no-op on databases with exact decimals.
+    """
+    function = 'ROUND'
+    template = '%(function)s(%(expressions)s, 2)'
+
+
+class WalletQuerySet(models.QuerySet):
+    """
+    Balance mutations of wallets.
+
+    Every mutation is a single conditional UPDATE, so the balance can never
+    go negative and no row has to be locked in between. Each change to the
+    balance appends a `LedgerEntry` in the same database transaction and
+    invalidates the cached details of the wallet, see `cache.WalletCache`.
+
+    With `settings.BALANCE_SHARDS['ENABLED']`, a very hot wallet can be
+    sharded, see `set_shards`: credits then land in
+    one of its `BalanceShard` rows, chosen by hash, instead of the wallet
+    row, so concurrent deposits do not wait on each other. Its balance is the
+    wallet `balance` plus the balances of its shards. Debits are taken from
+    the wallet `balance`, which is topped up from the shards when it does
+    not cover them.
+    """
+
+    def _mutate(self, pk, ledger_amount, kind, transaction=None, condition=None,
+                rows=None, **changes) -> bool:
+        queryset = self.filter(pk=pk) if rows is None else rows
+        if condition is not None:
+            queryset = queryset.filter(condition)
+        changes = {name: Cents(value) if hasattr(value, 'resolve_expression') else value
+                   for name, value in changes.items()}
+        with atomic(savepoint=False):
+            changed = queryset.update(updated_at=timezone.now(), **changes) == 1
+            if changed and ledger_amount and kind is not None:
+                LedgerEntry.objects.create(wallet_id=pk,
+                                           transaction=transaction,
+                                           amount=ledger_amount,
+                                           kind=kind)
+        if changed:
+            wallet_cache.invalidate(pk)
+        return changed
+
+    def _add(self, pk, amount, kind, transaction=None) -> bool:
+        """
+        Adds `amount` to the wallet row, or to one of its shards if the
+        wallet is sharded. Returns whether the wallet exists.
+        """
+        if not settings.BALANCE_SHARDS['ENABLED']:
+            return self._mutate(pk, amount, kind, transaction, balance=F('balance') + amount)
+        if self._mutate(pk, amount, kind, transaction, condition=Q(shard_count=0),
+                        balance=F('balance') + amount):
+            return True
+        key = transaction.pk if transaction is not None and transaction.pk else random.getrandbits(31)
+        shard_count = NullIf(Subquery(self.filter(pk=pk).values('shard_count')), Value(0))
+        shard = BalanceShard.objects.filter(wallet_id=pk, index=Mod(Value(key), shard_count))
+        if self._mutate(pk, amount, kind, transaction, rows=shard,
+                        balance=F('balance') + amount):
+            return True
+        # missing, or unsharded since the first UPDATE
+        return self._mutate(pk, amount, kind, transaction, balance=F('balance') + amount)
+
+    def _take(self, pk, amount, kind, transaction=None, **changes) -> bool:
+        """
+        Subtracts `amount` from the balance of the wallet in a conditional
+        UPDATE that only matches while the balance covers it, consolidating
+        the shards of a sharded wallet first if the balance alone does not.
+        """
+        changes['balance'] = F('balance') - amount
+        return (self._mutate(pk, -amount, kind, transaction,
+                             condition=Q(balance__gte=amount), **changes)
+                or (self.consolidate(pk)
+                    and self._mutate(pk, -amount, kind, transaction,
+                                     condition=Q(balance__gte=amount), **changes)))
+
+    def credit(self, pk, amount, transaction=None) -> bool:
+        """
+        Adds `amount` to the balance of the wallet in a single UPDATE.
+        Returns whether the wallet exists.
+        """
+        return self._add(pk, Decimal(amount), LedgerEntry.Kind.DEPOSIT, transaction)
+
+    def credit_all(self, pk, transactions) -> bool:
+        """
+        Adds the amounts of the saved `transactions` to the balance of the
+        wallet in a single UPDATE, recording a ledger entry per transaction.
+        Returns whether the wallet exists.
+        """
+        total = sum((transaction.amount for transaction in transactions), Decimal("0.00"))
+        with atomic(savepoint=False):
+            if not self._add(pk, total, None):
+                return False
+            LedgerEntry.objects.bulk_create(
+                (LedgerEntry(wallet_id=pk, transaction_id=transaction.pk, amount=transaction.amount,
+                             kind=LedgerEntry.Kind.DEPOSIT)
+                 for transaction in transactions),
+                batch_size=1000)
+        return True
+
+    def debit(self, pk, amount, transaction=None) -> bool:
+        """
+        Subtracts `amount` from the balance of the wallet in a single
+        conditional UPDATE that only matches while the balance covers it, so
+        the balance can never go negative. Returns whether it was debited.
+        """
+        return self._take(pk, Decimal(amount), LedgerEntry.Kind.WITHDRAW, transaction)
+
+    def reserve(self, pk, amount, transaction=None) -> bool:
+        """
+        Moves `amount` from the balance into the held amount of the wallet in
+        a single conditional UPDATE. Returns whether it was reserved.
+        """
+        amount = Decimal(amount)
+        return self._take(pk, amount, LedgerEntry.Kind.WITHDRAW, transaction,
+                          held=F('held') + amount)
+
+    def settle(self, pk, amount, transaction=None) -> bool:
+        """
+        Removes a reserved `amount` from the held amount of the wallet once it
+        has been paid out. Returns whether it was settled.
+        """
+        amount = Decimal(amount)
+        return self._mutate(pk, None, None, transaction,
+                            condition=Q(held__gte=amount),
+                            held=F('held') - amount)
+
+    def release(self, pk, amount, transaction=None) -> bool:
+        """
+        Returns a reserved `amount` from the held amount to the balance of the
+        wallet. Returns whether it was released.
+        """
+        amount = Decimal(amount)
+        return self._mutate(pk, amount, LedgerEntry.Kind.RELEASE, transaction,
+                            condition=Q(held__gte=amount),
+                            balance=F('balance') + amount,
+                            held=F('held') - amount)
+
+    def transfer(self, source, target, amount, transaction=None) -> bool:
+        """
+        Moves `amount` from the balance of wallet `source` to that of wallet
+        `target` in one database transaction. Returns whether it was moved;
+        nothing changes if the source lacks the funds or a wallet is missing.
+
+        The two rows are updated in `uuid` order whichever way the money
+        flows, so concurrent transfers between the same wallets lock them in
+        the same order and can not deadlock.
+        """
+        amount = Decimal(amount)
+        with atomic():
+            for pk in sorted((source, target)):
+                if pk == source:
+                    changed = self._take(source, amount, LedgerEntry.Kind.TRANSFER, transaction)
+                else:
+                    changed = self._add(target, amount, LedgerEntry.Kind.TRANSFER, transaction)
+                if not changed:
+                    set_rollback(True)
+                    return False
+        return True
+
+    def adjust(self, pk, balance) -> bool:
+        """
+        Sets the balance of the wallet to `balance`, recording the difference
+        as an adjustment. Returns whether the wallet exists.
+        """
+        balance = Decimal(balance)
+        with atomic():
+            self.consolidate(pk)
+            current = self.select_for_update().filter(pk=pk).values_list('balance', flat=True).first()
+            if current is None:
+                return False
+            return self._mutate(pk, balance - current, LedgerEntry.Kind.ADJUSTMENT,
+                                balance=balance)
+
+    def consolidate(self, pk) -> bool:
+        """
+        Moves the balances of the shards of the wallet into its `balance`.
+        Returns whether anything was moved.
+
+        Every shard is decreased by the amount read from it rather than set
+        to zero, so a credit landing in between is kept.
+        """
+        shards = BalanceShard.objects.filter(wallet_id=pk).exclude(balance=0)
+        if not shards.exists():
+            return False
+        with atomic():
+            shards = list(shards.select_for_update().values_list('pk', 'balance'))
+            for shard_pk, amount in shards:
+                BalanceShard.objects.filter(pk=shard_pk).update(
+                    balance=Cents(F('balance') - amount))
+            total = sum((amount for _, amount in shards), Decimal("0.00"))
+            return bool(total) and self._mutate(pk, None, None, balance=F('balance') + total)
+
+    def set_shards(self, pk, count) -> bool:
+        """
+        Spreads the credits of the wallet over `count` shards, or keeps them
+        on the wallet row again when `count` is 0. The balances of removed
+        shards are moved into the wallet `balance`. Returns whether the
+        wallet exists. Raises `ValueError` for a positive `count` while
+        balance shards are disabled.
+        """
+        if count and not settings.BALANCE_SHARDS['ENABLED']:
+            raise ValueError("balance shards are disabled, see settings.BALANCE_SHARDS")
+        with atomic():
+            if not self.filter(pk=pk).update(shard_count=count):
+                return False
+            BalanceShard.objects.bulk_create(
+                (BalanceShard(wallet_id=pk, index=index) for index in range(count)),
+                ignore_conflicts=True)
+            removed = BalanceShard.objects.filter(wallet_id=pk, index__gte=count)
+            total = sum(removed.select_for_update().values_list('balance', flat=True),
+                        Decimal("0.00"))
+            removed.delete()
+            if total:
+                self._mutate(pk, None, None, balance=F('balance') + total)
+        return True
+
+    def with_shard_balance(self):
+        """
+        Annotates every wallet with `shard_balance`, the sum of its shards,
+        which is only computed for sharded wallets, and is 0 without a
+        subquery while balance shards are disabled.
+        """
+        balance = DecimalField(max_digits=12, decimal_places=2)
+        if not settings.BALANCE_SHARDS['ENABLED']:
+            return self.annotate(shard_balance=ExpressionWrapper(Value(0), output_field=balance))
+        shards = (BalanceShard.objects.filter(wallet=OuterRef('pk')).order_by()
+                  .values('wallet').annotate(total=Sum('balance')).values('total'))
+        return self.annotate(shard_balance=Case(
+            When(shard_count=0, then=Value(0)),
+            default=Coalesce(Subquery(shards, output_field=balance), Value(0)),
+            output_field=balance))
 
 
 class Wallet(models.Model):
@@ -19,6 +266,11 @@ class Wallet(models.Model):
         A unique identifier for the wallet.
     balance: decimal.Decimal
         The current balance of the wallet.
+    held: decimal.Decimal
+        The amount reserved by withdrawals waiting for the third party.
+    shard_count: int
+        The number of `BalanceShard` rows credits are spread over, 0 if the
+        wallet is not sharded. See `total_balance`.
     owner: django.contrib.auth.models.User
         The user who owns the wallet.
     created_at: datetime.datetime
@@ -32,36 +284,79 @@ class Wallet(models.Model):
     balance = models.DecimalField(max_digits=12,
                                   decimal_places=2,
                                   default=Decimal("0.00"))
+    held = models.DecimalField(max_digits=12,
+                               decimal_places=2,
+                               default=Decimal("0.00"))
+    shard_count = models.PositiveSmallIntegerField(default=0)
     owner = models.OneToOneField(User,
                                  on_delete=models.CASCADE)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
-    def deposit(self, amount) -> [str, bool]:
+    objects = WalletQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            # wallet lists, see `pagination.WalletPagination`
+            models.Index(fields=['created_at', 'uuid'],
+                         name='wallet_created_idx'),
+        ]
+
+    def save(self, *args, **kwargs):
+        """
+        Saves the wallet, recording the balance of a new wallet as its
+        opening ledger entry.
+        """
+        adding = self._state.adding
+        with atomic():
+            super().save(*args, **kwargs)
+            wallet_cache.invalidate(self.pk)
+            if adding and self.balance:
+                LedgerEntry.objects.create(wallet=self,
+                                           amount=self.balance,
+                                           kind=LedgerEntry.Kind.ADJUSTMENT)
+
+    @property
+    def total_balance(self) -> Decimal:
+        """
+        The balance of the wallet including its shards, read from the
+        `shard_balance` annotation when present.
+        """
+        if not self.shard_count:
+            return self.balance
+        shard_balance = getattr(self, 'shard_balance', None)
+        if shard_balance is None:
+            shard_balance = self.balance_shards.aggregate(total=Sum('balance'))['total']
+        return self.balance + (shard_balance or Decimal("0.00"))
+
+    def deposit(self, amount, transaction=None) -> [str, bool]:
         """
         Deposits the given amount into the wallet balance.
         Returns a tuple containing a message and a boolean indicating the success of the deposit.
         """
-        self.balance += Decimal(amount)
-        self.save()
+        Wallet.objects.credit(self.pk, amount, transaction)
+        self.refresh_from_db(fields=['balance'])
         return "deposited successfully", True
 
     def withdraw(self, amount, request_third_party_deposit) -> [str, bool]:
         """
         Withdraws the given amount from the wallet balance.
         Returns a tuple containing a message and a boolean indicating the success of the withdrawal.
-        If the withdrawal is successful, a request to a third party is made to process the transaction.
+        The amount is reserved first, then a request to a third party is made to process the
+        transaction; the reservation is settled if the third party succeeds and released back
+        to the balance otherwise.
         """
-        if self.balance < Decimal(amount):
-            result_description = "Insufficient funds."
-            result_status = False
+        if not Wallet.objects.reserve(self.pk, amount):
+            self.refresh_from_db(fields=['balance', 'held'])
+            return "Insufficient funds.", False
+        request_res: dict = request_third_party_deposit()
+        result_status: bool = request_res.get('status') == 200
+        result_description: str = request_res.get('data')
+        if result_status:
+            Wallet.objects.settle(self.pk, amount)
         else:
-            request_res: dict = request_third_party_deposit()
-            result_status: bool = request_res.get('status') == 200
-            result_description: str = request_res.get('data')
-            if result_status:
-                self.balance -= Decimal(amount)
-            self.save()
+            Wallet.objects.release(self.pk, amount)
+        self.refresh_from_db(fields=['balance', 'held'])
         return result_description, result_status
 
     def __str__(self):
@@ -71,31 +366,104 @@ class Wallet(models.Model):
         return self.owner.username
 
 
+@receiver(post_delete, sender=Wallet)
+def invalidate_deleted_wallet(sender, instance, **kwargs):
+    wallet_cache.invalidate(instance.pk)
+
+
+class BalanceShard(models.Model):
+    """
+    A part of the balance of a sharded wallet, see `WalletQuerySet`.
+
+    Attributes:
+        wallet (Wallet): The wallet the shard belongs to.
+        index (int): The position of the shard, below `Wallet.shard_count`.
+        balance (Decimal): The credits that landed in the shard and were not
+            yet consolidated into the wallet balance.
+        updated_at (datetime): When the shard was last updated.
+    """
+    wallet = models.ForeignKey(Wallet,
+                               on_delete=models.CASCADE,
+                               related_name='balance_shards')
+    index = models.PositiveSmallIntegerField()
+    balance = models.DecimalField(max_digits=12,
+                                  decimal_places=2,
+                                  default=Decimal("0.00"))
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['wallet', 'index'],
+                                    name='balance_shard_unique'),
+        ]
+
+
+class TransactionQuerySet(models.QuerySet):
+
+    def due_withdrawals(self, now=None):
+        """
+        Returns the pending withdrawals whose `scheduled_time` has arrived,
+        oldest first.
+        """
+        if now is None:
+            now = timezone.now().timestamp()
+        return self.filter(status=Transaction.Status.PENDING,
+                           method=Transaction.Method.WITHDRAW,
+                           scheduled_time__lte=now,
+                           ).order_by('scheduled_time', 'id')
+
+    def due_retries(self, now=None):
+        """
+        Returns the processing withdrawals whose retry time has arrived,
+        oldest first.
+        """
+        if now is None:
+            now = timezone.now().timestamp()
+        return self.filter(status=Transaction.Status.PROCESSING,
+                           retry_at__lte=now,
+                           ).order_by('retry_at', 'id')
+
+
 class Transaction(models.Model):
     """
     A model to represent a financial transaction for a wallet.
 
     Attributes:
         wallet (Wallet): The foreign key to the Wallet model.
+        counterparty (Wallet): The wallet a transfer moves the amount to.
         amount (Decimal): The amount of the transaction.
         scheduled_time (int): The scheduled time for the transaction in timestamp format.
         executed_time (int): The execution time of the transaction in timestamp format.
-        method (str): The method of the transaction, either deposit or withdraw.
-        status (str): The status of the transaction, either pending, completed, or failed.
+        method (str): The method of the transaction, either deposit, withdraw or transfer.
+        status (str): The status of the transaction, either pending, processing, completed,
+            or failed. A processing withdrawal has its amount reserved on the wallet and is
+            waiting for the third party.
         status_description (str): A description of the status of the transaction.
+        idempotency_key (str): The `Idempotency-Key` the transaction was created with, if any.
+        attempts (int): The number of third party calls made for a withdrawal.
+        retry_at (int): When a processing withdrawal is retried, in timestamp format.
+        lease_owner (str): The withdrawal worker that claimed the transaction, if any.
+        lease_expires (int): When the claim lapses unless renewed, in timestamp format.
 
     """
     class Status(models.TextChoices):
         PENDING = "0", _("PENDING")
         COMPLETED = "1", _("COMPLETED")
         FAILED = "2", _("FAILED")
+        PROCESSING = "3", _("PROCESSING")
 
     class Method(models.TextChoices):
         DEPOSIT = "0", _("DEPOSIT")
         WITHDRAW = "1", _("WITHDRAW")
+        TRANSFER = "2", _("TRANSFER")
 
     wallet = models.ForeignKey(Wallet,
                                on_delete=models.CASCADE)
+    counterparty = models.ForeignKey(Wallet,
+                                     null=True,
+                                     blank=True,
+                                     on_delete=models.SET_NULL,
+                                     related_name='incoming_transfers')
     amount = models.DecimalField(max_digits=12,
                                  decimal_places=2,
                                  default=Decimal("0.00"))
@@ -108,36 +476,262 @@ class Transaction(models.Model):
                               choices=Status.choices,
                               default=Status.PENDING, )
     status_description = models.TextField(null=True)
+    idempotency_key = models.CharField(max_length=64,
+                                       null=True,
+                                       unique=True)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    retry_at = models.PositiveIntegerField(null=True)
+    lease_owner = models.CharField(max_length=64, null=True)
+    lease_expires = models.PositiveIntegerField(null=True)
+
+    objects = TransactionQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            # due withdrawals, see `TransactionQuerySet.due_withdrawals`
+            models.Index(fields=['status', 'method', 'scheduled_time'],
+                         name='transaction_due_idx'),
+            # transactions of a wallet ordered by time
+            models.Index(fields=['wallet', 'scheduled_time'],
+                         name='transaction_wallet_time_idx'),
+            # pending rows only, skipped on backends without partial indexes
+            models.Index(fields=['method', 'scheduled_time'],
+                         name='transaction_pending_idx',
+                         condition=Q(status="0")),
+            # withdrawals waiting for a retry, see `TransactionQuerySet.due_retries`
+            models.Index(fields=['retry_at'],
+                         name='transaction_retry_idx',
+                         condition=Q(status="3")),
+            # leases held by a withdrawal worker, see `scheduler.Leases`
+            models.Index(fields=['lease_owner'],
+                         name='transaction_lease_idx',
+                         condition=Q(lease_owner__isnull=False)),
+        ]
 
     def execute_deposit(self):
         """
         Executes a deposit transaction.
         """
         self.executed_time = timezone.now().timestamp()
-        message, is_done = self.wallet.deposit(self.amount)
+        message, is_done = self.wallet.deposit(self.amount, self)
         self.status = self.Status.COMPLETED if is_done else self.Status.FAILED
         self.status_description = message
         self.save()
 
-    def execute_withdraw(self):
+    def execute_transfer(self):
         """
-        Executes a withdraw transaction.
+        Executes a transfer from `wallet` to `counterparty` as a single
+        database transaction, without calling the third party.
         """
-        if self.executed_time is not None:
+        if self.executed_time is not None or self.status != self.Status.PENDING:
             message = "Transaction has already been executed."
             raise ValueError(message)
-        if self.scheduled_time > timezone.now().timestamp():
-            message = "Withdrawal time has not yet arrived."
+        with atomic():
+            moved = Wallet.objects.transfer(self.wallet_id, self.counterparty_id,
+                                            self.amount, self)
+            self.status = self.Status.COMPLETED if moved else self.Status.FAILED
+            self.status_description = ("transferred successfully" if moved
+                                       else "Insufficient funds.")
+            self.executed_time = timezone.now().timestamp()
+            self.save(update_fields=['status', 'status_description', 'executed_time'])
+
+    def execute_withdraw(self):
+        """
+        Executes a withdraw transaction in two phases.
+
+        The amount is reserved on the wallet and the transaction marked as
+        processing in one short database transaction. The third party is
+        called outside of it, so no lock is held during the call, and the
+        outcome is then recorded by `finish_withdraw`.
+
+        A processing withdrawal whose `retry_at` has arrived already holds its
+        reservation and only repeats the third party call.
+        """
+        if not self.prepare_withdraw():
+            return
+        outcome, request_res = payout_client.call(request_third_party_deposit,
+                                                  idempotency_key=self.payout_key)
+        self.finish_withdraw(request_res, outcome)
+
+    def prepare_withdraw(self) -> bool:
+        """
+        Checks that a withdrawal is due and reserves its amount unless a
+        retry already holds it. Returns whether the third party should be
+        called, raises ValueError if the withdrawal is not due.
+        """
+        now = timezone.now().timestamp()
+        if self.status == self.Status.PROCESSING and self.retry_at is not None:
+            if self.retry_at > now:
+                message = "Retry time has not yet arrived."
+                raise ValueError(message)
+        else:
+            if self.executed_time is not None or self.status != self.Status.PENDING:
+                message = "Transaction has already been executed."
+                raise ValueError(message)
+            if self.scheduled_time > now:
+                message = "Withdrawal time has not yet arrived."
+                raise ValueError(message)
+            return self.reserve()
+        return True
+
+    @property
+    def payout_key(self) -> str:
+        """
+        The idempotency key sent to the third party, so a retried payout of
+        this transaction is never paid twice.
+        """
+        return self.idempotency_key or f"transaction-{self.pk}"
+
+    def advance(self, current, **changes) -> None:
+        """
+        Applies `changes` to the row only while its status is still `current`
+        with the attempts this instance read, so of two workers holding the
+        same withdrawal only one can move it on. Raises ValueError for the
+        other.
+        """
+        if not Transaction.objects.filter(pk=self.pk, status=current,
+                                          attempts=self.attempts).update(**changes):
+            message = "Transaction has already been executed."
             raise ValueError(message)
-        message, is_done = self.wallet.withdraw(self.amount,
-                                                request_third_party_deposit)
-        self.status = self.Status.COMPLETED if is_done else self.Status.FAILED
-        self.status_description = message
-        self.executed_time = timezone.now().timestamp()
-        self.save()
+        for name, value in changes.items():
+            setattr(self, name, value)
+
+    def reserve(self) -> bool:
+        """
+        Reserves the amount of a pending withdrawal on its wallet and marks
+        the transaction as processing. Marks it as failed if the wallet lacks
+        the funds. Returns whether it was reserved.
+        """
+        with atomic():
+            self.advance(self.Status.PENDING, status=self.Status.PROCESSING)
+            reserved = Wallet.objects.reserve(self.wallet_id, self.amount, self)
+            if not reserved:
+                self.status = self.Status.FAILED
+                self.status_description = "Insufficient funds."
+                self.executed_time = timezone.now().timestamp()
+                self.save(update_fields=['status', 'status_description', 'executed_time'])
+        return reserved
+
+    def finish_withdraw(self, request_res: dict, outcome=None):
+        """
+        Records the third party response of a processing withdrawal: the
+        reservation is settled on success and released back to the wallet
+        balance on failure. A retryable failure keeps the reservation and
+        schedules a retry instead, until the retry policy gives up.
+        """
+        if outcome is None:
+            outcome = classify(request_res)
+        if outcome is Outcome.REJECTED or (
+                outcome is Outcome.RETRY
+                and payout_client.policy.should_retry(self.attempts + 1)):
+            self.schedule_retry(request_res, outcome)
+            return
+        if outcome is Outcome.RETRY:
+            payout_client.count('retries_exhausted')
+        is_done = outcome is Outcome.SUCCESS
+        with atomic():
+            self.advance(self.Status.PROCESSING,
+                         status=self.Status.COMPLETED if is_done else self.Status.FAILED,
+                         status_description=request_res.get('data'),
+                         executed_time=timezone.now().timestamp(),
+                         attempts=self.attempts + 1,
+                         retry_at=None,
+                         lease_owner=None,
+                         lease_expires=None)
+            if is_done:
+                Wallet.objects.settle(self.wallet_id, self.amount, self)
+            else:
+                Wallet.objects.release(self.wallet_id, self.amount, self)
+
+    def schedule_retry(self, request_res: dict, outcome):
+        """
+        Keeps a processing withdrawal reserved and schedules its next third
+        party call. Calls rejected by the open circuit breaker are not
+        counted as attempts and wait for the breaker to probe again.
+        """
+        attempts = self.attempts
+        if outcome is Outcome.REJECTED:
+            delay = payout_client.breaker.reset_timeout
+        else:
+            attempts += 1
+            delay = payout_client.policy.delay(attempts)
+        self.advance(self.Status.PROCESSING,
+                     attempts=attempts,
+                     retry_at=timezone.now().timestamp() + delay,
+                     status_description=request_res.get('data'))
+        if outcome is not Outcome.REJECTED:
+            payout_client.count('retries_scheduled')
 
     def __str__(self) -> str:
         username = self.wallet.owner.username
         amount = self.amount
         status = self.status
         return f"username {username}, amount {amount}, status {status}"
+
+
+class LedgerEntry(models.Model):
+    """
+    An append-only record of a change to the balance of a wallet.
+
+    The entries of a wallet sum up to its `balance`. Reserving a withdrawal
+    is recorded as a negative `WITHDRAW` entry and releasing it again as a
+    positive `RELEASE` entry; settling only touches the held amount. A
+    transfer records a negative and a positive `TRANSFER` entry.
+
+    Attributes:
+        wallet (Wallet): The wallet whose balance changed.
+        transaction (Transaction): The transaction that caused the change, if any.
+        amount (Decimal): The signed change of the balance.
+        kind (str): What caused the change.
+        created_at (datetime): When the change was made.
+    """
+    class Kind(models.TextChoices):
+        DEPOSIT = "0", _("DEPOSIT")
+        WITHDRAW = "1", _("WITHDRAW")
+        RELEASE = "2", _("RELEASE")
+        ADJUSTMENT = "3", _("ADJUSTMENT")
+        TRANSFER = "4", _("TRANSFER")
+
+    wallet = models.ForeignKey(Wallet,
+                               on_delete=models.CASCADE)
+    transaction = models.ForeignKey(Transaction,
+                                    null=True,
+                                    on_delete=models.SET_NULL)
+    amount = models.DecimalField(max_digits=12,
+                                 decimal_places=2)
+    kind = models.CharField(max_length=1,
+                            choices=Kind.choices)
+    created_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['wallet', 'id'],
+                         name='ledger_wallet_id_idx'),
+            models.Index(fields=['wallet', 'created_at'],
+                         name='ledger_wallet_time_idx'),
+        ]
+
+
+class BalanceSnapshot(models.Model):
+    """
+    The balance of a wallet computed from its ledger entries up to and
+    including `last_entry_id`, see `wallets.ledger`.
+
+    Attributes:
+        wallet (Wallet): The wallet the snapshot belongs to.
+        balance (Decimal): The sum of the ledger entries it covers.
+        last_entry_id (int): The id of the last ledger entry it covers.
+        created_at (datetime): When the snapshot was taken.
+    """
+    wallet = models.ForeignKey(Wallet,
+                               on_delete=models.CASCADE)
+    balance = models.DecimalField(max_digits=12,
+                                  decimal_places=2)
+    last_entry_id = models.BigIntegerField()
+    created_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['wallet', 'created_at'],
+                         name='snapshot_wallet_time_idx'),
+        ]
@@ -0,0 +1,89 @@
+from django.conf import settings
+from rest_framework.pagination import BasePagination, CursorPagination, LimitOffsetPagination
+
+MODES = ('offset', 'cursor')
+
+
+class KeysetPagination(CursorPagination):
+    """
+    Cursor pagination keyed on an indexed, monotonic column.
+
+    Each page is fetched with `WHERE <ordering column> < <last seen value>`
+    through the index, so deep pages cost the same as the first one, and no
+    `COUNT(*)` is run. Clients follow the `next` and `previous` links; the
+    page size can be set with `limit`, like with `LimitOffsetPagination`.
+    """
+    ordering = '-id'
+    page_size_query_param = 'limit'
+    max_page_size = 1000
+
+
+class WalletPagination(KeysetPagination):
+    # uuid breaks ties between wallets created in the same instant
+    ordering = ('-created_at', '-uuid')
+
+
+class ListPagination(BasePagination):
+    """
+    Pages a list with `LimitOffsetPagination`, the `REST_FRAMEWORK` default
+    with `count`, `next`, `previous` and `results`, or with `cursor_class`
+    when the client asks for `?pagination=cursor` or follows a cursor link.
+    `settings.PAGINATION['MODE']` sets the mode of requests that ask for
+    none. Offset pages are ordered like cursor pages, so both are stable.
+    """
+    cursor_class = KeysetPagination
+    offset_class = LimitOffsetPagination
+    mode_query_param = 'pagination'
+
+    def __init__(self):
+        self.paginator = self.offset_class()
+
+    @property
+    def ordering(self) -> tuple:
+        ordering = self.cursor_class.ordering
+        return (ordering,) if isinstance(ordering, str) else tuple(ordering)
+
+    def get_mode(self, request) -> str:
+        mode = request.query_params.get(self.mode_query_param)
+        if mode in MODES:
+            return mode
+        if request.query_params.get(self.cursor_class.cursor_query_param):
+            return 'cursor'
+        return settings.PAGINATION['MODE']
+
+    def paginate_queryset(self, queryset, request, view=None):
+        if self.get_mode(request) == 'cursor':
+            self.paginator = self.cursor_class()
+        else:
+            self.paginator = self.offset_class()
+            queryset = queryset.order_by(*self.ordering)
+        return self.paginator.paginate_queryset(queryset, request, view)
+
+    def get_paginated_response(self, data):
+        return self.paginator.get_paginated_response(data)
+
+    def get_paginated_response_schema(self, schema):
+        return self.offset_class().get_paginated_response_schema(schema)
+
+    def get_schema_operation_parameters(self, view):
+        parameters = self.offset_class().get_schema_operation_parameters(view)
+        cursor = self.cursor_class().get_schema_operation_parameters(view)
+        names = {parameter['name'] for parameter in parameters}
+        return parameters + [parameter for parameter in cursor if parameter['name'] not in names] + [{
+            'name': self.mode_query_param,
+            'required': False,
+            'in': 'query',
+            'description': "Pagination mode, `offset` (the default) or `cursor`.",
+            'schema': {'type': 'string', 'enum': list(MODES)},
+        }]
+
+    @property
+    def display_page_controls(self) -> bool:
+        return self.paginator.display_page_controls
+
+    def to_html(self):
+        return self.paginator.to_html()
+
+
+class WalletListPagination(ListPagination):
+    cursor_class = WalletPagination
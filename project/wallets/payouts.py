@@ -0,0 +1,272 @@
+"""
+This module contains the retry and circuit breaking logic of payouts.
+
+A third party response is classified as a success, a terminal failure (the
+bank rejected the payout, e.g. a 400) or a retryable one (a 503, a 500 from a
+connection error or timeout, or an empty body). A retryable withdrawal keeps
+its reservation and is retried after a jittered exponential backoff, see
+`RetryPolicy`, until `MAX_ATTEMPTS` calls were made.
+
+The `CircuitBreaker` watches the retryable error rate over a sliding window.
+Once it trips, calls are rejected without reaching the bank until
+`BREAKER_RESET_TIMEOUT` has passed; then a single probe call decides whether
+it closes again. The withdrawal executor does not even fetch work while the
+breaker is open.
+
+Payouts can also be sent to the bank in batches, see
+`PayoutClient.call_batch`: one call carries many items and its per-item
+results are classified like single responses.
+
+`payout_client` is the process wide `PayoutClient`; its `metrics` expose the
+call outcomes, retries and breaker state. The latency of every bank call and
+the outcome counters are also recorded in `wallets.metrics`.
+"""
+
+import enum
+import random
+import threading
+import time
+from collections import Counter, deque
+
+from django.conf import settings
+
+from . import metrics
+
+
+class Outcome(enum.Enum):
+    SUCCESS = 'success'
+    FAILED = 'failed'
+    RETRY = 'retry'
+    REJECTED = 'rejected'
+
+
+def classify(response: dict) -> Outcome:
+    """
+    Classifies a third party response as success, terminal or retryable.
+    """
+    status = response.get('status')
+    if status == 200:
+        return Outcome.SUCCESS
+    if status is not None and 400 <= status < 500:
+        return Outcome.FAILED
+    return Outcome.RETRY
+
+
+class RetryPolicy:
+    """
+    Exponential backoff with full jitter.
+
+    Attributes:
+        max_attempts (int): The number of calls made before giving up.
+        base_delay (float): Seconds of the first backoff.
+        max_delay (float): Upper bound of any backoff in seconds.
+    """
+
+    def __init__(self, max_attempts, base_delay, max_delay):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def should_retry(self, attempts) -> bool:
+        return attempts < self.max_attempts
+
+    def delay(self, attempts) -> float:
+        """
+        Returns the seconds to wait after the `attempts`-th failed call.
+        """
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempts - 1)))
+
+
+class CircuitBreaker:
+    """
+    A circuit breaker tripping on the error rate over a sliding time window.
+
+    Attributes:
+        error_rate (float): The share of failed calls that opens the breaker.
+        window (float): Seconds of calls the error rate is computed over.
+        min_calls (int): The number of calls in the window needed to open it.
+        reset_timeout (float): Seconds the breaker stays open before probing.
+        opened (int): The number of times the breaker opened.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, error_rate, window, min_calls, reset_timeout, timer=time.monotonic):
+        self.error_rate = error_rate
+        self.window = window
+        self.min_calls = min_calls
+        self.reset_timeout = reset_timeout
+        self.opened = 0
+        self._timer = timer
+        self._state = self.CLOSED
+        self._opened_at = None
+        self._probing = False
+        self._calls = deque()
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            return self._current_state()
+
+    def _current_state(self) -> str:
+        if self._state == self.OPEN and self._timer() >= self._opened_at + self.reset_timeout:
+            self._state = self.HALF_OPEN
+            self._probing = False
+        return self._state
+
+    def allow(self) -> bool:
+        """
+        Returns whether a call may go through. While half open only one probe
+        call is allowed at a time.
+        """
+        with self._lock:
+            state = self._current_state()
+            if state == self.CLOSED:
+                return True
+            if state == self.HALF_OPEN and not self._probing:
+                self._probing = True
+                return True
+            return False
+
+    def record(self, ok) -> None:
+        """
+        Records the result of an allowed call.
+        """
+        with self._lock:
+            now = self._timer()
+            if self._current_state() == self.HALF_OPEN:
+                self._probing = False
+                if ok:
+                    self._state = self.CLOSED
+                    self._calls.clear()
+                else:
+                    self._open(now)
+                return
+            self._calls.append((now, ok))
+            while self._calls and self._calls[0][0] < now - self.window:
+                self._calls.popleft()
+            failures = sum(1 for _, call_ok in self._calls if not call_ok)
+            if (len(self._calls) >= self.min_calls
+                    and failures / len(self._calls) >= self.error_rate):
+                self._open(now)
+
+    def reset(self) -> None:
+        with self._lock:
+            self._state = self.CLOSED
+            self._probing = False
+            self._calls.clear()
+
+    def _open(self, now) -> None:
+        self._state = self.OPEN
+        self._opened_at = now
+        self._calls.clear()
+        self.opened += 1
+
+
+class PayoutClient:
+    """
+    Guards third party calls with a circuit breaker and counts their outcomes.
+
+    Attributes:
+        policy (RetryPolicy): When and how often failed payouts are retried.
+        breaker (CircuitBreaker): The breaker calls go through.
+        counts (collections.Counter): Calls by outcome, plus scheduled and
+            exhausted retries.
+    """
+
+    def __init__(self, policy, breaker):
+        self.policy = policy
+        self.breaker = breaker
+        self.counts = Counter()
+        self._lock = threading.Lock()
+
+    def call(self, func, **kwargs) -> (Outcome, dict):
+        """
+        Calls `func(**kwargs)` unless the breaker is open, and returns the
+        classified outcome with the response.
+        """
+        if not self.breaker.allow():
+            self.count(Outcome.REJECTED.value)
+            return Outcome.REJECTED, {'data': "Third party circuit is open.", 'status': None}
+        start = time.perf_counter()
+        response = func(**kwargs)
+        outcome = classify(response)
+        metrics.bank_call_seconds.observe(time.perf_counter() - start, 'payout', outcome.value)
+        # a rejected payout still means the bank is up
+        self.breaker.record(outcome is not Outcome.RETRY)
+        self.count(outcome.value)
+        return outcome, response
+
+    def call_batch(self, func, items) -> dict:
+        """
+        Calls `func(items=items)` once for many payouts unless the breaker is
+        open, and returns the classified outcome with the response of each
+        item by its `key`. An item missing from the response is retried.
+
+        The bank call as a whole counts once towards the breaker; a batch the
+        bank failed as a whole gives every item the outcome of the batch.
+        """
+        if not self.breaker.allow():
+            self.count(Outcome.REJECTED.value, len(items))
+            response = {'data': "Third party circuit is open.", 'status': None}
+            return {item['key']: (Outcome.REJECTED, response) for item in items}
+        start = time.perf_counter()
+        response = func(items=items)
+        outcome = classify(response)
+        metrics.bank_call_seconds.observe(time.perf_counter() - start, 'batch', outcome.value)
+        self.breaker.record(outcome is not Outcome.RETRY)
+        if outcome is Outcome.SUCCESS:
+            responses = {result.get('key'): result for result in response.get('items', [])}
+        else:
+            responses = {}
+            response = {'data': response.get('data'), 'status': response.get('status')}
+        results = {}
+        for item in items:
+            item_response = responses.get(
+                item['key'],
+                response if outcome is not Outcome.SUCCESS
+                else {'data': "Missing from the batch response.", 'status': None})
+            item_outcome = classify(item_response)
+            self.count(item_outcome.value)
+            results[item['key']] = (item_outcome, item_response)
+        return results
+
+    def count(self, name, value=1) -> None:
+        with self._lock:
+            self.counts[name] += value
+        metrics.payouts.inc(name, value=value)
+
+    def reset(self) -> None:
+        """
+        Clears the counters and closes the breaker.
+        """
+        with self._lock:
+            self.counts.clear()
+        self.breaker.reset()
+
+    def metrics(self) -> dict:
+        """
+        Returns the outcome counters and the breaker state.
+        """
+        with self._lock:
+            metrics = {f'payouts_{name}': value for name, value in self.counts.items()}
+        metrics['breaker_state'] = self.breaker.state
+        metrics['breaker_opened'] = self.breaker.opened
+        return metrics
+
+
+def build_client() -> PayoutClient:
+    config = settings.PAYOUTS
+    return PayoutClient(
+        policy=RetryPolicy(max_attempts=config['MAX_ATTEMPTS'],
+                           base_delay=config['RETRY_BASE_DELAY'],
+                           max_delay=config['RETRY_MAX_DELAY']),
+        breaker=CircuitBreaker(error_rate=config['BREAKER_ERROR_RATE'],
+                               window=config['BREAKER_WINDOW'],
+                               min_calls=config['BREAKER_MIN_CALLS'],
+                               reset_timeout=config['BREAKER_RESET_TIMEOUT']))
+
+
+payout_client = build_client()
@@ -0,0 +1,31 @@
+from rest_framework.renderers import JSONRenderer
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+class FastJSONRenderer(JSONRenderer):
+    """
+    A `JSONRenderer` that encodes with orjson, a C JSON encoder, when it is
+    installed, and with the standard library otherwise.
+
+    The output is byte for byte the one of `JSONRenderer` with the default
+    compact, unicode output: values orjson does not encode itself, such as
+    decimals, lazy translations and datetimes, go through the encoder of
+    `JSONRenderer`. Indented output, `UNICODE_JSON = False` and data orjson
+    can not encode are rendered by `JSONRenderer` itself.
+    """
+    options = (orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS) if orjson else 0
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if (orjson is None or data is None or self.ensure_ascii or not self.compact
+                or self.get_indent(accepted_media_type, renderer_context or {})):
+            return super().render(data, accepted_media_type, renderer_context)
+        try:
+            ret = orjson.dumps(data, default=self.encoder_class().default, option=self.options)
+        except (orjson.JSONEncodeError, TypeError):
+            return super().render(data, accepted_media_type, renderer_context)
+        # like `JSONRenderer`, escape the separators that are not valid in javascript
+        return ret.replace(b'\xe2\x80\xa8', b'\\u2028').replace(b'\xe2\x80\xa9', b'\\u2029')
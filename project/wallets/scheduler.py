@@ -1,44 +1,488 @@
 """
-This module contains functions and objects related to scheduling jobs using
-the `apscheduler` library and the Django framework.
-
-The `scheduler` object is an instance of the `BlockingScheduler` class from the
-`apscheduler.schedulers.blocking` module, configured to use the timezone
-defined in the Django `settings` module. It also has a jobstore created using
-the `DjangoJobStore` class from the `django_apscheduler.jobstores` module.
-
-The `define_schedule_job` function takes three parameters: `my_job`, a callable
-object representing the job to be scheduled; `schedule`, a `datetime.datetime`
-object representing the time and date when the job should run; and `_id`, a
-string representing the ID of the job. The function schedules the job using the
-`add_job` method of the `scheduler` object, with the `trigger` argument set to
-'date', the `run_date` argument set to the `schedule` parameter, and the `id`
-argument set to the `_id` parameter. If a job with the same ID already exists,
-it will be replaced by the new job.
-
-The function then starts the `scheduler` object using the `start` method, which
-will run indefinitely until it is stopped or an exception is raised. If an
-exception is raised, the function retrieves and prints the list of scheduled
-jobs using the `get_jobs` method of the `scheduler` object.
+This module contains the withdrawal executor.
+
+Scheduled withdrawals are plain `Transaction` rows with a `PENDING` status and
+a `scheduled_time` in the future; creating one through the API is a single
+insert. The `WithdrawalExecutor` runs in its own process (see the
+`run_withdrawals` management command), polls the table for withdrawals whose
+`scheduled_time` has arrived and executes them in batches of `batch_size`.
+
+With a `PayoutDispatcher` the withdrawals of a batch run concurrently, each
+waiting on the bank in its own worker; without one they run one after the
+other in the calling thread. The executor waits for the whole batch before
+polling again, so a withdrawal still in flight is never fetched twice.
+
+Withdrawals whose third party call failed with a retryable error stay
+reserved and come back in a later batch once their `retry_at` arrives. While
+the payout circuit breaker is open the executor fetches nothing, so no worker
+waits on a bank that is down.
+
+With a `payout_batch_size` the third party is not called once per
+withdrawal: the batch is split into chunks of that size, every withdrawal of
+a chunk is reserved, and the chunk is paid out in a single bank call whose
+per-item results are then recorded on each transaction. This pays the fixed
+latency of a bank call once per chunk instead of once per withdrawal. Chunks
+run on the dispatcher like single withdrawals do.
+
+When a poll returns a full batch the executor immediately polls again, so a
+backlog of due withdrawals is drained without waiting `poll_interval` between
+batches. When the table holds nothing due, it sleeps for `poll_interval`
+seconds before the next poll.
+
+Any number of executors, on any number of nodes, can share the table when
+each claims its withdrawals through `Leases`. A claim stamps the rows with
+the worker and a lease expiry, using `SELECT ... FOR UPDATE SKIP LOCKED` on
+databases that support it and a conditional UPDATE elsewhere, so no two
+workers hold the same withdrawal. A heartbeat thread renews the leases while
+the batch runs. Leases of a crashed worker lapse and its withdrawals are
+claimed again; one it crashed on while the bank call was in flight is turned
+into a retry, which repeats the call with the same payout key. So is one
+left processing without any lease, by an executor running without leases or
+one whose payout raised, once its `scheduled_time` is `grace` seconds past.
+Every status change of a withdrawal is conditional on the status and
+attempts it was read with, see `Transaction.advance`, so even a worker that
+outlived its lease can not execute a withdrawal a second time.
+
+With a `TimingWheel` the executor does not query the table for due
+withdrawals on every poll. The wheel keeps the ids of the pending
+withdrawals scheduled within the next `window` seconds in buckets of `tick`
+seconds, fires each bucket once its time arrives and sleeps until the next
+one. Its memory and startup cost depend on the withdrawals of the next window
+only, however many are scheduled further ahead.
+
+The lag of every withdrawal the executor finishes, from its `scheduled_time`
+to its `executed_time`, is recorded in `wallets.metrics`.
 """
 
-from apscheduler.schedulers.blocking import BlockingScheduler
+import heapq
+import logging
+import os
+import socket
+import threading
+import time
+from concurrent.futures import wait
+from uuid import uuid4
+
 from django.conf import settings
-from django_apscheduler.jobstores import DjangoJobStore
+from django.db import close_old_connections, connection
+from django.db.transaction import atomic
+from django.db.models import Max, Q
+from django.utils import timezone
+
+from utils import request_third_party_batch
+from . import metrics
+from .models import Transaction
+from .payouts import CircuitBreaker, payout_client
+
+logger = logging.getLogger(__name__)
+
+
+class Leases:
+    """
+    Claims withdrawals for one worker with leases that lapse unless renewed.
+
+    Attributes:
+        owner (str): The id of the worker, unique across nodes and restarts.
+        ttl (float): Seconds a lease lasts without a heartbeat.
+        grace (float): Seconds past its `scheduled_time` a processing
+            withdrawal without a lease is left alone before it is recovered.
+    """
+
+    def __init__(self, owner=None, ttl=None, grace=None):
+        config = settings.WITHDRAWAL_EXECUTOR
+        self.owner = owner or f"{socket.gethostname()[:40]}:{os.getpid()}:{uuid4().hex[:8]}"
+        self.ttl = ttl or config['LEASE_TTL']
+        self.grace = config['RECOVERY_GRACE'] if grace is None else grace
+        self._stopped = threading.Event()
+        self._thread = None
+        self._next_recovery = 0
+
+    @staticmethod
+    def free(now):
+        return Q(lease_expires__isnull=True) | Q(lease_expires__lt=now)
+
+    def claim(self, queryset, limit) -> list:
+        """
+        Claims up to `limit` transactions of `queryset` that no live lease
+        holds, skipping those other workers are claiming, and returns them.
+        """
+        now = timezone.now().timestamp()
+        free = queryset.filter(self.free(now))
+        if connection.features.has_select_for_update_skip_locked:
+            with atomic():
+                ids = list(free.select_for_update(skip_locked=True)
+                           .values_list('pk', flat=True)[:limit])
+                claimed = Transaction.objects.filter(pk__in=ids).update(
+                    lease_owner=self.owner, lease_expires=now + self.ttl)
+        else:
+            # one statement, so the rows can not be taken between select and update
+            claimed = Transaction.objects.filter(pk__in=free.values('pk')[:limit]).update(
+                lease_owner=self.owner, lease_expires=now + self.ttl)
+        if not claimed:
+            return []
+        return list(queryset.filter(lease_owner=self.owner)[:limit])
+
+    def release(self, transactions) -> None:
+        """
+        Gives up the leases this worker holds on `transactions`.
+        """
+        Transaction.objects.filter(pk__in=[transaction.pk for transaction in transactions],
+                                   lease_owner=self.owner,
+                                   ).update(lease_owner=None, lease_expires=None)
+
+    def heartbeat(self) -> int:
+        """
+        Renews every lease this worker holds and returns their number.
+        """
+        return Transaction.objects.filter(lease_owner=self.owner).update(
+            lease_expires=timezone.now().timestamp() + self.ttl)
+
+    def recover(self) -> int:
+        """
+        Turns the withdrawals whose worker crashed while paying them out
+        into retries due now, and returns their number: those whose lease
+        lapsed, and those without a lease once `grace` seconds are past
+        their `scheduled_time`. Runs at most once per third of `ttl`.
+        """
+        now = timezone.now().timestamp()
+        if now < self._next_recovery:
+            return 0
+        self._next_recovery = now + self.ttl / 3
+        crashed = (Q(lease_expires__lt=now)
+                   | Q(lease_expires__isnull=True, scheduled_time__lt=now - self.grace))
+        return Transaction.objects.filter(crashed,
+                                          status=Transaction.Status.PROCESSING,
+                                          retry_at__isnull=True,
+                                          ).update(retry_at=now, lease_owner=None,
+                                                   lease_expires=None)
+
+    @property
+    def beating(self) -> bool:
+        return self._thread is not None
+
+    def start(self) -> None:
+        """
+        Starts renewing the leases of this worker every third of `ttl`.
+        """
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._beat, name='lease-heartbeat', daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _beat(self):
+        try:
+            while not self._stopped.wait(self.ttl / 3):
+                try:
+                    self.heartbeat()
+                except Exception:
+                    logger.exception("Renewing the leases of %s failed", self.owner)
+        finally:
+            connection.close()
+
+
+class TimingWheel:
+    """
+    An in-memory index of the pending withdrawals scheduled within the next
+    `window` seconds, bucketed by `scheduled_time`.
+
+    Every `refresh` seconds the wheel loads the withdrawals that entered the
+    window since the last load and those created since then, using the
+    pending index and the primary key. Withdrawals the wheel can not have
+    seen, because they were already overdue when it started or committed out
+    of id order, are picked up by a sweep of the table every `window`
+    seconds, which drains a backlog batch by batch.
+
+    Attributes:
+        tick (float): Seconds covered by one bucket.
+        window (float): Seconds ahead of now that are kept in memory.
+        refresh (float): Seconds between loads of new withdrawals.
+        loaded_until (float): Withdrawals scheduled before this timestamp
+            have been loaded.
+    """
+
+    def __init__(self, tick, window, refresh):
+        self.tick = tick
+        self.window = window
+        self.refresh = refresh
+        self.loaded_until = None
+        self._last_id = 0
+        self._buckets = {}
+        self._slots = []
+        self._size = 0
+        self._next_load = 0
+        self._next_sweep = 0
+
+    def __len__(self):
+        return self._size
+
+    def add(self, pk, scheduled_time) -> None:
+        slot = int(scheduled_time // self.tick)
+        bucket = self._buckets.get(slot)
+        if bucket is None:
+            bucket = self._buckets[slot] = []
+            heapq.heappush(self._slots, slot)
+        bucket.append((scheduled_time, pk))
+        self._size += 1
+
+    def load(self, now) -> int:
+        """
+        Loads the pending withdrawals scheduled from now up to `now + window`
+        that are not loaded yet, and returns their number.
+        """
+        until = now + self.window
+        pending = Transaction.objects.filter(status=Transaction.Status.PENDING,
+                                             method=Transaction.Method.WITHDRAW)
+        if self.loaded_until is None:
+            rows = pending.filter(scheduled_time__gte=now, scheduled_time__lt=until)
+            self._last_id = Transaction.objects.aggregate(last=Max('id'))['last'] or 0
+        else:
+            rows = pending.filter(Q(scheduled_time__gte=self.loaded_until,
+                                    scheduled_time__lt=until)
+                                  | Q(pk__gt=self._last_id, scheduled_time__lt=self.loaded_until))
+        loaded = 0
+        for pk, scheduled_time in rows.values_list('pk', 'scheduled_time').iterator():
+            self.add(pk, scheduled_time)
+            self._last_id = max(self._last_id, pk)
+            loaded += 1
+        self.loaded_until = until
+        self._next_load = now + self.refresh
+        return loaded
+
+    def pop_due(self, now, limit) -> list:
+        """
+        Removes and returns the ids of up to `limit` withdrawals scheduled at
+        or before `now`, earliest first.
+        """
+        due = []
+        while self._slots and self._slots[0] * self.tick <= now and len(due) < limit:
+            slot = self._slots[0]
+            bucket = sorted(self._buckets[slot])
+            ready = [entry for entry in bucket if entry[0] <= now][:limit - len(due)]
+            due += [pk for _, pk in ready]
+            rest = bucket[len(ready):]
+            self._size -= len(ready)
+            if rest:
+                self._buckets[slot] = rest
+                if len(ready) < limit and rest[0][0] > now:
+                    break
+            else:
+                heapq.heappop(self._slots)
+                del self._buckets[slot]
+        return due
+
+    def next_event(self) -> float:
+        """
+        Returns the timestamp of the next bucket or load, whichever is first.
+        """
+        if self._slots:
+            return min(self._next_load, self._slots[0] * self.tick)
+        return self._next_load
+
+    def fetch(self, limit, now=None) -> list:
+        """
+        Returns up to `limit` due pending withdrawals, loading new ones first
+        and sweeping the table when a sweep is due.
+        """
+        if now is None:
+            now = timezone.now().timestamp()
+        if now >= self._next_load:
+            self.load(now)
+        ids = self.pop_due(now, limit)
+        batch = list(Transaction.objects.due_withdrawals(now).filter(pk__in=ids)) if ids else []
+        if len(batch) < limit and now >= self._next_sweep:
+            swept = list(Transaction.objects.due_withdrawals(now)
+                         .exclude(pk__in=ids)[:limit - len(batch)])
+            if len(swept) < limit - len(batch):
+                self._next_sweep = now + self.window
+            batch += swept
+        return batch
+
+
+def build_wheel():
+    """
+    Returns the timing wheel configured in `settings.WITHDRAWAL_EXECUTOR`, or
+    None when withdrawals are polled from the table.
+    """
+    config = settings.WITHDRAWAL_EXECUTOR
+    if not config['WHEEL_WINDOW']:
+        return None
+    return TimingWheel(tick=config['WHEEL_TICK'], window=config['WHEEL_WINDOW'],
+                       refresh=config['WHEEL_REFRESH'])
+
+
+class WithdrawalExecutor:
+    """
+    Polls the `Transaction` table for due withdrawals and executes them.
+
+    Attributes:
+        batch_size (int): The maximum number of withdrawals fetched per poll.
+        poll_interval (float): Seconds to sleep when nothing is due.
+        dispatcher (PayoutDispatcher): The worker pool withdrawals run on, or
+            None to run them in the calling thread.
+        payout_batch_size (int): The number of withdrawals paid out per bank
+            call, or 0 to call the bank once per withdrawal.
+        wheel (TimingWheel): Where due withdrawals are fetched from, or None
+            to query the table on every poll.
+        leases (Leases): How withdrawals are claimed when several executors
+            share the table, or None for a single executor.
+    """
+
+    def __init__(self, batch_size=None, poll_interval=None, dispatcher=None,
+                 payout_batch_size=None, wheel=None, leases=None):
+        config = settings.WITHDRAWAL_EXECUTOR
+        self.batch_size = batch_size or config['BATCH_SIZE']
+        self.poll_interval = poll_interval or config['POLL_INTERVAL']
+        self.dispatcher = dispatcher
+        self.payout_batch_size = (config['PAYOUT_BATCH_SIZE'] if payout_batch_size is None
+                                  else payout_batch_size)
+        self.wheel = wheel
+        self.leases = leases
+        self._running = False
+
+    def fetch_batch(self) -> list:
+        """
+        Returns the next batch of due withdrawals and retries, or nothing
+        while the payout circuit breaker is open.
+        """
+        if payout_client.breaker.state == CircuitBreaker.OPEN:
+            return []
+        if self.leases is not None:
+            self.leases.recover()
+        batch = self.take(Transaction.objects.due_retries(), self.batch_size)
+        if len(batch) < self.batch_size:
+            limit = self.batch_size - len(batch)
+            if self.wheel is None:
+                batch += self.take(Transaction.objects.due_withdrawals(), limit)
+            else:
+                due = self.wheel.fetch(limit)
+                if due and self.leases is not None:
+                    due = self.take(Transaction.objects.due_withdrawals().filter(
+                        pk__in=[transaction.pk for transaction in due]), limit)
+                batch += due
+        return batch
+
+    def take(self, queryset, limit) -> list:
+        """
+        Returns up to `limit` transactions of `queryset`, claimed through
+        `leases` when there are any.
+        """
+        if self.leases is None:
+            return list(queryset[:limit])
+        return self.leases.claim(queryset, limit)
+
+    def execute(self, transaction) -> None:
+        """
+        Executes a single withdrawal, logging instead of raising so one bad
+        transaction does not stop the executor.
+        """
+        try:
+            transaction.execute_withdraw()
+            self.record_lag(transaction)
+        except ValueError as err:
+            logger.warning("Skipping transaction %s: %s", transaction.pk, err)
+        except Exception:
+            logger.exception("Withdrawal %s failed", transaction.pk)
+
+    def execute_chunk(self, chunk) -> None:
+        """
+        Reserves a chunk of withdrawals and pays them out in one bank call.
+        """
+        ready = []
+        for transaction in chunk:
+            try:
+                if transaction.prepare_withdraw():
+                    ready.append(transaction)
+            except ValueError as err:
+                logger.warning("Skipping transaction %s: %s", transaction.pk, err)
+            except Exception:
+                logger.exception("Withdrawal %s failed", transaction.pk)
+        if ready:
+            results = payout_client.call_batch(
+                request_third_party_batch,
+                [{'key': transaction.payout_key, 'amount': str(transaction.amount)}
+                 for transaction in ready])
+            for transaction in ready:
+                outcome, request_res = results[transaction.payout_key]
+                try:
+                    transaction.finish_withdraw(request_res, outcome)
+                except Exception:
+                    logger.exception("Withdrawal %s failed", transaction.pk)
+        for transaction in chunk:
+            self.record_lag(transaction)
+
+    @staticmethod
+    def record_lag(transaction) -> None:
+        """
+        Records the lag of a withdrawal that was completed or failed.
+        """
+        if transaction.executed_time is not None:
+            metrics.withdrawal_lag_seconds.observe(
+                transaction.executed_time - transaction.scheduled_time,
+                str(transaction.get_status_display()))
 
-scheduler = BlockingScheduler(timezone=settings.TIME_ZONE)
-scheduler.add_jobstore(DjangoJobStore(), "default")
+    def run_once(self) -> int:
+        """
+        Executes one batch of due withdrawals and returns its size. The
+        leases of the batch are renewed while it runs, by the heartbeat of
+        `run_forever` or by one started for this batch.
+        """
+        batch = self.fetch_batch()
+        heartbeat = bool(batch) and self.leases is not None and not self.leases.beating
+        if heartbeat:
+            self.leases.start()
+        if self.payout_batch_size:
+            execute = self.execute_chunk
+            tasks = [batch[start:start + self.payout_batch_size]
+                     for start in range(0, len(batch), self.payout_batch_size)]
+        else:
+            execute, tasks = self.execute, batch
+        try:
+            if self.dispatcher is None:
+                for task in tasks:
+                    execute(task)
+            else:
+                wait([self.dispatcher.submit(execute, task) for task in tasks])
+        finally:
+            if heartbeat:
+                self.leases.stop()
+            if self.leases is not None and batch:
+                self.leases.release(batch)
+        return len(batch)
 
+    def run_forever(self) -> None:
+        """
+        Polls and executes due withdrawals until `stop` is called.
+        """
+        self._running = True
+        if self.leases is not None:
+            self.leases.start()
+        try:
+            while self._running:
+                close_old_connections()
+                executed = self.run_once()
+                if executed:
+                    logger.info("Executed %s withdrawals, payouts %s",
+                                executed, payout_client.metrics())
+                if executed < self.batch_size:
+                    time.sleep(self.idle_time())
+        finally:
+            if self.leases is not None:
+                self.leases.stop()
 
-def define_schedule_job(my_job, schedule, _id):
-    scheduler.add_job(my_job,
-                      trigger='date',
-                      id=_id,
-                      run_date=schedule,
-                      replace_existing=True)
+    def idle_time(self) -> float:
+        """
+        Returns the seconds to sleep when nothing was due: `poll_interval`,
+        or less when the wheel fires or loads earlier.
+        """
+        if self.wheel is None:
+            return self.poll_interval
+        wait_for = self.wheel.next_event() - timezone.now().timestamp()
+        return max(0.0, min(self.poll_interval, wait_for))
 
-    try:
-        print("Starting scheduler...")
-        scheduler.start()
-    except Exception as err:
-        scheduler.get_jobs()
\ No newline at end of file
+    def stop(self) -> None:
+        self._running = False
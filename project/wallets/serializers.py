@@ -1,11 +1,18 @@
-from datetime import timedelta, datetime
+import uuid
+from collections import defaultdict
+from datetime import timedelta
+from decimal import Decimal
 
+from django.conf import settings
 from django.contrib.auth.models import User
+from django.db import connection
+from django.db.models import Max
+from django.db.transaction import atomic
 from django.utils import timezone
 from rest_framework import serializers
 
+from .coalesce import deposit_coalescer
 from .models import Wallet, Transaction
-from .scheduler import define_schedule_job
 
 
 class UserSerializer(serializers.ModelSerializer):
@@ -35,6 +42,31 @@ class WalletSerializer(serializers.HyperlinkedModelSerializer):
         ]
         read_only_fields = ('uuid',)
 
+    def update(self, instance, validated_data):
+        """
+        Updates the wallet. A new `balance` is applied as a ledger
+        adjustment instead of saving the balance read with the instance.
+        """
+        balance = validated_data.pop('balance', None)
+        with atomic():
+            if validated_data:
+                for attr, value in validated_data.items():
+                    setattr(instance, attr, value)
+                instance.save(update_fields=[*validated_data, 'updated_at'])
+            if balance is not None:
+                Wallet.objects.adjust(instance.pk, balance)
+                instance.refresh_from_db(fields=['balance'])
+        return instance
+
+    def to_representation(self, instance):
+        """
+        Represents the balance of a sharded wallet including its shards.
+        """
+        data = super().to_representation(instance)
+        if instance.shard_count:
+            data['balance'] = self.fields['balance'].to_representation(instance.total_balance)
+        return data
+
 
 class ChoicesField(serializers.ChoiceField):
 
@@ -42,6 +74,130 @@ class ChoicesField(serializers.ChoiceField):
         return self.choices.get(value)
 
 
+class WalletField(serializers.PrimaryKeyRelatedField):
+    """
+    A `PrimaryKeyRelatedField` for wallets that looks them up in the
+    `wallets` dict of the serializer context when one is present, so a list
+    of transactions resolves its wallets with a single query.
+    """
+
+    def to_internal_value(self, data):
+        wallets = self.context.get('wallets')
+        if wallets is None:
+            return super().to_internal_value(data)
+        try:
+            return wallets[uuid.UUID(str(data))]
+        except KeyError:
+            self.fail('does_not_exist', pk_value=data)
+        except ValueError:
+            self.fail('incorrect_type', data_type=type(data).__name__)
+
+
+class TransactionListSerializer(serializers.ListSerializer):
+    """
+    List serializer for bulk transaction creation.
+
+    Unlike the default `ListSerializer`, an invalid item does not reject the
+    whole list: every item is validated on its own, the valid ones become
+    `validated_data` and the errors of the others are kept in `item_errors`
+    by their index. `valid_indexes` holds the index of each valid item.
+
+    `create` inserts all transactions with `bulk_create` and applies the
+    deposits as one balance UPDATE per wallet, with a ledger entry per
+    deposit. Transfers are executed one by
+    one afterwards, in request order. Withdrawals are stored as pending for
+    the withdrawal executor.
+    """
+
+    def to_internal_value(self, data):
+        if not isinstance(data, list):
+            message = self.error_messages['not_a_list'].format(input_type=type(data).__name__)
+            raise serializers.ValidationError({'non_field_errors': [message]},
+                                              code='not_a_list')
+        if self.max_length is not None and len(data) > self.max_length:
+            message = self.error_messages['max_length'].format(max_length=self.max_length)
+            raise serializers.ValidationError({'non_field_errors': [message]},
+                                              code='max_length')
+        self.context['wallets'] = self.prefetch_wallets(data)
+        self.item_errors = {}
+        self.valid_indexes = []
+        validated = []
+        for index, item in enumerate(data):
+            try:
+                validated.append(self.child.run_validation(item))
+            except serializers.ValidationError as exc:
+                self.item_errors[index] = exc.detail
+            else:
+                self.valid_indexes.append(index)
+        return validated
+
+    @staticmethod
+    def prefetch_wallets(data) -> dict:
+        """
+        Returns the wallets referenced by the items, keyed by uuid.
+        """
+        ids = set()
+        for item in data:
+            for field in ('wallet', 'counterparty'):
+                try:
+                    ids.add(uuid.UUID(str(item[field])))
+                except (KeyError, TypeError, ValueError):
+                    continue
+        return Wallet.objects.in_bulk(ids)
+
+    def create(self, validated_data):
+        now = timezone.now().timestamp()
+        transactions = [Transaction(**attrs) for attrs in validated_data]
+        deposits = defaultdict(list)
+        for transaction in transactions:
+            if transaction.method == Transaction.Method.DEPOSIT:
+                transaction.status = Transaction.Status.COMPLETED
+                transaction.status_description = "deposited successfully"
+                transaction.executed_time = now
+                deposits[transaction.wallet_id].append(transaction)
+        transfers = [attrs for attrs in validated_data
+                     if attrs['method'] == Transaction.Method.TRANSFER]
+        transactions = [transaction for transaction in transactions
+                        if transaction.method != Transaction.Method.TRANSFER]
+        with atomic():
+            self.insert(transactions)
+            for wallet_id, wallet_deposits in deposits.items():
+                Wallet.objects.credit_all(wallet_id, wallet_deposits)
+        created = iter(transactions)
+        executed = []
+        for attrs in validated_data:
+            if attrs['method'] != Transaction.Method.TRANSFER:
+                executed.append(next(created))
+                continue
+            with atomic():
+                transfer = Transaction.objects.create(**attrs)
+                transfer.execute_transfer()
+            executed.append(transfer)
+        return executed
+
+    @staticmethod
+    def insert(transactions) -> None:
+        """
+        Inserts `transactions` with `bulk_create` and sets their primary
+        keys. SQLite does not return them from a bulk insert on Django 3.2,
+        but a transaction that has written holds its write lock until it
+        commits, so the rows of the batch hold the last ids of the table.
+        Other such databases insert row by row.
+        """
+        if connection.features.can_return_rows_from_bulk_insert:
+            Transaction.objects.bulk_create(transactions, batch_size=1000)
+            return
+        if connection.vendor != 'sqlite':
+            for transaction in transactions:
+                transaction.save(force_insert=True)
+            return
+        with atomic(savepoint=False):
+            Transaction.objects.bulk_create(transactions, batch_size=1000)
+            last = Transaction.objects.aggregate(last=Max('id'))['last']
+        for pk, transaction in enumerate(transactions, start=last - len(transactions) + 1):
+            transaction.pk = pk
+
+
 class TransactionSerializer(serializers.ModelSerializer):
     """
     Serializer for the Transaction model.
@@ -53,14 +209,18 @@ class TransactionSerializer(serializers.ModelSerializer):
     `Transaction` object.
     """
 
+    wallet = WalletField(queryset=Wallet.objects.all())
+    counterparty = WalletField(queryset=Wallet.objects.all(), required=False, allow_null=True)
     status = ChoicesField(Transaction.Status.choices, read_only=True)
     method = ChoicesField(Transaction.Method.choices)
 
     class Meta:
         model = Transaction
+        list_serializer_class = TransactionListSerializer
         fields = [
             'id',
             'wallet',
+            'counterparty',
             'amount',
             'scheduled_time',
             'executed_time',
@@ -75,35 +235,112 @@ class TransactionSerializer(serializers.ModelSerializer):
         Validates the `scheduled_time` field to ensure it is in the future.
 
         Raises a `ValidationError` if the `scheduled_time` is in the past.
-        If the transaction `method` is a withdrawal and no `scheduled_time`
-        is provided, a default value of one minute in the future is used.
         """
         if value and value < timezone.now().timestamp():
             raise serializers.ValidationError("scheduled_time must be larger than now")
-        if request := self.context.get('request'):
-            method = request.data.get('method')
-            if method == "1" and value is None:
-                default = timezone.now() + timedelta(minutes=1)
-                return default.timestamp()
         return value
 
+    def validate(self, attrs):
+        """
+        Defaults the `scheduled_time` of a withdrawal to one minute in the
+        future when it is omitted, so every withdrawal is picked up by the
+        withdrawal executor. A transfer needs a `counterparty` other than its
+        `wallet`; other methods take none.
+        """
+        counterparty = attrs.get('counterparty')
+        if attrs.get('method') == Transaction.Method.TRANSFER:
+            if counterparty is None:
+                raise serializers.ValidationError(
+                    {'counterparty': "A transfer needs a counterparty."})
+            if counterparty == attrs.get('wallet'):
+                raise serializers.ValidationError(
+                    {'counterparty': "A wallet can not transfer to itself."})
+        elif counterparty is not None:
+            raise serializers.ValidationError(
+                {'counterparty': "Only transfers have a counterparty."})
+        if (attrs.get('method') == Transaction.Method.WITHDRAW
+                and attrs.get('scheduled_time') is None):
+            default = timezone.now() + timedelta(minutes=1)
+            attrs['scheduled_time'] = default.timestamp()
+        return attrs
+
     def save(self, **kwargs):
         """
-        Saves the transaction object and schedules a job for a future withdrawal.
+        Saves the transaction object.
 
         If the `method` field is "0" (deposit), the `execute_deposit` method of the
-        transaction instance is called.
-        If the `method` field is "1" (withdrawal), a job is scheduled to call the
-        `execute_withdraw` method of the transaction instance in the future.
+        transaction instance is called, or the deposit is batched with
+        concurrent ones by `deposit_coalescer` when `DEPOSIT_COALESCING` is enabled.
+        If the `method` field is "1" (withdrawal), the transaction is stored as
+        pending and picked up by the withdrawal executor once its
+        `scheduled_time` arrives.
+        If the `method` field is "2" (transfer), the transaction is created and
+        its `execute_transfer` method called in one database transaction, so
+        no transfer is left pending.
         """
-        instance = super().save()
         method = self.validated_data.get('method')
+        if method == "2":
+            with atomic():
+                instance = super().save(**kwargs)
+                instance.execute_transfer()
+            return instance
+        instance = super().save(**kwargs)
         if method == "0":
-            self.instance.execute_deposit()
-        else:
-            job = self.instance.execute_withdraw
-            _id = str(self.instance.id)
-            schedule = self.instance.scheduled_time
-            schedule = datetime.fromtimestamp(schedule)
-            define_schedule_job(job, schedule, (_id))
+            if settings.DEPOSIT_COALESCING['ENABLED']:
+                deposit_coalescer.execute(self.instance)
+            else:
+                self.instance.execute_deposit()
         return instance
+
+
+CENT = Decimal("0.01")
+
+
+def cents(value) -> str:
+    """
+    Formats an amount like the `DecimalField`s of the serializers.
+    """
+    return f'{value.quantize(CENT):f}'
+
+
+# columns `transaction_rows` reads, see `TransactionViewSet.list`
+TRANSACTION_ROW_FIELDS = TransactionSerializer.Meta.fields
+
+
+def transaction_rows(rows) -> list:
+    """
+    Represents transactions read with `values(*TRANSACTION_ROW_FIELDS)` as
+    `TransactionSerializer` does, without building model instances or
+    running every field of the serializer on every row.
+    """
+    methods = {value: str(label) for value, label in Transaction.Method.choices}
+    statuses = {value: str(label) for value, label in Transaction.Status.choices}
+    return [{
+        'id': row['id'],
+        'wallet': str(row['wallet']),
+        'counterparty': None if row['counterparty'] is None else str(row['counterparty']),
+        'amount': cents(row['amount']),
+        'scheduled_time': None if row['scheduled_time'] is None else int(row['scheduled_time']),
+        'executed_time': None if row['executed_time'] is None else int(row['executed_time']),
+        'method': methods.get(row['method']),
+        'status': statuses.get(row['status']),
+        'status_description': row['status_description'],
+    } for row in rows]
+
+
+# columns `wallet_rows` reads from `Wallet.objects.with_shard_balance()`
+WALLET_ROW_FIELDS = ('uuid', 'balance', 'shard_count', 'shard_balance', 'owner', 'created_at')
+
+
+def wallet_rows(rows, owner_url) -> list:
+    """
+    Represents wallets read with `values(*WALLET_ROW_FIELDS)` as
+    `WalletSerializer` does. `owner_url` returns the hyperlink of an owner by
+    its primary key.
+    """
+    return [{
+        'uuid': str(row['uuid']),
+        'balance': cents(row['balance'] + row['shard_balance'] if row['shard_count']
+                         else row['balance']),
+        'owner': owner_url(row['owner']),
+    } for row in rows]
@@ -0,0 +1,195 @@
+"""
+This module streams the transaction history of a wallet as CSV or NDJSON,
+served by `GET /wallets/wallets/{uuid}/statement/`.
+
+The history holds the transactions of the wallet and the transfers it
+received, which carry the wallet as `counterparty`. Rows are read with a
+server-side iterator, `chunk_size` at a time, and written out one chunk at a
+time, so memory stays constant however long the history is. Rows come in
+`id` order.
+
+The history can be limited to a range of `scheduled_time` and
+`executed_time`. Bounds are inclusive and given either as timestamps or as
+ISO 8601 dates or datetimes.
+
+Under ASGI, Django 3.2 iterates streaming responses on the event loop, where
+queries are not allowed. `stream` detects that and reads the rows in a
+worker thread instead, handing the chunks over through a bounded queue. The
+loop, and every other request of the worker, still waits for each chunk, so
+serve statements with WSGI.
+"""
+
+import asyncio
+import csv
+import io
+import json
+import queue
+import threading
+from datetime import datetime, time
+
+from django.conf import settings
+from django.db import connection
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+from rest_framework.exceptions import ValidationError
+
+from .models import Transaction
+
+COLUMNS = ['id', 'wallet', 'counterparty', 'amount', 'method', 'status',
+           'status_description', 'scheduled_time', 'executed_time']
+
+# query parameter, field lookup
+FILTERS = {
+    'scheduled_from': 'scheduled_time__gte',
+    'scheduled_to': 'scheduled_time__lte',
+    'executed_from': 'executed_time__gte',
+    'executed_to': 'executed_time__lte',
+}
+
+OUTPUTS = ('csv', 'ndjson')
+
+
+def parse_bound(name, value) -> int:
+    """
+    Returns the timestamp of a range bound given as a timestamp or as an ISO
+    8601 date or datetime. A date given as an upper bound means its end.
+    """
+    try:
+        return int(value)
+    except ValueError:
+        pass
+    try:
+        when = parse_datetime(value)
+        if when is None:
+            day = parse_date(value)
+            if day is not None:
+                when = datetime.combine(day, time.max if name.endswith('_to') else time.min)
+    except ValueError:
+        when = None
+    if when is None:
+        raise ValidationError({name: "Expected a timestamp or an ISO 8601 date or datetime."})
+    if timezone.is_naive(when):
+        when = timezone.make_aware(when)
+    return int(when.timestamp())
+
+
+def parse_filters(params) -> dict:
+    """
+    Returns the field lookups of the range filters in `params`.
+    """
+    return {lookup: parse_bound(name, params[name])
+            for name, lookup in FILTERS.items() if params.get(name)}
+
+
+def statement_rows(wallet, filters=None, chunk_size=None):
+    """
+    Yields the transactions of `wallet` and the transfers it received as
+    dicts of `COLUMNS`, oldest first.
+    """
+    chunk_size = chunk_size or settings.STATEMENT_CHUNK_SIZE
+    methods = {value: str(label) for value, label in Transaction.Method.choices}
+    statuses = {value: str(label) for value, label in Transaction.Status.choices}
+    rows = (Transaction.objects.filter(Q(wallet=wallet) | Q(counterparty=wallet),
+                                       **(filters or {}))
+            .order_by('id').values_list(*COLUMNS).iterator(chunk_size=chunk_size))
+    for row in rows:
+        row = dict(zip(COLUMNS, row))
+        row['wallet'] = str(row['wallet'])
+        if row['counterparty'] is not None:
+            row['counterparty'] = str(row['counterparty'])
+        row['amount'] = str(row['amount'])
+        row['method'] = methods[row['method']]
+        row['status'] = statuses[row['status']]
+        yield row
+
+
+def chunks(rows, size):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def csv_stream(rows, chunk_size=None):
+    """
+    Yields the header and then `rows` as CSV, one string per chunk.
+    """
+    chunk_size = chunk_size or settings.STATEMENT_CHUNK_SIZE
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=COLUMNS)
+    writer.writeheader()
+    yield buffer.getvalue()
+    for chunk in chunks(rows, chunk_size):
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerows(chunk)
+        yield buffer.getvalue()
+
+
+def ndjson_stream(rows, chunk_size=None):
+    """
+    Yields `rows` as one JSON object per line, one string per chunk.
+    """
+    chunk_size = chunk_size or settings.STATEMENT_CHUNK_SIZE
+    for chunk in chunks(rows, chunk_size):
+        yield ''.join(json.dumps(row) + '\n' for row in chunk)
+
+
+def stream(make_chunks):
+    """
+    Yields the chunks of `make_chunks()`, producing them in a worker thread
+    when iterated on an event loop.
+    """
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        yield from make_chunks()
+    else:
+        yield from in_worker_thread(make_chunks)
+
+
+def in_worker_thread(make_chunks, maxsize=2):
+    """
+    Yields the chunks of `make_chunks()` produced by a worker thread, which
+    runs at most `maxsize` chunks ahead and stops once iteration stops.
+    """
+    chunks = queue.Queue(maxsize)
+    stopped = threading.Event()
+    done = object()
+
+    def put(item) -> bool:
+        while not stopped.is_set():
+            try:
+                chunks.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for chunk in make_chunks():
+                if not put(chunk):
+                    return
+            put(done)
+        except Exception as err:
+            put(err)
+        finally:
+            connection.close()
+
+    threading.Thread(target=produce, daemon=True).start()
+    try:
+        while True:
+            item = chunks.get()
+            if item is done:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        stopped.set()
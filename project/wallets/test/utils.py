@@ -0,0 +1,30 @@
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+
+class QueryCountMixin:
+    """
+    Assertions for list endpoints whose number of queries must not grow with
+    the number of rows on the page.
+    """
+
+    def count_queries(self, get):
+        """
+        Calls `get` and returns the number of queries it ran.
+        """
+        with CaptureQueriesContext(connection) as queries:
+            response = get()
+        self.assertEqual(response.status_code, 200)
+        return len(queries)
+
+    def assertConstantQueries(self, get, add_rows, small=1, large=5):
+        """
+        Asserts that `get` runs as many queries once `add_rows` has added
+        `large` rows as it does with `small` rows.
+        """
+        add_rows(small)
+        few = self.count_queries(get)
+        add_rows(large - small)
+        many = self.count_queries(get)
+        self.assertEqual(few, many,
+                         f"{many} queries for {large} rows but {few} for {small}")
@@ -1,12 +1,50 @@
+import asyncio
+import io
+import json
+import multiprocessing
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
 from decimal import Decimal
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock, skipUnless
+from uuid import uuid4
 
+from asgiref.sync import sync_to_async
+
+import django.test
+from django.conf import settings
 from django.contrib.auth.models import User
-from django.test import TestCase
+from django.core.cache import caches
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.core.cache.backends.locmem import LocMemCache
+from django.test import AsyncClient, SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
 from rest_framework import status
+from rest_framework.renderers import JSONRenderer
 from rest_framework.test import APIClient
+from rest_framework.viewsets import GenericViewSet
 
-from wallets.models import Wallet, Transaction
-from utils import request_third_party_deposit
+from wallets import ledger, metrics, statements
+from wallets.bench import seed, torture
+from wallets.cache import TTLCache, WalletCache, wallet_cache
+from wallets.coalesce import DepositCoalescer, deposit_coalescer
+from wallets.dispatch import PayoutDispatcher
+from wallets.models import BalanceShard, BalanceSnapshot, LedgerEntry, Wallet, Transaction
+from wallets.renderers import FastJSONRenderer
+from wallets.payouts import CircuitBreaker, Outcome, RetryPolicy, classify, payout_client
+from wallets.scheduler import Leases, TimingWheel, WithdrawalExecutor
+from wallets.test.utils import QueryCountMixin
+from wallets.views import RowListMixin, TransactionViewSet, WalletViewSet, idempotency_cache
+from utils import (BankClient, bank_client, request_third_party_batch,
+                   request_third_party_deposit, send_third_party_deposit)
 
 
 class WalletTestCase(TestCase):
@@ -35,6 +73,38 @@ class WalletTestCase(TestCase):
         self.assertEqual(success, False)
         self.assertEqual(self.wallet.balance, Decimal("0.00"))
 
+    def test_deposit_from_stale_instances_is_not_lost(self):
+        stale = Wallet.objects.get(pk=self.wallet.pk)
+        self.wallet.deposit("100.00")
+        stale.deposit("50.00")
+        self.assertEqual(stale.balance, Decimal("150.00"))
+        self.assertEqual(Wallet.objects.get(pk=self.wallet.pk).balance, Decimal("150.00"))
+
+    def test_withdraw_checks_committed_balance(self):
+        self.wallet.deposit("100.00")
+        stale = Wallet.objects.get(pk=self.wallet.pk)
+        self.wallet.withdraw("80.00", lambda: {'data': 'success', 'status': 200})
+        message, success = stale.withdraw("80.00", lambda: {'data': 'success', 'status': 200})
+        self.assertEqual(message, "Insufficient funds.")
+        self.assertEqual(success, False)
+        self.assertEqual(stale.balance, Decimal("20.00"))
+
+    def test_withdraw_failed_third_party_returns_funds(self):
+        self.wallet.deposit("100.00")
+        message, success = self.wallet.withdraw("80.00", lambda: {'data': 'failed', 'status': 503})
+        self.assertEqual(success, False)
+        self.assertEqual(self.wallet.balance, Decimal("100.00"))
+
+    def test_amounts_do_not_drift_off_the_cent(self):
+        self.wallet.deposit("1.00")
+        self.assertTrue(Wallet.objects.reserve(self.wallet.pk, "0.30"))
+        self.assertTrue(Wallet.objects.settle(self.wallet.pk, "0.10"))
+        # 0.30 - 0.10 must still cover 0.20 where decimals are added as floats
+        self.assertTrue(Wallet.objects.settle(self.wallet.pk, "0.20"))
+        self.assertTrue(Wallet.objects.debit(self.wallet.pk, "0.70"))
+        self.wallet.refresh_from_db()
+        self.assertEqual((self.wallet.balance, self.wallet.held), (Decimal("0.00"), Decimal("0.00")))
+
     def test_withdraw_success(self):
         deposit_amount = "200.00"
         self.wallet.deposit(deposit_amount)
@@ -50,6 +120,7 @@ class WalletTestCase(TestCase):
 
 class TransactionTestCase(TestCase):
     def setUp(self):
+        payout_client.reset()
         self.user = User.objects.create_user(
             username='testuser'
         )
@@ -66,6 +137,122 @@ class TransactionTestCase(TestCase):
         self.assertEqual(transaction.status_description, "deposited successfully")
         self.assertEqual(self.wallet.balance, Decimal("600.50"))
 
+    def create_due_withdraw(self, amount):
+        return Transaction.objects.create(wallet=self.wallet,
+                                          amount=Decimal(amount),
+                                          method=Transaction.Method.WITHDRAW,
+                                          scheduled_time=timezone.now().timestamp() - 1)
+
+    def test_withdraw_transaction_reserves_during_third_party_call(self):
+        transaction = self.create_due_withdraw("100.00")
+        seen = {}
+
+        def third_party(**kwargs):
+            seen['wallet'] = Wallet.objects.values('balance', 'held').get(pk=self.wallet.pk)
+            seen['status'] = Transaction.objects.get(pk=transaction.pk).status
+            return {'data': 'success', 'status': 200}
+
+        with mock.patch('wallets.models.request_third_party_deposit', third_party):
+            transaction.execute_withdraw()
+        self.assertEqual(seen['wallet'], {'balance': Decimal("400.00"), 'held': Decimal("100.00")})
+        self.assertEqual(seen['status'], Transaction.Status.PROCESSING)
+        self.assertEqual(transaction.status, Transaction.Status.COMPLETED)
+        wallet = Wallet.objects.get(pk=self.wallet.pk)
+        self.assertEqual((wallet.balance, wallet.held), (Decimal("400.00"), Decimal("0.00")))
+
+    def test_cent_withdrawals_settle_their_whole_reservation(self):
+        Wallet.objects.filter(pk=self.wallet.pk).update(balance=Decimal("0.30"))
+        withdrawals = [self.create_due_withdraw(amount) for amount in ("0.10", "0.20")]
+        for transaction in withdrawals:
+            self.assertTrue(transaction.prepare_withdraw())
+        for transaction in withdrawals:
+            transaction.finish_withdraw({'data': 'success', 'status': 200})
+            self.assertEqual(transaction.status, Transaction.Status.COMPLETED)
+        wallet = Wallet.objects.get(pk=self.wallet.pk)
+        self.assertEqual((wallet.balance, wallet.held), (Decimal("0.00"), Decimal("0.00")))
+
+    @mock.patch('wallets.models.request_third_party_deposit',
+                return_value={'data': 'failed', 'status': 400})
+    def test_withdraw_transaction_failed_third_party_returns_funds(self, _):
+        transaction = self.create_due_withdraw("100.00")
+        transaction.execute_withdraw()
+        transaction.refresh_from_db()
+        self.assertEqual(transaction.status, Transaction.Status.FAILED)
+        self.assertEqual(transaction.status_description, "failed")
+        self.assertIsNotNone(transaction.executed_time)
+        wallet = Wallet.objects.get(pk=self.wallet.pk)
+        self.assertEqual((wallet.balance, wallet.held), (Decimal("500.00"), Decimal("0.00")))
+
+    def test_withdraw_transaction_retryable_failure_keeps_reservation(self):
+        transaction = self.create_due_withdraw("100.00")
+        with mock.patch('wallets.models.request_third_party_deposit',
+                        return_value={'data': 'failed', 'status': 503}):
+            transaction.execute_withdraw()
+        transaction.refresh_from_db()
+        self.assertEqual(transaction.status, Transaction.Status.PROCESSING)
+        self.assertEqual(transaction.attempts, 1)
+        self.assertIsNotNone(transaction.retry_at)
+        wallet = Wallet.objects.get(pk=self.wallet.pk)
+        self.assertEqual((wallet.balance, wallet.held), (Decimal("400.00"), Decimal("100.00")))
+
+        Transaction.objects.filter(pk=transaction.pk).update(retry_at=timezone.now().timestamp())
+        self.assertEqual(list(Transaction.objects.due_retries()), [transaction])
+        transaction.refresh_from_db()
+        with mock.patch('wallets.models.request_third_party_deposit',
+                        return_value={'data': 'success', 'status': 200}) as third_party:
+            transaction.execute_withdraw()
+        third_party.assert_called_once_with(idempotency_key=transaction.payout_key)
+        self.assertEqual(transaction.status, Transaction.Status.COMPLETED)
+        self.assertEqual(transaction.attempts, 2)
+        self.assertIsNone(transaction.retry_at)
+        wallet = Wallet.objects.get(pk=self.wallet.pk)
+        self.assertEqual((wallet.balance, wallet.held), (Decimal("400.00"), Decimal("0.00")))
+
+    def test_withdraw_transaction_retries_are_exhausted(self):
+        transaction = self.create_due_withdraw("100.00")
+        transaction.attempts = payout_client.policy.max_attempts - 1
+        transaction.save(update_fields=['attempts'])
+        with mock.patch('wallets.models.request_third_party_deposit', return_value={}):
+            transaction.execute_withdraw()
+        self.assertEqual(transaction.status, Transaction.Status.FAILED)
+        self.assertEqual(Wallet.objects.get(pk=self.wallet.pk).balance, Decimal("500.00"))
+        self.assertEqual(payout_client.metrics()['payouts_retries_exhausted'], 1)
+
+    def test_withdraw_transaction_rejected_by_open_breaker(self):
+        transaction = self.create_due_withdraw("100.00")
+        with mock.patch.object(payout_client.breaker, 'allow', return_value=False), \
+                mock.patch('wallets.models.request_third_party_deposit') as third_party:
+            transaction.execute_withdraw()
+        third_party.assert_not_called()
+        self.assertEqual(transaction.status, Transaction.Status.PROCESSING)
+        self.assertEqual(transaction.attempts, 0)
+        self.assertIsNotNone(transaction.retry_at)
+
+    def test_withdraw_transaction_insufficient_funds(self):
+        transaction = self.create_due_withdraw("600.00")
+        with mock.patch('wallets.models.request_third_party_deposit') as third_party:
+            transaction.execute_withdraw()
+        third_party.assert_not_called()
+        self.assertEqual(transaction.status, Transaction.Status.FAILED)
+        self.assertEqual(transaction.status_description, "Insufficient funds.")
+        self.assertEqual(Wallet.objects.get(pk=self.wallet.pk).balance, Decimal("500.00"))
+
+    def test_withdraw_transaction_sends_idempotency_key(self):
+        transaction = self.create_due_withdraw("100.00")
+        with mock.patch('wallets.models.request_third_party_deposit',
+                        return_value={'data': 'success', 'status': 200}) as third_party:
+            transaction.execute_withdraw()
+        third_party.assert_called_once_with(idempotency_key=f"transaction-{transaction.pk}")
+
+    def test_withdraw_transaction_runs_once(self):
+        transaction = self.create_due_withdraw("100.00")
+        with mock.patch('wallets.models.request_third_party_deposit',
+                        return_value={'data': 'success', 'status': 200}):
+            transaction.execute_withdraw()
+            with self.assertRaises(ValueError):
+                transaction.execute_withdraw()
+        self.assertEqual(Wallet.objects.get(pk=self.wallet.pk).balance, Decimal("400.00"))
+
 
 class WalletViewSetTest(TestCase):
     def setUp(self):
@@ -85,6 +272,7 @@ class WalletViewSetTest(TestCase):
         response = self.client.patch(f'/wallets/wallets/{self.wallet.uuid}/', data=data)
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertEqual(Wallet.objects.get(uuid=self.wallet.uuid).balance, 1000.00)
+        self.assertEqual(list(ledger.verify()), [])
 
     def test_list_wallets(self):
         self.client.force_authenticate(user=self.user)
@@ -93,6 +281,152 @@ class WalletViewSetTest(TestCase):
         self.assertGreaterEqual(len(response.data), 1)
 
 
+class AsyncViewsTest(TestCase):
+    def setUp(self):
+        self.async_client = AsyncClient()
+        self.user = User.objects.create_user(username='testuser')
+        self.wallet = Wallet.objects.create(owner=self.user, balance=Decimal("100.00"))
+
+    async def test_retrieve_wallet_matches_viewset(self):
+        response = await self.async_client.get(f'/wallets/async/wallets/{self.wallet.uuid}/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        expected = await sync_to_async(APIClient().get)(f'/wallets/wallets/{self.wallet.uuid}/')
+        self.assertEqual(response.json(), expected.json())
+
+    async def test_missing_wallet(self):
+        response = await self.async_client.get(f'/wallets/async/wallets/{uuid4()}/')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    async def test_create_and_retrieve_transaction(self):
+        data = {'wallet': str(self.wallet.uuid), 'amount': '20.00', 'method': '0'}
+        response = await self.async_client.post('/wallets/async/transactions/', data,
+                                                content_type='application/json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        created = response.json()
+        self.assertEqual(created['status'], 'COMPLETED')
+        response = await self.async_client.get(f"/wallets/async/transactions/{created['id']}/")
+        self.assertEqual(response.json(), created)
+        expected = await sync_to_async(APIClient().get)(f"/wallets/transactions/{created['id']}/")
+        self.assertEqual(expected.json(), created)
+
+    async def test_invalid_transaction(self):
+        response = await self.async_client.post('/wallets/async/transactions/',
+                                                {'wallet': str(self.wallet.uuid)},
+                                                content_type='application/json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('method', response.json())
+        response = await self.async_client.post('/wallets/async/transactions/', 'nope',
+                                                content_type='application/json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = await self.async_client.put('/wallets/async/transactions/')
+        self.assertEqual(response.status_code, status.HTTP_405_METHOD_NOT_ALLOWED)
+
+    async def test_idempotency_key_is_shared_with_viewset(self):
+        idempotency_cache.clear()
+        data = {'wallet': str(self.wallet.uuid), 'amount': '20.00', 'method': '0'}
+        first = await self.async_client.post('/wallets/async/transactions/', data,
+                                             content_type='application/json',
+                                             **{'Idempotency-Key': 'async-key'})
+        idempotency_cache.clear()
+        retry = await self.async_client.post('/wallets/async/transactions/', data,
+                                             content_type='application/json',
+                                             **{'Idempotency-Key': 'async-key'})
+        self.assertEqual(retry['Idempotent-Replayed'], 'true')
+        self.assertEqual(retry.json(), first.json())
+        sync_retry = await sync_to_async(APIClient().post)('/wallets/transactions/', data,
+                                                           format='json',
+                                                           HTTP_IDEMPOTENCY_KEY='async-key')
+        self.assertEqual(sync_retry.json(), first.json())
+        balance = await sync_to_async(Wallet.objects.values_list('balance', flat=True).get)(
+            pk=self.wallet.pk)
+        self.assertEqual(balance, Decimal("120.00"))
+
+
+class StatementTest(QueryCountMixin, TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.user = User.objects.create_user(username='testuser')
+        self.wallet = Wallet.objects.create(owner=self.user)
+        other = Wallet.objects.create(owner=User.objects.create_user(username='other'))
+        Transaction.objects.create(wallet=other, amount=Decimal("1.00"), method="0")
+        self.url = f'/wallets/wallets/{self.wallet.uuid}/statement/'
+        self.day = int(timezone.datetime(2023, 3, 1, 12, tzinfo=timezone.utc).timestamp())
+
+    def add_rows(self, count):
+        Transaction.objects.bulk_create(
+            Transaction(wallet=self.wallet, amount=Decimal("2.50"), method="1", status="1",
+                        scheduled_time=self.day + i * 86400, executed_time=self.day + i * 86400)
+            for i in range(count))
+
+    def stream(self, url):
+        response = self.client.get(url)
+        response.text = b''.join(response.streaming_content).decode()
+        return response
+
+    def test_csv(self):
+        self.add_rows(3)
+        response = self.stream(self.url)
+        self.assertEqual(response['Content-Type'], 'text/csv')
+        self.assertIn(f'statement-{self.wallet.uuid}.csv', response['Content-Disposition'])
+        lines = response.text.splitlines()
+        self.assertEqual(lines[0], 'id,wallet,counterparty,amount,method,status,'
+                                   'status_description,scheduled_time,executed_time')
+        self.assertEqual(len(lines), 4)
+        self.assertTrue(lines[1].endswith(
+            f',{self.wallet.uuid},,2.50,WITHDRAW,COMPLETED,,{self.day},{self.day}'))
+
+    def test_ndjson_and_date_filters(self):
+        self.add_rows(5)
+        response = self.stream(f'{self.url}?output=ndjson&scheduled_from=2023-03-02'
+                               f'&executed_to={self.day + 3 * 86400}')
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        rows = [json.loads(line) for line in response.text.splitlines()]
+        self.assertEqual([row['scheduled_time'] for row in rows],
+                         [self.day + i * 86400 for i in (1, 2, 3)])
+        self.assertEqual(rows[0]['amount'], "2.50")
+        response = self.stream(f'{self.url}?output=ndjson&scheduled_to=2023-03-02')
+        self.assertEqual(len(response.text.splitlines()), 2)
+
+    def test_invalid_parameters(self):
+        self.assertEqual(self.client.get(f'{self.url}?output=xml').status_code,
+                         status.HTTP_400_BAD_REQUEST)
+        response = self.client.get(f'{self.url}?executed_from=yesterday')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('executed_from', response.data)
+        missing = f'/wallets/wallets/{uuid4()}/statement/'
+        self.assertEqual(self.client.get(missing).status_code, status.HTTP_404_NOT_FOUND)
+
+    @mock.patch('django.conf.settings.STATEMENT_CHUNK_SIZE', 2)
+    def test_query_count_does_not_grow_with_history(self):
+        self.assertConstantQueries(lambda: self.stream(self.url), self.add_rows, large=25)
+
+
+class StatementStreamTest(SimpleTestCase):
+    def test_worker_thread_keeps_order_and_errors(self):
+        self.assertEqual(list(statements.in_worker_thread(lambda: iter(range(50)))),
+                         list(range(50)))
+
+        def failing():
+            yield 'a'
+            raise ValueError("boom")
+
+        chunks = statements.in_worker_thread(failing)
+        self.assertEqual(next(chunks), 'a')
+        with self.assertRaisesMessage(ValueError, "boom"):
+            next(chunks)
+
+    def test_stream_uses_worker_thread_on_event_loop(self):
+        async def consume():
+            return [(chunk, threading.get_ident())
+                    for chunk in statements.stream(lambda: ((c, threading.get_ident())
+                                                           for c in 'ab'))]
+
+        chunks = asyncio.run(consume())
+        self.assertEqual([chunk for (chunk, _), _ in chunks], ['a', 'b'])
+        self.assertNotEqual(chunks[0][0][1], chunks[0][1])
+        self.assertEqual(list(statements.stream(lambda: iter('ab'))), ['a', 'b'])
+
+
 class TransactionViewSetTest(TestCase):
     def setUp(self):
         self.client = APIClient()
@@ -111,6 +445,174 @@ class TransactionViewSetTest(TestCase):
         self.assertEqual(Transaction.objects.count(), 2)  # 1 created during setup, 1 created in this test
         self.assertEqual(Transaction.objects.last().wallet.pk, self.wallet.pk)
 
+    def test_create_withdraw_transaction_stays_pending(self):
+        self.client.force_authenticate(user=self.user)
+        data = {'wallet': self.wallet.uuid,
+                'amount': '50.00',
+                'method': '1'}
+        response = self.client.post('/wallets/transactions/', data)
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        transaction = Transaction.objects.get(pk=response.data['id'])
+        self.assertEqual(transaction.status, Transaction.Status.PENDING)
+        self.assertIsNone(transaction.executed_time)
+        self.assertGreater(transaction.scheduled_time, timezone.now().timestamp())
+
+    def test_create_transaction_with_idempotency_key(self):
+        idempotency_cache.clear()
+        data = {'wallet': self.wallet.uuid, 'amount': '50.00', 'method': '0'}
+        first = self.client.post('/wallets/transactions/', data, HTTP_IDEMPOTENCY_KEY='key-1')
+        self.assertEqual(first.status_code, status.HTTP_201_CREATED)
+        with self.assertNumQueries(0):
+            retry = self.client.post('/wallets/transactions/', data, HTTP_IDEMPOTENCY_KEY='key-1')
+        self.assertEqual(retry.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(retry['Idempotent-Replayed'], 'true')
+        self.assertEqual(retry.data, first.data)
+        idempotency_cache.clear()
+        retry = self.client.post('/wallets/transactions/', data, HTTP_IDEMPOTENCY_KEY='key-1')
+        self.assertEqual(retry.data, first.data)
+        self.assertEqual(Transaction.objects.filter(idempotency_key='key-1').count(), 1)
+        self.assertEqual(Wallet.objects.get(pk=self.wallet.pk).balance, Decimal("150.00"))
+
+    def test_create_transaction_with_new_idempotency_key(self):
+        data = {'wallet': self.wallet.uuid, 'amount': '50.00', 'method': '0'}
+        self.client.post('/wallets/transactions/', data, HTTP_IDEMPOTENCY_KEY='key-2')
+        self.client.post('/wallets/transactions/', data, HTTP_IDEMPOTENCY_KEY='key-3')
+        self.assertEqual(Wallet.objects.get(pk=self.wallet.pk).balance, Decimal("200.00"))
+
+    def test_bulk_create_transactions(self):
+        other = Wallet.objects.create(owner=User.objects.create_user(username='other'))
+        data = [{'wallet': str(self.wallet.uuid), 'amount': '10.00', 'method': '0'},
+                {'wallet': str(other.uuid), 'amount': '5.00', 'method': '0'},
+                {'wallet': str(self.wallet.uuid), 'amount': '2.50', 'method': '0'},
+                {'wallet': str(self.wallet.uuid), 'amount': '30.00', 'method': '1'}]
+        # one balance UPDATE and one ledger INSERT per wallet, not per item
+        with self.assertNumQueries(9):
+            response = self.client.post('/wallets/transactions/bulk/', data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data['created'], 4)
+        self.assertEqual([result['status'] for result in response.data['results']],
+                         ['COMPLETED', 'COMPLETED', 'COMPLETED', 'PENDING'])
+        ids = [result['id'] for result in response.data['results']]
+        created = Transaction.objects.in_bulk(ids)
+        self.assertEqual([(created[pk].wallet_id, str(created[pk].amount)) for pk in ids],
+                         [(Wallet.objects.get(uuid=item['wallet']).pk, item['amount'])
+                          for item in data])
+        # ids are read back without touching the client facing idempotency key
+        self.assertEqual([(created[pk].idempotency_key, created[pk].payout_key) for pk in ids],
+                         [(None, f'transaction-{pk}') for pk in ids])
+        self.assertEqual(list(LedgerEntry.objects.filter(kind=LedgerEntry.Kind.DEPOSIT)
+                              .order_by('transaction_id').values_list('transaction_id', 'amount')),
+                         [(ids[0], Decimal("10.00")), (ids[1], Decimal("5.00")),
+                          (ids[2], Decimal("2.50"))])
+        self.assertEqual(list(ledger.verify()), [])
+        self.assertEqual(Wallet.objects.get(pk=self.wallet.pk).balance, Decimal("112.50"))
+        self.assertEqual(Wallet.objects.get(pk=other.pk).balance, Decimal("5.00"))
+        self.assertEqual(Transaction.objects.filter(method=Transaction.Method.WITHDRAW,
+                                                    status=Transaction.Status.PENDING).count(), 1)
+
+    def test_bulk_create_reports_invalid_items(self):
+        data = [{'wallet': str(self.wallet.uuid), 'amount': '10.00', 'method': '0'},
+                {'wallet': 'not-a-uuid', 'amount': '10.00', 'method': '0'},
+                {'wallet': str(self.wallet.uuid), 'amount': '10.00', 'method': '9'}]
+        response = self.client.post('/wallets/transactions/bulk/', data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_207_MULTI_STATUS)
+        self.assertEqual((response.data['created'], response.data['failed']), (1, 2))
+        results = response.data['results']
+        self.assertEqual([result['index'] for result in results], [0, 1, 2])
+        self.assertEqual(results[0]['status'], 'COMPLETED')
+        self.assertIn('wallet', results[1]['errors'])
+        self.assertIn('method', results[2]['errors'])
+        self.assertEqual(Wallet.objects.get(pk=self.wallet.pk).balance, Decimal("110.00"))
+
+    def test_bulk_create_from_ndjson(self):
+        line = f'{{"wallet": "{self.wallet.uuid}", "amount": "1.00", "method": "0"}}'
+        response = self.client.post('/wallets/transactions/bulk/',
+                                    data="\n".join([line, "", line]) + "\n",
+                                    content_type='application/x-ndjson')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data['created'], 2)
+        self.assertEqual(Wallet.objects.get(pk=self.wallet.pk).balance, Decimal("102.00"))
+
+    def test_transfer(self):
+        other = Wallet.objects.create(owner=User.objects.create_user(username='other'))
+        data = {'wallet': self.wallet.uuid, 'counterparty': other.uuid,
+                'amount': '40.00', 'method': '2'}
+        with mock.patch('wallets.models.request_third_party_deposit') as third_party:
+            response = self.client.post('/wallets/transactions/', data)
+        third_party.assert_not_called()
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data['status'], 'COMPLETED')
+        self.assertEqual(response.data['counterparty'], other.uuid)
+        self.assertEqual(Wallet.objects.get(pk=self.wallet.pk).balance, Decimal("60.00"))
+        self.assertEqual(Wallet.objects.get(pk=other.pk).balance, Decimal("40.00"))
+        self.assertEqual(sorted(LedgerEntry.objects.filter(transaction_id=response.data['id'])
+                                .values_list('amount', flat=True)),
+                         [Decimal("-40.00"), Decimal("40.00")])
+        self.assertEqual(list(ledger.verify()), [])
+
+    def test_transfer_insufficient_funds_changes_nothing(self):
+        other = Wallet.objects.create(owner=User.objects.create_user(username='other'))
+        data = {'wallet': self.wallet.uuid, 'counterparty': other.uuid,
+                'amount': '400.00', 'method': '2'}
+        response = self.client.post('/wallets/transactions/', data)
+        self.assertEqual(response.data['status'], 'FAILED')
+        self.assertEqual(response.data['status_description'], "Insufficient funds.")
+        self.assertEqual(Wallet.objects.get(pk=self.wallet.pk).balance, Decimal("100.00"))
+        self.assertEqual(Wallet.objects.get(pk=other.pk).balance, Decimal("0.00"))
+        self.assertFalse(LedgerEntry.objects.filter(kind=LedgerEntry.Kind.TRANSFER).exists())
+
+    def test_failed_transfer_leaves_no_pending_row(self):
+        other = Wallet.objects.create(owner=User.objects.create_user(username='other'))
+        data = {'wallet': str(self.wallet.uuid), 'counterparty': str(other.uuid),
+                'amount': '40.00', 'method': '2'}
+        with mock.patch.object(type(Wallet.objects), 'transfer', side_effect=RuntimeError):
+            with self.assertRaises(RuntimeError):
+                self.client.post('/wallets/transactions/', data, format='json')
+            with self.assertRaises(RuntimeError):
+                self.client.post('/wallets/transactions/bulk/', [data], format='json')
+        self.assertFalse(Transaction.objects.filter(method=Transaction.Method.TRANSFER).exists())
+
+    def test_transfer_locks_wallets_in_uuid_order(self):
+        other = Wallet.objects.create(owner=User.objects.create_user(username='other'),
+                                      balance=Decimal("10.00"))
+        for source, target in ((self.wallet, other), (other, self.wallet)):
+            with CaptureQueriesContext(connection) as queries:
+                self.assertTrue(Wallet.objects.transfer(source.pk, target.pk, "1.00"))
+            updates = [query['sql'] for query in queries.captured_queries
+                       if query['sql'].startswith('UPDATE')]
+            first, second = sorted((source.pk, target.pk))
+            self.assertIn(first.hex, updates[0])
+            self.assertIn(second.hex, updates[1])
+
+    def test_transfer_validation(self):
+        other = Wallet.objects.create(owner=User.objects.create_user(username='other'))
+        for data, field in (
+                ({'wallet': self.wallet.uuid, 'amount': '1.00', 'method': '2'}, 'counterparty'),
+                ({'wallet': self.wallet.uuid, 'counterparty': self.wallet.uuid,
+                  'amount': '1.00', 'method': '2'}, 'counterparty'),
+                ({'wallet': self.wallet.uuid, 'counterparty': other.uuid,
+                  'amount': '1.00', 'method': '0'}, 'counterparty')):
+            response = self.client.post('/wallets/transactions/', data)
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+            self.assertIn(field, response.data)
+
+    def test_bulk_create_transfers(self):
+        other = Wallet.objects.create(owner=User.objects.create_user(username='other'))
+        data = [{'wallet': str(self.wallet.uuid), 'counterparty': str(other.uuid),
+                 'amount': '30.00', 'method': '2'},
+                {'wallet': str(other.uuid), 'amount': '5.00', 'method': '0'},
+                {'wallet': str(other.uuid), 'counterparty': str(self.wallet.uuid),
+                 'amount': '500.00', 'method': '2'}]
+        response = self.client.post('/wallets/transactions/bulk/', data, format='json')
+        self.assertEqual([result['status'] for result in response.data['results']],
+                         ['COMPLETED', 'COMPLETED', 'FAILED'])
+        self.assertEqual(Wallet.objects.get(pk=other.pk).balance, Decimal("35.00"))
+
+    def test_bulk_create_rejects_non_list(self):
+        response = self.client.post('/wallets/transactions/bulk/', {'amount': '1.00'},
+                                    format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
     def test_retrieve_transaction(self):
         self.client.force_authenticate(user=self.user)
         response = self.client.get(f'/wallets/transactions/{self.transaction.pk}/')
@@ -122,3 +624,1192 @@ class TransactionViewSetTest(TestCase):
         response = self.client.get('/wallets/transactions/')
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertGreaterEqual(len(response.data), 1)
+
+    def test_list_transactions_follows_cursor(self):
+        Transaction.objects.bulk_create(
+            Transaction(wallet=self.wallet, amount=i) for i in range(6))
+        expected = list(Transaction.objects.order_by('-id').values_list('id', flat=True))
+        seen = []
+        url = '/wallets/transactions/?pagination=cursor&limit=3'
+        while url:
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(url)
+            self.assertFalse(any('COUNT(' in query['sql'] for query in queries))
+            self.assertNotIn('count', response.data)
+            seen.extend(item['id'] for item in response.data['results'])
+            url = response.data['next']
+        self.assertEqual(seen, expected)
+
+    def test_list_transactions_pages_by_offset_by_default(self):
+        Transaction.objects.bulk_create(
+            Transaction(wallet=self.wallet, amount=i) for i in range(6))
+        expected = list(Transaction.objects.order_by('-id').values_list('id', flat=True))
+        response = self.client.get('/wallets/transactions/?limit=3&offset=3')
+        self.assertEqual(response.data['count'], len(expected))
+        self.assertEqual([item['id'] for item in response.data['results']], expected[3:6])
+        with override_settings(PAGINATION={'MODE': 'cursor'}):
+            response = self.client.get('/wallets/transactions/?limit=3')
+        self.assertNotIn('count', response.data)
+        self.assertEqual([item['id'] for item in response.data['results']], expected[:3])
+
+    def test_wallet_cursor_does_not_skip_wallets_created_together(self):
+        for i in range(5):
+            Wallet.objects.create(owner=User.objects.create_user(username=f'twin{i}'))
+        Wallet.objects.update(created_at=timezone.now())
+        seen = []
+        url = '/wallets/wallets/?pagination=cursor&limit=2'
+        while url:
+            response = self.client.get(url)
+            seen.extend(item['uuid'] for item in response.data['results'])
+            url = response.data['next']
+        self.assertEqual(seen, [str(pk) for pk in Wallet.objects.order_by('-created_at', '-uuid')
+                                .values_list('pk', flat=True)])
+
+
+@mock.patch('wallets.models.request_third_party_deposit',
+            return_value={'data': 'success', 'status': 200})
+class WithdrawalExecutorTest(TestCase):
+    def setUp(self):
+        payout_client.reset()
+        self.user = User.objects.create_user(username='testuser')
+        self.wallet = Wallet.objects.create(owner=self.user,
+                                            balance=Decimal("500.00"))
+        now = timezone.now().timestamp()
+        self.due = Transaction.objects.create(wallet=self.wallet,
+                                              amount=Decimal("100.00"),
+                                              method=Transaction.Method.WITHDRAW,
+                                              scheduled_time=now - 60)
+        self.future = Transaction.objects.create(wallet=self.wallet,
+                                                 amount=Decimal("100.00"),
+                                                 method=Transaction.Method.WITHDRAW,
+                                                 scheduled_time=now + 3600)
+
+    def test_run_once_executes_due_withdrawals_only(self, _):
+        executed = WithdrawalExecutor(batch_size=10).run_once()
+        self.assertEqual(executed, 1)
+        self.due.refresh_from_db()
+        self.future.refresh_from_db()
+        self.assertEqual(self.due.status, Transaction.Status.COMPLETED)
+        self.assertEqual(self.future.status, Transaction.Status.PENDING)
+        self.assertEqual(Wallet.objects.get(pk=self.wallet.pk).balance, Decimal("400.00"))
+
+    def test_run_once_respects_batch_size(self, _):
+        Transaction.objects.create(wallet=self.wallet,
+                                   amount=Decimal("100.00"),
+                                   method=Transaction.Method.WITHDRAW,
+                                   scheduled_time=timezone.now().timestamp() - 30)
+        executor = WithdrawalExecutor(batch_size=1)
+        self.assertEqual(executor.run_once(), 1)
+        self.assertEqual(executor.run_once(), 1)
+        self.assertEqual(executor.run_once(), 0)
+
+
+@mock.patch('wallets.models.request_third_party_deposit',
+            return_value={'data': 'success', 'status': 200})
+class LeasesTest(TestCase):
+    def setUp(self):
+        payout_client.reset()
+        self.wallet = Wallet.objects.create(owner=User.objects.create_user(username='testuser'),
+                                            balance=Decimal("500.00"))
+        self.withdrawals = [
+            Transaction.objects.create(wallet=self.wallet, amount=Decimal("10.00"),
+                                       method=Transaction.Method.WITHDRAW,
+                                       scheduled_time=timezone.now().timestamp() - 60)
+            for _ in range(5)]
+        self.first = Leases(owner='first', ttl=30)
+        self.second = Leases(owner='second', ttl=30)
+
+    def test_workers_claim_disjoint_withdrawals(self, _):
+        first = self.first.claim(Transaction.objects.due_withdrawals(), 3)
+        second = self.second.claim(Transaction.objects.due_withdrawals(), 5)
+        self.assertEqual(first, self.withdrawals[:3])
+        self.assertEqual(second, self.withdrawals[3:])
+        self.assertEqual(self.first.claim(Transaction.objects.due_withdrawals(), 5), [])
+
+    def test_expired_leases_are_claimed_again(self, _):
+        self.first.claim(Transaction.objects.due_withdrawals(), 5)
+        self.assertEqual(self.first.heartbeat(), 5)
+        self.assertEqual(self.second.claim(Transaction.objects.due_withdrawals(), 5), [])
+        Transaction.objects.update(lease_expires=timezone.now().timestamp() - 1)
+        self.assertEqual(self.second.claim(Transaction.objects.due_withdrawals(), 5),
+                         self.withdrawals)
+        self.assertEqual(self.first.heartbeat(), 0)
+
+    def test_heartbeats_run_until_stopped(self, _):
+        leases = Leases(owner='beating', ttl=0.03)
+        with mock.patch.object(leases, 'heartbeat') as heartbeat:
+            leases.start()
+            time.sleep(0.1)
+            leases.stop()
+            beats = heartbeat.call_count
+            time.sleep(0.05)
+        self.assertGreaterEqual(beats, 2)
+        self.assertEqual(heartbeat.call_count, beats)
+
+    def test_release_frees_withdrawals(self, _):
+        claimed = self.first.claim(Transaction.objects.due_withdrawals(), 2)
+        self.first.release(claimed)
+        self.assertEqual(self.second.claim(Transaction.objects.due_withdrawals(), 2), claimed)
+
+    def test_crashed_payouts_are_retried(self, third_party):
+        transaction = self.first.claim(Transaction.objects.due_withdrawals(), 1)[0]
+        self.assertTrue(transaction.prepare_withdraw())
+        # the worker dies during the bank call and its lease lapses
+        Transaction.objects.filter(pk=transaction.pk).update(
+            lease_expires=timezone.now().timestamp() - 1)
+        self.assertEqual(self.second.recover(), 1)
+        self.assertEqual(self.second.recover(), 0)
+        executor = WithdrawalExecutor(batch_size=10, leases=self.second)
+        self.assertEqual(executor.run_once(), 5)
+        self.assertEqual(set(Transaction.objects.values_list('status', 'lease_owner')),
+                         {(Transaction.Status.COMPLETED, None)})
+        self.assertEqual(third_party.call_count, 5)
+        wallet = Wallet.objects.get(pk=self.wallet.pk)
+        self.assertEqual((wallet.balance, wallet.held), (Decimal("450.00"), Decimal("0.00")))
+        self.assertEqual(list(ledger.verify()), [])
+
+    def test_processing_withdrawals_without_a_lease_are_retried_after_grace(self, _):
+        for transaction in self.withdrawals[:2]:
+            self.assertTrue(transaction.prepare_withdraw())
+        Transaction.objects.filter(pk=self.withdrawals[1].pk).update(
+            scheduled_time=timezone.now().timestamp() - 600)
+        self.assertEqual(Leases(owner='third', ttl=30, grace=300).recover(), 1)
+        self.assertEqual(list(Transaction.objects.due_retries()), [self.withdrawals[1]])
+
+    def test_run_once_renews_the_leases_of_its_batch(self, _):
+        leases = Leases(owner='once', ttl=0.03)
+        executor = WithdrawalExecutor(batch_size=10, leases=leases)
+        with mock.patch.object(leases, 'heartbeat') as heartbeat, \
+                mock.patch.object(executor, 'execute', lambda _: time.sleep(0.02)):
+            self.assertEqual(executor.run_once(), 5)
+        self.assertGreaterEqual(heartbeat.call_count, 2)
+        self.assertFalse(leases.beating)
+
+    def test_a_withdrawal_is_executed_once(self, third_party):
+        transaction = self.withdrawals[0]
+        stale = Transaction.objects.get(pk=transaction.pk)
+        transaction.execute_withdraw()
+        with self.assertRaisesMessage(ValueError, "already been executed"):
+            stale.execute_withdraw()
+        self.assertEqual(third_party.call_count, 1)
+        self.assertEqual(Wallet.objects.get(pk=self.wallet.pk).balance, Decimal("490.00"))
+
+    def test_an_outcome_is_recorded_once(self, _):
+        transaction = self.withdrawals[0]
+        self.assertTrue(transaction.prepare_withdraw())
+        stale = Transaction.objects.get(pk=transaction.pk)
+        transaction.finish_withdraw({'data': 'success', 'status': 200})
+        with self.assertRaisesMessage(ValueError, "already been executed"):
+            stale.finish_withdraw({'data': 'failed', 'status': 400})
+        transaction.refresh_from_db()
+        self.assertEqual((transaction.status, transaction.attempts),
+                         (Transaction.Status.COMPLETED, 1))
+        wallet = Wallet.objects.get(pk=self.wallet.pk)
+        self.assertEqual((wallet.balance, wallet.held), (Decimal("490.00"), Decimal("0.00")))
+
+
+class TimingWheelTest(TestCase):
+    def setUp(self):
+        self.wallet = Wallet.objects.create(owner=User.objects.create_user(username='testuser'),
+                                            balance=Decimal("500.00"))
+        self.now = 1_000_000
+        self.wheel = TimingWheel(tick=1.0, window=300, refresh=5)
+
+    def withdrawal(self, delay):
+        return Transaction.objects.create(wallet=self.wallet, amount=Decimal("1.00"),
+                                          method=Transaction.Method.WITHDRAW,
+                                          scheduled_time=self.now + delay)
+
+    def test_loads_only_the_next_window(self):
+        soon, later = self.withdrawal(10), self.withdrawal(100)
+        for _ in range(5):
+            self.withdrawal(10_000)
+        self.assertEqual(self.wheel.load(self.now), 2)
+        self.assertEqual(len(self.wheel), 2)
+        self.assertEqual(self.wheel.next_event(), self.now + 5)
+        self.assertEqual(self.wheel.pop_due(self.now + 10, 10), [soon.pk])
+        self.assertEqual(self.wheel.pop_due(self.now + 200, 10), [later.pk])
+        self.assertEqual(len(self.wheel), 0)
+
+    def test_fetch_fires_due_withdrawals_in_order(self):
+        self.wheel.fetch(10, now=self.now)
+        first, second, _ = self.withdrawal(4), self.withdrawal(3), self.withdrawal(9)
+        self.assertEqual(self.wheel.fetch(10, now=self.now + 2), [])
+        self.assertEqual(self.wheel.fetch(10, now=self.now + 6), [second, first])
+        self.assertEqual(len(self.wheel), 1)
+
+    def test_refresh_loads_new_withdrawals_and_extends_the_window(self):
+        self.wheel.load(self.now)
+        soon, edge = self.withdrawal(20), self.withdrawal(302)
+        self.assertEqual(self.wheel.load(self.now + 5), 2)
+        self.assertEqual(self.wheel.load(self.now + 10), 0)
+        self.assertEqual(self.wheel.pop_due(self.now + 400, 10), [soon.pk, edge.pk])
+
+    def test_sweep_drains_overdue_withdrawals(self):
+        overdue = [self.withdrawal(-60) for _ in range(3)]
+        self.assertEqual(self.wheel.fetch(2, now=self.now), overdue[:2])
+        Transaction.objects.filter(pk__in=[overdue[0].pk, overdue[1].pk]).update(
+            status=Transaction.Status.PROCESSING)
+        self.assertEqual(self.wheel.fetch(2, now=self.now), overdue[2:])
+        self.withdrawal(-30)
+        self.assertEqual(self.wheel.fetch(2, now=self.now + 1), [])
+
+    def test_executed_withdrawals_are_not_fired(self):
+        self.wheel.load(self.now)
+        withdrawal = self.withdrawal(3)
+        self.wheel.load(self.now + 5)
+        Transaction.objects.filter(pk=withdrawal.pk).update(status=Transaction.Status.PROCESSING)
+        self.assertEqual(self.wheel.fetch(10, now=self.now + 6), [])
+
+    @mock.patch('wallets.models.request_third_party_deposit',
+                return_value={'data': 'success', 'status': 200})
+    def test_executor_runs_withdrawals_from_the_wheel(self, _):
+        self.now = timezone.now().timestamp()
+        due, future = self.withdrawal(-60), self.withdrawal(3600)
+        executor = WithdrawalExecutor(batch_size=10, wheel=TimingWheel(tick=1.0, window=60,
+                                                                       refresh=5))
+        self.assertEqual(executor.run_once(), 1)
+        self.assertEqual(executor.run_once(), 0)
+        due.refresh_from_db()
+        future.refresh_from_db()
+        self.assertEqual((due.status, future.status),
+                         (Transaction.Status.COMPLETED, Transaction.Status.PENDING))
+        self.assertLessEqual(executor.idle_time(), 5)
+
+
+class BatchPayoutTest(TestCase):
+    def setUp(self):
+        payout_client.reset()
+        self.user = User.objects.create_user(username='testuser')
+        self.wallet = Wallet.objects.create(owner=self.user,
+                                            balance=Decimal("500.00"))
+        now = timezone.now().timestamp()
+        self.transactions = [
+            Transaction.objects.create(wallet=self.wallet,
+                                       amount=Decimal("100.00"),
+                                       method=Transaction.Method.WITHDRAW,
+                                       scheduled_time=now - 60 + i)
+            for i in range(4)
+        ]
+        self.executor = WithdrawalExecutor(batch_size=10, payout_batch_size=10)
+
+    def test_results_are_mapped_per_item(self):
+        ok, rejected, unavailable, missing = [t.payout_key for t in self.transactions]
+
+        def bank(items):
+            self.assertEqual([item['key'] for item in items], [ok, rejected, unavailable, missing])
+            self.assertEqual(items[0]['amount'], "100.00")
+            return {'data': 'success', 'status': 200, 'items': [
+                {'key': ok, 'data': 'success', 'status': 200},
+                {'key': rejected, 'data': 'failed', 'status': 400},
+                {'key': unavailable, 'data': 'failed', 'status': 503},
+            ]}
+
+        with mock.patch('wallets.scheduler.request_third_party_batch', side_effect=bank) as call:
+            self.assertEqual(self.executor.run_once(), 4)
+        call.assert_called_once()
+        statuses = [Transaction.objects.get(pk=t.pk).status for t in self.transactions]
+        self.assertEqual(statuses, [Transaction.Status.COMPLETED, Transaction.Status.FAILED,
+                                    Transaction.Status.PROCESSING, Transaction.Status.PROCESSING])
+        wallet = Wallet.objects.get(pk=self.wallet.pk)
+        self.assertEqual((wallet.balance, wallet.held), (Decimal("200.00"), Decimal("200.00")))
+
+    def test_failed_batch_call_retries_every_item(self):
+        with mock.patch('wallets.scheduler.request_third_party_batch',
+                        return_value={'data': 'timeout', 'status': 500}):
+            self.executor.run_once()
+        for transaction in self.transactions:
+            transaction.refresh_from_db()
+            self.assertEqual(transaction.status, Transaction.Status.PROCESSING)
+            self.assertEqual(transaction.attempts, 1)
+            self.assertEqual(transaction.status_description, 'timeout')
+
+    def test_chunks_and_insufficient_funds(self):
+        Transaction.objects.filter(pk=self.transactions[-1].pk).update(amount=Decimal("900.00"))
+        self.executor.payout_batch_size = 2
+        with mock.patch('wallets.scheduler.request_third_party_batch',
+                        side_effect=lambda items: {'data': 'success', 'status': 200, 'items': [
+                            {'key': item['key'], 'data': 'success', 'status': 200}
+                            for item in items]}) as call:
+            self.executor.run_once()
+        self.assertEqual([len(c.kwargs['items']) for c in call.call_args_list], [2, 1])
+        self.assertEqual(Transaction.objects.get(pk=self.transactions[-1].pk).status_description,
+                         "Insufficient funds.")
+        self.assertEqual(Wallet.objects.get(pk=self.wallet.pk).balance, Decimal("200.00"))
+
+    def test_mock_bank_answers_a_subset(self):
+        items = [{'key': str(i), 'amount': "1.00"} for i in range(4)]
+        # the mock leaves out the items it draws an empty response for
+        drawn = [{'data': 'success', 'status': 200}, {}, {'data': 'failed', 'status': 400}, {}]
+        payout_client.reset()
+        with mock.patch('utils.choices', return_value=drawn):
+            response = request_third_party_batch(items)
+            results = payout_client.call_batch(request_third_party_batch, items)
+        self.assertEqual(response['status'], 200)
+        self.assertEqual([result['key'] for result in response['items']], ['0', '2'])
+        self.assertEqual({key: outcome for key, (outcome, _) in results.items()},
+                         {'0': Outcome.SUCCESS, '1': Outcome.RETRY,
+                          '2': Outcome.FAILED, '3': Outcome.RETRY})
+
+
+class PayoutDispatcherTest(SimpleTestCase):
+    def setUp(self):
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.peak = 0
+
+    def slow_call(self, item):
+        with self.lock:
+            self.in_flight += 1
+            self.peak = max(self.peak, self.in_flight)
+        time.sleep(0.02)
+        with self.lock:
+            self.in_flight -= 1
+        return item
+
+    def test_map_returns_results_in_order(self):
+        with PayoutDispatcher(concurrency=4, max_pending=4) as dispatcher:
+            self.assertEqual(dispatcher.map(self.slow_call, range(10)), list(range(10)))
+
+    def test_concurrency_is_bounded(self):
+        with PayoutDispatcher(concurrency=3, max_pending=10) as dispatcher:
+            dispatcher.map(self.slow_call, range(12))
+        self.assertEqual(self.peak, 3)
+
+    def test_submit_blocks_when_saturated(self):
+        release = threading.Event()
+        with PayoutDispatcher(concurrency=1, max_pending=1) as dispatcher:
+            dispatcher.submit(release.wait)
+            dispatcher.submit(release.wait)
+            submitted = threading.Event()
+            producer = threading.Thread(
+                target=lambda: (dispatcher.submit(release.wait), submitted.set()))
+            producer.start()
+            self.assertFalse(submitted.wait(0.1))
+            release.set()
+            self.assertTrue(submitted.wait(1))
+            producer.join()
+
+
+class DepositCoalescerTest(SimpleTestCase):
+    def setUp(self):
+        self.batches = []
+
+    def record(self, transactions):
+        self.batches.append([transaction.pk for transaction in transactions])
+
+    def test_concurrent_deposits_share_a_batch(self):
+        coalescer = DepositCoalescer(max_delay=0.5, max_items=4)
+        with mock.patch.object(coalescer, 'apply', self.record):
+            futures = [coalescer.submit(mock.Mock(pk=pk)) for pk in range(6)]
+            self.assertEqual([future.result(timeout=1).pk for future in futures[:4]],
+                             [0, 1, 2, 3])
+            self.assertEqual([future.result(timeout=1).pk for future in futures[4:]], [4, 5])
+        self.assertEqual(self.batches, [[0, 1, 2, 3], [4, 5]])
+
+    def test_failed_batch_fails_every_deposit(self):
+        coalescer = DepositCoalescer(max_delay=0.05, max_items=10)
+        with mock.patch.object(coalescer, 'apply', side_effect=RuntimeError("database is down")), \
+                mock.patch.object(coalescer, 'fail') as fail:
+            futures = [coalescer.submit(mock.Mock(pk=pk)) for pk in range(3)]
+            for future in futures:
+                with self.assertRaisesMessage(RuntimeError, "database is down"):
+                    future.result(timeout=1)
+        (transactions, err), _ = fail.call_args
+        self.assertEqual([transaction.pk for transaction in transactions], [0, 1, 2])
+        self.assertIsInstance(err, RuntimeError)
+
+
+class CoalescedDepositTest(TestCase):
+    def setUp(self):
+        self.wallets = [Wallet.objects.create(owner=User.objects.create_user(username=f'user{i}'))
+                        for i in range(2)]
+
+    def deposit(self, wallet, amount):
+        return Transaction.objects.create(wallet=wallet, amount=Decimal(amount),
+                                          method=Transaction.Method.DEPOSIT)
+
+    def test_apply_credits_each_wallet_once(self):
+        transactions = [self.deposit(self.wallets[i % 2], "5.00") for i in range(5)]
+        with CaptureQueriesContext(connection) as queries:
+            DepositCoalescer.apply(transactions)
+        updates = [query for query in queries if query['sql'].startswith('UPDATE "wallets_wallet"')]
+        self.assertEqual(len(updates), 2)
+        self.assertEqual([wallet.total_balance for wallet in Wallet.objects.order_by('owner_id')],
+                         [Decimal("15.00"), Decimal("10.00")])
+        self.assertEqual(set(Transaction.objects.values_list('status', 'status_description')),
+                         {(Transaction.Status.COMPLETED, "deposited successfully")})
+        self.assertEqual(sorted(LedgerEntry.objects.filter(kind=LedgerEntry.Kind.DEPOSIT)
+                                .values_list('transaction_id', flat=True)),
+                         [transaction.pk for transaction in transactions])
+        self.assertEqual(list(ledger.verify()), [])
+
+    def test_fail_marks_pending_deposits_failed(self):
+        transactions = [self.deposit(self.wallets[0], "5.00") for _ in range(2)]
+        DepositCoalescer.apply(transactions[1:])
+        DepositCoalescer.fail(transactions, RuntimeError("database is down"))
+        self.assertEqual(list(Transaction.objects.order_by('id').values_list('status', flat=True)),
+                         [Transaction.Status.FAILED, Transaction.Status.COMPLETED])
+        self.assertEqual(Transaction.objects.get(pk=transactions[0].pk).status_description,
+                         "Deposit failed: database is down")
+
+    @override_settings(DEPOSIT_COALESCING={'ENABLED': True, 'MAX_DELAY': 0.01, 'MAX_ITEMS': 100})
+    def test_deposit_inside_a_database_transaction_is_executed_directly(self):
+        with mock.patch('wallets.coalesce.DepositCoalescer.submit') as submit:
+            response = APIClient().post('/wallets/transactions/',
+                                        {'wallet': str(self.wallets[0].pk), 'amount': "5.00",
+                                         'method': '0'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED, response.data)
+        self.assertEqual(response.data['status'], "COMPLETED")
+        submit.assert_not_called()
+
+
+@override_settings(DEPOSIT_COALESCING={'ENABLED': True, 'MAX_DELAY': 0.05, 'MAX_ITEMS': 100})
+class ConcurrentCoalescedDepositTest(django.test.TransactionTestCase):
+    """
+    Posts concurrent deposits through the API and the background thread of
+    `deposit_coalescer`.
+    """
+
+    def setUp(self):
+        self.wallets = [Wallet.objects.create(owner=User.objects.create_user(username=f'user{i}'))
+                        for i in range(2)]
+        self.batches = []
+        apply = DepositCoalescer.apply
+
+        def record(transactions):
+            self.batches.append(len(transactions))
+            apply(transactions)
+
+        patches = [mock.patch.object(deposit_coalescer, 'apply', record),
+                   mock.patch.object(deposit_coalescer, 'max_delay', 0.05)]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def post(self, wallet):
+        try:
+            return APIClient().post('/wallets/transactions/',
+                                    {'wallet': str(wallet.pk), 'amount': "2.50", 'method': '0'},
+                                    format='json')
+        finally:
+            connection.close()
+
+    def test_concurrent_deposits_are_applied_in_batches(self):
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            responses = list(pool.map(self.post, self.wallets * 8))
+        self.assertEqual([(response.status_code, response.data['status']) for response in responses],
+                         [(status.HTTP_201_CREATED, "COMPLETED")] * 16)
+        self.assertLess(len(self.batches), 16)
+        self.assertEqual(sum(self.batches), 16)
+        self.assertEqual([wallet.total_balance for wallet in Wallet.objects.order_by('owner_id')],
+                         [Decimal("20.00")] * 2)
+        self.assertEqual(sorted(LedgerEntry.objects.filter(kind=LedgerEntry.Kind.DEPOSIT)
+                                .values_list('transaction_id', flat=True)),
+                         sorted(response.data['id'] for response in responses))
+        self.assertEqual(list(ledger.verify()), [])
+
+
+@skipUnless(connection.vendor == 'sqlite', "query plans are checked on SQLite")
+class TransactionQueryPlanTest(TestCase):
+    def assertNoFullScan(self, queryset):
+        plan = queryset.explain()
+        self.assertIn("USING INDEX", plan)
+        self.assertNotIn("SCAN wallets_transaction", plan)
+        self.assertNotIn("USE TEMP B-TREE", plan)
+
+    def test_due_withdrawals_use_index(self):
+        self.assertNoFullScan(Transaction.objects.due_withdrawals()[:100])
+
+    def test_wallet_transactions_by_time_use_index(self):
+        wallet = Wallet.objects.create(owner=User.objects.create_user(username='testuser'))
+        self.assertNoFullScan(Transaction.objects.filter(wallet=wallet)
+                              .order_by('scheduled_time'))
+
+
+class ListQueryCountTest(QueryCountMixin, TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.users = 0
+
+    def add_wallets(self, count):
+        for _ in range(count):
+            self.users += 1
+            user = User.objects.create_user(username=f'user{self.users}')
+            Wallet.objects.create(owner=user, balance=100)
+
+    def add_transactions(self, count):
+        if not Wallet.objects.exists():
+            self.add_wallets(1)
+        wallet = Wallet.objects.first()
+        Transaction.objects.bulk_create(Transaction(wallet=wallet, amount=1,
+                                                    method=Transaction.Method.DEPOSIT)
+                                        for _ in range(count))
+
+    def test_list_wallets(self):
+        self.assertConstantQueries(lambda: self.client.get('/wallets/wallets/?limit=50'),
+                                   self.add_wallets)
+
+    def test_list_transactions(self):
+        self.assertConstantQueries(lambda: self.client.get('/wallets/transactions/?limit=50'),
+                                   self.add_transactions)
+
+    def test_admin_changelists(self):
+        admin = User.objects.create_superuser(username='admin', password='admin')
+        self.client.force_login(admin)
+        self.assertConstantQueries(lambda: self.client.get('/admin/wallets/wallet/'),
+                                   self.add_wallets)
+        self.assertConstantQueries(lambda: self.client.get('/admin/wallets/transaction/'),
+                                   self.add_transactions)
+
+    def test_admin_transaction_forms(self):
+        self.client.force_login(User.objects.create_superuser(username='admin', password='admin'))
+        self.add_transactions(1)
+        for url in (f'/admin/wallets/transaction/{Transaction.objects.get().pk}/change/',
+                    '/admin/wallets/transaction/add/'):
+            # the first request fills the content type cache
+            self.client.get(url)
+            self.assertConstantQueries(lambda: self.client.get(url), self.add_wallets)
+
+
+@override_settings(BALANCE_SHARDS={'ENABLED': True})
+class RowListTest(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.wallet = Wallet.objects.create(owner=User.objects.create_user(username='alice'),
+                                            balance=Decimal("100.00"))
+        self.other = Wallet.objects.create(owner=User.objects.create_user(username='bob'))
+        sharded = Wallet.objects.create(owner=User.objects.create_user(username='merchant'),
+                                        balance=Decimal("10.00"))
+        Wallet.objects.set_shards(sharded.pk, 4)
+        sharded.deposit("0.10")
+        sharded.deposit("0.20")
+        Transaction.objects.create(wallet=self.wallet, amount=Decimal("5.50"),
+                                   method=Transaction.Method.DEPOSIT).execute_deposit()
+        Transaction.objects.create(wallet=self.wallet, counterparty=self.other, amount=3,
+                                   method=Transaction.Method.TRANSFER).execute_transfer()
+        Transaction.objects.create(wallet=self.other, amount=Decimal("900.00"),
+                                   method=Transaction.Method.TRANSFER,
+                                   counterparty=self.wallet).execute_transfer()
+        Transaction.objects.create(wallet=self.wallet, amount=Decimal("1.25"),
+                                   method=Transaction.Method.WITHDRAW,
+                                   scheduled_time=timezone.now().timestamp() + 60)
+
+    def assertSameAsSerializer(self, viewset, url):
+        response = self.client.get(url)
+        with mock.patch.object(viewset, 'fast_list', False):
+            expected = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.content, expected.content)
+        return response
+
+    def test_transactions_match_the_serializer(self):
+        response = self.assertSameAsSerializer(TransactionViewSet, '/wallets/transactions/')
+        self.assertEqual(len(response.json()['results']), 4)
+        self.assertSameAsSerializer(TransactionViewSet, '/wallets/transactions/?limit=2')
+
+    def test_wallets_match_the_serializer(self):
+        response = self.assertSameAsSerializer(WalletViewSet, '/wallets/wallets/')
+        self.assertIn("10.30", [wallet['balance'] for wallet in response.json()['results']])
+        self.assertSameAsSerializer(WalletViewSet, '/wallets/wallets.json?limit=1')
+
+    def test_next_page_matches_the_serializer(self):
+        url = self.client.get('/wallets/transactions/?limit=3').json()['next']
+        self.assertSameAsSerializer(TransactionViewSet, url)
+
+    def test_row_lists_must_represent_their_rows(self):
+        class RowlessViewSet(RowListMixin, GenericViewSet):
+            queryset = Wallet.objects.all()
+
+        with self.assertRaises(TypeError):
+            RowlessViewSet()
+
+
+class FastJSONRendererTest(SimpleTestCase):
+    data = {'text': 'caf\u00e9 \u2028 \u2029 "quoted"', 'amount': Decimal("1.50"),
+            'uuid': uuid4(), 'when': timezone.now(), 'nested': [None, True, 1, 2.5, {}],
+            1: 'key'}
+
+    def test_matches_the_json_renderer(self):
+        self.assertEqual(FastJSONRenderer().render(self.data), JSONRenderer().render(self.data))
+
+    def test_indented_output_matches_the_json_renderer(self):
+        self.assertEqual(FastJSONRenderer().render(self.data, 'application/json; indent=2'),
+                         JSONRenderer().render(self.data, 'application/json; indent=2'))
+
+    def test_falls_back_without_orjson(self):
+        with mock.patch('wallets.renderers.orjson', None):
+            self.assertEqual(FastJSONRenderer().render(self.data),
+                             JSONRenderer().render(self.data))
+
+
+class LedgerTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='testuser')
+        self.wallet = Wallet.objects.create(owner=self.user, balance=Decimal("100.00"))
+        self.success = lambda: {'data': 'success', 'status': 200}
+        self.failure = lambda: {'data': 'failed', 'status': 503}
+
+    def test_mutations_are_recorded(self):
+        self.wallet.deposit("50.00")
+        self.wallet.withdraw("30.00", self.success)
+        self.wallet.withdraw("20.00", self.failure)
+        self.wallet.withdraw("500.00", self.success)
+        self.assertEqual(list(LedgerEntry.objects.order_by('id').values_list('kind', 'amount')),
+                         [(LedgerEntry.Kind.ADJUSTMENT, Decimal("100.00")),
+                          (LedgerEntry.Kind.DEPOSIT, Decimal("50.00")),
+                          (LedgerEntry.Kind.WITHDRAW, Decimal("-30.00")),
+                          (LedgerEntry.Kind.WITHDRAW, Decimal("-20.00")),
+                          (LedgerEntry.Kind.RELEASE, Decimal("20.00"))])
+        self.assertEqual(ledger.ledger_balances([self.wallet.pk]),
+                         {self.wallet.pk: Decimal("120.00")})
+        self.assertEqual(list(ledger.verify()), [])
+
+    def test_ledger_sums_are_exact_cents(self):
+        for _ in range(3):
+            self.wallet.deposit("0.10")
+        bases, deltas = ledger.ledger_deltas([self.wallet.pk])
+        self.assertEqual(str(deltas[self.wallet.pk]), "100.30")
+        self.assertEqual(list(ledger.verify()), [])
+
+    def test_verify_reports_untracked_changes(self):
+        other = Wallet.objects.create(owner=User.objects.create_user(username='other'))
+        Wallet.objects.filter(pk=self.wallet.pk).update(balance=Decimal("90.00"))
+        self.assertEqual(list(ledger.verify(chunk_size=1)),
+                         [(self.wallet.pk, Decimal("90.00"), Decimal("100.00"))])
+        self.assertEqual(ledger.ledger_balances([other.pk]), {other.pk: Decimal("0.00")})
+
+    def test_snapshots_bound_the_replayed_entries(self):
+        self.wallet.deposit("50.00")
+        self.assertEqual(ledger.take_snapshots(lag=0), 1)
+        self.assertEqual(ledger.take_snapshots(lag=0), 0)
+        snapshot = BalanceSnapshot.objects.get()
+        self.assertEqual(snapshot.balance, Decimal("150.00"))
+        self.wallet.deposit("25.00")
+        bases, deltas = ledger.ledger_deltas([self.wallet.pk])
+        self.assertEqual((bases[self.wallet.pk], deltas[self.wallet.pk]),
+                         (Decimal("150.00"), Decimal("25.00")))
+        self.assertEqual(list(ledger.verify()), [])
+
+    def test_balance_at(self):
+        now = timezone.now()
+        self.wallet.deposit("50.00")
+        LedgerEntry.objects.update(created_at=now - timedelta(hours=2))
+        ledger.take_snapshots(lag=0)
+        BalanceSnapshot.objects.update(created_at=now - timedelta(hours=2))
+        self.wallet.deposit("25.00")
+        LedgerEntry.objects.filter(amount=Decimal("25.00")).update(
+            created_at=now - timedelta(hours=1))
+        self.assertEqual(ledger.balance_at(self.wallet.pk, now - timedelta(hours=3)),
+                         Decimal("0.00"))
+        self.assertEqual(ledger.balance_at(self.wallet.pk, now - timedelta(minutes=90)),
+                         Decimal("150.00"))
+        self.assertEqual(ledger.balance_at(self.wallet.pk, now), Decimal("175.00"))
+
+    @override_settings(BALANCE_SHARDS={'ENABLED': True})
+    def test_admin_edits_keep_the_ledger(self):
+        self.client.force_login(User.objects.create_superuser(username='admin', password='admin'))
+        self.wallet.deposit("50.00")
+        response = self.client.post(f'/admin/wallets/wallet/{self.wallet.pk}/change/', {
+            'owner': self.user.pk, 'balance': '120.00', 'shard_count': '2', 'held': '999.00'})
+        self.assertEqual(response.status_code, status.HTTP_302_FOUND)
+        self.wallet.refresh_from_db()
+        self.assertEqual((self.wallet.total_balance, self.wallet.held, self.wallet.shard_count),
+                         (Decimal("120.00"), Decimal("0.00"), 2))
+        self.assertEqual(BalanceShard.objects.filter(wallet=self.wallet).count(), 2)
+        self.assertEqual(LedgerEntry.objects.filter(kind=LedgerEntry.Kind.ADJUSTMENT)
+                         .order_by('id').last().amount, Decimal("-30.00"))
+        self.assertEqual(list(ledger.verify()), [])
+
+
+class SeedTest(TestCase):
+    def test_seeded_wallets_match_their_ledger(self):
+        result = seed.seed(users=5, transactions=20)
+        self.assertEqual(result['users'], 5)
+        self.assertEqual(Transaction.objects.count(), 100)
+        self.assertEqual(Transaction.objects.filter(status=Transaction.Status.PENDING).count(), 10)
+        self.assertEqual(list(ledger.verify()), [])
+        self.assertEqual(seed.unseed(), 5)
+        self.assertFalse(Wallet.objects.exists())
+
+
+@skipUnless('fork' in multiprocessing.get_all_start_methods(), "needs forked processes")
+class BalanceTortureTest(django.test.TransactionTestCase):
+    """
+    Interleaves deposits, withdrawals against a failing bank and transfers
+    from several processes, see `wallets.bench.torture`.
+    """
+
+    def setUp(self):
+        if connection.vendor == 'sqlite' and connection.is_in_memory_db():
+            self.skipTest("processes can not share an in-memory database, "
+                          "set WALLET_TORTURE_TEST=1")
+
+    def test_balances_hold_under_parallel_load(self):
+        result = torture.run(processes=4, operations=300, wallets=3)
+        self.assertEqual(result['violations'], [])
+        self.assertEqual(result['negative_sightings'], 0)
+        self.assertGreater(result['polls'], 0)
+        self.assertEqual(result['errors'], {})
+        self.assertEqual(result['operations'], 1200)
+        self.assertGreater(result['operations_per_second'], 0)
+        self.assertGreater(result['statuses']['FAILED'], 0)
+
+
+@override_settings(BALANCE_SHARDS={'ENABLED': True})
+class ShardedWalletTest(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.wallet = Wallet.objects.create(owner=User.objects.create_user(username='merchant'),
+                                            balance=Decimal("10.00"))
+        Wallet.objects.set_shards(self.wallet.pk, 4)
+        self.success = lambda: {'data': 'success', 'status': 200}
+
+    def shard_balances(self):
+        return list(BalanceShard.objects.filter(wallet=self.wallet)
+                    .order_by('index').values_list('balance', flat=True))
+
+    def total(self):
+        return Wallet.objects.get(pk=self.wallet.pk).total_balance
+
+    def test_deposits_land_in_shards(self):
+        for _ in range(8):
+            self.wallet.deposit("5.00")
+        self.wallet.refresh_from_db()
+        self.assertEqual(self.wallet.balance, Decimal("10.00"))
+        self.assertEqual(sum(self.shard_balances()), Decimal("40.00"))
+        self.assertEqual(self.total(), Decimal("50.00"))
+        self.assertEqual(list(ledger.verify()), [])
+
+    def test_deposit_transactions_pick_the_shard_by_id(self):
+        transaction = Transaction.objects.create(wallet=self.wallet, amount=Decimal("5.00"),
+                                                 method=Transaction.Method.DEPOSIT)
+        transaction.execute_deposit()
+        self.assertEqual(self.shard_balances()[transaction.pk % 4], Decimal("5.00"))
+
+    def test_withdraw_consolidates_shards(self):
+        for _ in range(4):
+            self.wallet.deposit("5.00")
+        message, done = self.wallet.withdraw("25.00", self.success)
+        self.assertTrue(done, message)
+        self.assertEqual(self.shard_balances(), [Decimal("0.00")] * 4)
+        self.assertEqual(self.total(), Decimal("5.00"))
+        message, done = self.wallet.withdraw("25.00", self.success)
+        self.assertFalse(done)
+        self.assertEqual(self.total(), Decimal("5.00"))
+        self.assertEqual(list(ledger.verify()), [])
+
+    def test_withdraw_covered_by_the_wallet_row_leaves_shards(self):
+        self.wallet.deposit("5.00")
+        self.assertTrue(self.wallet.withdraw("10.00", self.success)[1])
+        self.assertEqual(sum(self.shard_balances()), Decimal("5.00"))
+
+    def test_transfer_to_and_from_a_sharded_wallet(self):
+        other = Wallet.objects.create(owner=User.objects.create_user(username='other'),
+                                      balance=Decimal("20.00"))
+        self.assertTrue(Wallet.objects.transfer(other.pk, self.wallet.pk, Decimal("20.00")))
+        self.assertTrue(Wallet.objects.transfer(self.wallet.pk, other.pk, Decimal("30.00")))
+        self.assertEqual(self.total(), Decimal("0.00"))
+        self.assertEqual(Wallet.objects.get(pk=other.pk).balance, Decimal("30.00"))
+        self.assertEqual(list(ledger.verify()), [])
+
+    def test_reads_include_shards(self):
+        self.wallet.deposit("5.00")
+        response = self.client.get(f'/wallets/wallets/{self.wallet.pk}/')
+        self.assertEqual(response.data['balance'], "15.00")
+        response = self.client.get('/wallets/wallets/')
+        self.assertEqual(response.data['results'][0]['balance'], "15.00")
+        self.wallet.deposit("5.00")
+        response = self.client.get(f'/wallets/wallets/{self.wallet.pk}/')
+        self.assertEqual(response.data['balance'], "20.00")
+
+    def test_adjust_consolidates_shards(self):
+        self.wallet.deposit("5.00")
+        Wallet.objects.adjust(self.wallet.pk, Decimal("12.00"))
+        self.assertEqual(self.total(), Decimal("12.00"))
+        self.assertEqual(list(ledger.verify()), [])
+
+    def test_removing_shards_keeps_their_balance(self):
+        for _ in range(8):
+            self.wallet.deposit("1.00")
+        Wallet.objects.set_shards(self.wallet.pk, 1)
+        self.assertEqual(BalanceShard.objects.filter(wallet=self.wallet).count(), 1)
+        self.assertEqual(self.total(), Decimal("18.00"))
+        Wallet.objects.set_shards(self.wallet.pk, 0)
+        self.wallet.deposit("1.00")
+        self.wallet.refresh_from_db()
+        self.assertEqual((self.wallet.shard_count, self.wallet.balance), (0, Decimal("19.00")))
+        self.assertFalse(BalanceShard.objects.exists())
+        self.assertEqual(list(ledger.verify()), [])
+
+
+class UnshardedWalletTest(TestCase):
+    def setUp(self):
+        self.wallet = Wallet.objects.create(owner=User.objects.create_user(username='merchant'),
+                                            balance=Decimal("10.00"))
+
+    def test_shards_are_refused_while_disabled(self):
+        with self.assertRaises(ValueError):
+            Wallet.objects.set_shards(self.wallet.pk, 4)
+        with self.assertRaisesMessage(CommandError, "BALANCE_SHARDS"):
+            call_command('shard_wallet', str(self.wallet.pk), '4')
+        self.assertTrue(Wallet.objects.set_shards(self.wallet.pk, 0))
+        self.assertFalse(BalanceShard.objects.exists())
+
+    def test_reads_and_credits_skip_shards(self):
+        with CaptureQueriesContext(connection) as queries:
+            Wallet.objects.credit(self.wallet.pk, Decimal("5.00"))
+            balance = Wallet.objects.with_shard_balance().get(pk=self.wallet.pk).total_balance
+        self.assertEqual(balance, Decimal("15.00"))
+        self.assertFalse([query for query in queries if 'wallets_balanceshard' in query['sql']])
+
+
+class TTLCacheTest(SimpleTestCase):
+    def setUp(self):
+        self.now = 0
+        self.cache = TTLCache(maxsize=2, ttl=10, timer=lambda: self.now)
+
+    def test_entries_expire(self):
+        self.cache.set('a', 1)
+        self.now = 9
+        self.assertEqual(self.cache.get('a'), 1)
+        self.now = 10
+        self.assertIsNone(self.cache.get('a'))
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+
+    def test_least_recently_used_is_evicted(self):
+        self.cache.set('a', 1)
+        self.cache.set('b', 2)
+        self.cache.get('a')
+        self.cache.set('c', 3)
+        self.assertEqual(self.cache.get('a'), 1)
+        self.assertIsNone(self.cache.get('b'))
+        self.assertEqual(len(self.cache), 2)
+
+
+class WalletCacheTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='testuser')
+        self.wallet = Wallet.objects.create(owner=self.user, balance=Decimal("100.00"))
+        self.url = f'/wallets/wallets/{self.wallet.uuid}/'
+
+    def test_detail_is_served_from_cache_until_a_write(self):
+        client = APIClient()
+        self.assertEqual(client.get(self.url).data['balance'], "100.00")
+        with self.assertNumQueries(0):
+            response = client.get(self.url)
+        self.assertEqual(response.data['balance'], "100.00")
+        self.wallet.deposit(Decimal("5.00"))
+        self.assertEqual(client.get(self.url).data['balance'], "105.00")
+        client.patch(self.url, {'balance': '7.00'})
+        self.assertEqual(client.get(self.url).data['balance'], "7.00")
+
+    def test_deleted_wallet_is_not_served(self):
+        client = APIClient()
+        client.get(self.url)
+        self.user.delete()
+        self.assertEqual(client.get(self.url).status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(client.get('/wallets/wallets/not-a-uuid/').status_code,
+                         status.HTTP_404_NOT_FOUND)
+
+    def test_read_racing_a_write_is_never_served(self):
+        cache = WalletCache(TTLCache(maxsize=10, ttl=60))
+
+        def load_then_write(pk):
+            # the write commits after the read loaded the old value
+            cache.invalidate(pk)
+            return 'old'
+
+        self.assertEqual(cache.get('a', load_then_write), 'old')
+        self.assertEqual(cache.get('a', lambda pk: 'new'), 'new')
+        self.assertEqual(cache.get('a', lambda pk: 'unused'), 'new')
+        self.assertEqual(cache.stats(), {'hits': 1, 'misses': 2, 'hit_rate': 0.3333})
+
+    def test_django_backend(self):
+        cache = WalletCache(LocMemCache('wallets-test', {}), ttl=60)
+        self.assertEqual(cache.get('a', lambda pk: {'balance': 1}), {'balance': 1})
+        self.assertEqual(cache.get('a', lambda pk: None), {'balance': 1})
+        cache.invalidate('a')
+        self.assertIsNone(cache.get('a', lambda pk: None))
+        self.assertEqual(cache.stats()['hits'], 1)
+
+    def test_writes_of_another_process_are_seen(self):
+        with tempfile.TemporaryDirectory() as location, override_settings(CACHES={
+                **settings.CACHES,
+                'wallets': {'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+                            'LOCATION': location}}):
+            # the executor stands for another process with a connection to the same store
+            executor = WalletCache(caches.create_connection('wallets'), ttl=60)
+            self.assertTrue(wallet_cache.shared)
+            self.assertEqual(APIClient().get(self.url).data['balance'], "100.00")
+            with mock.patch('wallets.models.wallet_cache', executor):
+                self.wallet.deposit(Decimal("5.00"))
+            self.assertEqual(APIClient().get(self.url).data['balance'], "105.00")
+        self.assertFalse(wallet_cache.shared)
+
+    def test_versions_expire_with_their_entries(self):
+        backend = LocMemCache('wallets-test', {})
+        cache = WalletCache(backend, ttl=60)
+        with mock.patch.object(backend, 'set', wraps=backend.set) as cache_set:
+            cache.get('a', lambda pk: 'old')
+            cache.invalidate('a')
+        self.assertEqual({timeout for (_, _, timeout), _ in cache_set.call_args_list}, {60})
+
+    def test_lru_serves_writes_of_another_process_stale(self):
+        web = WalletCache(TTLCache(maxsize=10, ttl=60))
+        executor = WalletCache(TTLCache(maxsize=10, ttl=60))
+        self.assertFalse(web.shared)
+        self.assertEqual(web.get('a', lambda pk: 'old'), 'old')
+        executor.invalidate('a')
+        self.assertEqual(web.get('a', lambda pk: 'new'), 'old')
+        stderr = io.StringIO()
+        with mock.patch('wallets.management.commands.run_withdrawals.wallet_cache', web), \
+                mock.patch.object(WithdrawalExecutor, 'run_once', return_value=0):
+            call_command('run_withdrawals', '--once', stdout=io.StringIO(), stderr=stderr)
+        self.assertIn("not shared between processes", stderr.getvalue())
+
+    def test_counts_hits(self):
+        hits = wallet_cache.hits
+        APIClient().get(self.url)
+        APIClient().get(self.url)
+        self.assertEqual(wallet_cache.hits, hits + 1)
+
+
+class KeepAliveBank(BaseHTTPRequestHandler):
+    """
+    Answers every payout with success after a short delay over keep-alive
+    connections, recording the client port of each connection it accepts.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        super().setup()
+        self.server.connections.add(self.client_address[1])
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        time.sleep(0.02)
+        body = b'{"data": "success", "status": 200}'
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class BankClientTest(SimpleTestCase):
+    def connections_opened(self, client, concurrency, rounds=3) -> int:
+        """
+        Sends `rounds` rounds of `concurrency` simultaneous payouts through
+        `client` and returns the number of connections the bank accepted.
+        """
+        server = ThreadingHTTPServer(('127.0.0.1', 0), KeepAliveBank)
+        server.connections = set()
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        client.url = f'http://127.0.0.1:{server.server_port}/'
+        with PayoutDispatcher(concurrency=concurrency) as dispatcher:
+            for _ in range(rounds):
+                futures = [dispatcher.submit(send_third_party_deposit, client=client)
+                           for _ in range(concurrency)]
+                self.assertTrue(all(future.result()['status'] == 200 for future in futures))
+        return len(server.connections)
+
+    def test_pool_keeps_a_connection_per_payout_in_flight(self):
+        client = BankClient(url=None, pool_size=1, connect_timeout=1.0, read_timeout=2.0)
+        self.addCleanup(client.close)
+        # connections beyond the pool are dropped after every call
+        self.assertGreater(self.connections_opened(client, concurrency=4), 4)
+        client.resize(4)
+        self.assertLessEqual(self.connections_opened(client, concurrency=4), 4)
+
+    def test_run_withdrawals_sizes_the_pool_to_its_concurrency(self):
+        with mock.patch.object(bank_client, 'resize') as resize, \
+                mock.patch.object(WithdrawalExecutor, 'run_once', return_value=0):
+            call_command('run_withdrawals', '--once', '--concurrency', '12', stdout=io.StringIO())
+        resize.assert_called_once_with(12)
+
+    def test_timeouts(self):
+        client = BankClient(url='http://bank.test/', pool_size=3,
+                            connect_timeout=1.5, read_timeout=4.0)
+        response = mock.Mock(**{'json.return_value': {'data': 'success', 'status': 200}})
+        with mock.patch.object(client._client, 'post', return_value=response) as post:
+            self.assertEqual(send_third_party_deposit(idempotency_key='k', client=client),
+                             {'data': 'success', 'status': 200})
+            send_third_party_deposit(timeout=9, client=client)
+        self.assertEqual(post.call_args_list, [
+            mock.call('http://bank.test/', headers={'Idempotency-Key': 'k'}, json=None,
+                      timeout=(1.5, 4.0)),
+            mock.call('http://bank.test/', headers={}, json=None, timeout=(1.5, 9)),
+        ])
+
+    def test_errors_become_500(self):
+        client = BankClient(url='http://bank.test/', pool_size=1,
+                            connect_timeout=1.5, read_timeout=4.0)
+        with mock.patch.object(client._client, 'post', side_effect=ConnectionError("down")):
+            self.assertEqual(send_third_party_deposit(client=client),
+                             {'data': "down", 'status': 500})
+
+
+class PayoutPolicyTest(SimpleTestCase):
+    def test_classify(self):
+        self.assertIs(classify({'data': 'success', 'status': 200}), Outcome.SUCCESS)
+        self.assertIs(classify({'data': 'failed', 'status': 400}), Outcome.FAILED)
+        self.assertIs(classify({'data': 'failed', 'status': 503}), Outcome.RETRY)
+        self.assertIs(classify({'data': 'timeout', 'status': 500}), Outcome.RETRY)
+        self.assertIs(classify({}), Outcome.RETRY)
+
+    def test_retry_delay_is_jittered_and_capped(self):
+        policy = RetryPolicy(max_attempts=5, base_delay=2, max_delay=10)
+        self.assertTrue(policy.should_retry(4))
+        self.assertFalse(policy.should_retry(5))
+        for attempts in range(1, 8):
+            self.assertTrue(0 <= policy.delay(attempts) <= min(10, 2 ** attempts))
+
+
+class CircuitBreakerTest(SimpleTestCase):
+    def setUp(self):
+        self.now = 0
+        self.breaker = CircuitBreaker(error_rate=0.5, window=10, min_calls=4,
+                                      reset_timeout=30, timer=lambda: self.now)
+
+    def test_opens_on_error_rate(self):
+        for ok in (True, False, True):
+            self.breaker.record(ok)
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+        self.breaker.record(False)
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+        self.assertFalse(self.breaker.allow())
+        self.assertEqual(self.breaker.opened, 1)
+
+    def test_old_calls_leave_the_window(self):
+        for _ in range(3):
+            self.breaker.record(False)
+        self.now = 11
+        self.breaker.record(False)
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+
+    def test_half_open_probe(self):
+        for _ in range(4):
+            self.breaker.record(False)
+        self.now = 30
+        self.assertEqual(self.breaker.state, CircuitBreaker.HALF_OPEN)
+        self.assertTrue(self.breaker.allow())
+        self.assertFalse(self.breaker.allow())
+        self.breaker.record(False)
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+        self.now = 60
+        self.assertTrue(self.breaker.allow())
+        self.breaker.record(True)
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+
+
+class MetricsRegistryTest(SimpleTestCase):
+    def setUp(self):
+        self.registry = metrics.Registry(enabled=True)
+        self.histogram = self.registry.histogram('test_seconds', "Test.", ('kind',),
+                                                 buckets=(0.1, 1))
+
+    def test_histogram_renders_cumulative_buckets(self):
+        for value in (0.05, 0.5, 5):
+            self.histogram.observe(value, 'a"b')
+        self.assertEqual(self.registry.render(), (
+            '# HELP test_seconds Test.\n'
+            '# TYPE test_seconds histogram\n'
+            'test_seconds_bucket{kind="a\\"b",le="0.1"} 1\n'
+            'test_seconds_bucket{kind="a\\"b",le="1"} 2\n'
+            'test_seconds_bucket{kind="a\\"b",le="+Inf"} 3\n'
+            'test_seconds_sum{kind="a\\"b"} 5.55\n'
+            'test_seconds_count{kind="a\\"b"} 3\n'))
+
+    def test_disabled_registry_records_nothing(self):
+        self.registry.enabled = False
+        counter = self.registry.counter('test', "Test.")
+        counter.inc()
+        self.histogram.observe(1, 'a')
+        self.assertEqual(counter.value(), 0)
+        self.assertEqual(self.histogram.count('a'), 0)
+
+    def test_metric_kinds_must_render_their_samples(self):
+        with self.assertRaises(TypeError):
+            metrics.Metric(self.registry, 'test', "Test.")
+
+
+@mock.patch('wallets.models.request_third_party_deposit',
+            return_value={'data': 'success', 'status': 200})
+class MetricsTest(TestCase):
+    def setUp(self):
+        payout_client.reset()
+        metrics.registry.reset()
+        metrics.registry.enabled = True
+        self.addCleanup(setattr, metrics.registry, 'enabled', False)
+        self.wallet = Wallet.objects.create(owner=User.objects.create_user(username='testuser'),
+                                            balance=Decimal("100.00"))
+
+    def test_request_latency_and_queries(self, _):
+        response = APIClient().post('/wallets/transactions/',
+                                    {'wallet': str(self.wallet.uuid), 'amount': '10.00',
+                                     'method': '0'})
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(metrics.request_seconds.count('POST', 'transaction-list', 201), 1)
+        self.assertEqual(metrics.request_queries.count('POST', 'transaction-list'), 1)
+        queries = metrics.request_queries._values[('POST', 'transaction-list')][1]
+        self.assertGreater(queries, 0)
+
+    async def test_async_requests_are_recorded(self, _):
+        response = await AsyncClient().get(f'/wallets/async/wallets/{self.wallet.uuid}/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(metrics.request_seconds.count('GET', 'async-wallet-detail', 200), 1)
+
+    def test_executor_records_bank_calls_and_lag(self, _):
+        Transaction.objects.create(wallet=self.wallet, amount=Decimal("10.00"),
+                                   method=Transaction.Method.WITHDRAW,
+                                   scheduled_time=timezone.now().timestamp() - 60)
+        WithdrawalExecutor(batch_size=10).run_once()
+        self.assertEqual(metrics.bank_call_seconds.count('payout', 'success'), 1)
+        self.assertEqual(metrics.payouts.value('success'), 1)
+        self.assertEqual(metrics.withdrawal_lag_seconds.count('COMPLETED'), 1)
+        lag = metrics.withdrawal_lag_seconds._values[('COMPLETED',)][1]
+        self.assertGreaterEqual(lag, 60)
+
+    def test_metrics_endpoint(self, _):
+        self.client.get(f'/wallets/wallets/{self.wallet.uuid}/')
+        response = self.client.get('/metrics')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response['Content-Type'], metrics.CONTENT_TYPE)
+        self.assertIn('wallet_http_request_duration_seconds_count'
+                      '{method="GET",view="wallet-detail",status="200"} 1',
+                      response.content.decode())
+
+    def test_executor_serves_its_metrics(self, _):
+        servers, scraped = [], []
+        real_serve = metrics.serve
+
+        def serve(port):
+            servers.append(real_serve(port, '127.0.0.1'))
+            return servers[-1]
+
+        def run_once():
+            url = f'http://127.0.0.1:{servers[0].server_port}/metrics'
+            with urllib.request.urlopen(url) as response:
+                scraped.append(response.read().decode())
+            return 0
+
+        metrics.payouts.inc('success')
+        with mock.patch.object(metrics, 'serve', serve), \
+                mock.patch.object(WithdrawalExecutor, 'run_once', side_effect=run_once):
+            call_command('run_withdrawals', '--once', '--metrics-port', '0', stdout=io.StringIO())
+        self.assertIn('wallet_payouts_total{outcome="success"} 1', scraped[0])
+        with self.assertRaises(urllib.error.URLError):
+            urllib.request.urlopen(f'http://127.0.0.1:{servers[0].server_port}/metrics', timeout=1)
+        metrics.registry.enabled = False
+        with self.assertRaisesMessage(CommandError, "METRICS"):
+            call_command('run_withdrawals', '--once', '--metrics-port', '0', stdout=io.StringIO())
+
+    def test_metrics_endpoint_is_off_when_disabled(self, _):
+        metrics.registry.enabled = False
+        self.assertEqual(self.client.get('/metrics').status_code, status.HTTP_404_NOT_FOUND)
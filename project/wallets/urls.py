@@ -1,5 +1,6 @@
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
+from . import async_views
 from .views import WalletViewSet, TransactionViewSet
 
 router = DefaultRouter()
@@ -8,4 +9,11 @@ router.register('transactions', TransactionViewSet)
 
 urlpatterns = [
     path('', include(router.urls)),
+    # async endpoints, see `async_views.py`
+    path('async/wallets/', async_views.wallet_create, name='async-wallet-create'),
+    path('async/wallets/<uuid:uuid>/', async_views.wallet_detail, name='async-wallet-detail'),
+    path('async/transactions/', async_views.transaction_create,
+         name='async-transaction-create'),
+    path('async/transactions/<int:pk>/', async_views.transaction_detail,
+         name='async-transaction-detail'),
 ]
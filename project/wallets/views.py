@@ -1,11 +1,55 @@
-from rest_framework import mixins
+import uuid
+from abc import ABC, abstractmethod
+
+from django.conf import settings
+from django.db import IntegrityError
+from django.http import Http404, StreamingHttpResponse
+from django.db.transaction import atomic
+from rest_framework import mixins, status
+from rest_framework.decorators import action
+from rest_framework.parsers import JSONParser
+from rest_framework.response import Response
+from rest_framework.reverse import reverse
 from rest_framework.viewsets import GenericViewSet
 
+from .cache import TTLCache, wallet_cache
 from .models import Wallet, Transaction
-from .serializers import WalletSerializer, TransactionSerializer
+from .pagination import ListPagination, WalletListPagination
+from . import statements
+from .parsers import NDJSONParser
+from .serializers import (TRANSACTION_ROW_FIELDS, WALLET_ROW_FIELDS, TransactionSerializer,
+                          WalletSerializer, transaction_rows, wallet_rows)
+
+
+class RowListMixin(ABC):
+    """
+    Lists rows read with `values(*list_fields)` and represented by
+    `represent_rows`, which gives the same data as the serializer, instead
+    of building a model instance per row and running it through the
+    serializer field by field. Setting `fast_list` to False lists through
+    the serializer.
+    """
+    fast_list = True
+    list_fields = ()
 
+    def list(self, request, *args, **kwargs):
+        if not self.fast_list:
+            return super().list(request, *args, **kwargs)
+        rows = self.filter_queryset(self.get_queryset()).values(*self.list_fields)
+        page = self.paginate_queryset(rows)
+        if page is None:
+            return Response(self.represent_rows(list(rows)))
+        return self.get_paginated_response(self.represent_rows(page))
 
-class WalletViewSet(mixins.CreateModelMixin,
+    @abstractmethod
+    def represent_rows(self, rows) -> list:
+        """
+        Returns the representations of `rows`, dicts of `list_fields`.
+        """
+
+
+class WalletViewSet(RowListMixin,
+                    mixins.CreateModelMixin,
                     mixins.RetrieveModelMixin,
                     mixins.UpdateModelMixin,
                     mixins.ListModelMixin,
@@ -22,17 +66,139 @@ class WalletViewSet(mixins.CreateModelMixin,
     - update: update an existing Wallet object by its UUID.
     - partial_update: partially update an existing Wallet object by its UUID.
     - list: list all existing Wallet objects.
+    - statement: stream the transactions of a Wallet as CSV or NDJSON.
 
     The queryset attribute is set to Wallet.objects.all() and the
     serializer_class attribute is set to WalletSerializer. The lookup field
-    is "uuid".
+    is "uuid". Lists are paginated with a limit and offset, or with a cursor
+    over "created_at" (see `ListPagination`), and read as rows, see
+    `RowListMixin`. Retrieved wallets are served from
+    `wallet_cache`.
     """
     queryset = Wallet.objects.all()
     serializer_class = WalletSerializer
+    pagination_class = WalletListPagination
     lookup_field = "uuid"
+    list_fields = WALLET_ROW_FIELDS
+
+    def get_queryset(self):
+        """
+        Loads only the columns the serializer and pagination read for
+        read-only actions.
+        """
+        queryset = super().get_queryset()
+        if self.action in ('list', 'retrieve'):
+            queryset = (queryset.only('uuid', 'balance', 'shard_count', 'owner_id', 'created_at')
+                        .with_shard_balance())
+        elif self.action == 'statement':
+            queryset = queryset.only('uuid')
+        return queryset
+
+    def represent_rows(self, rows) -> list:
+        """
+        Reverses the owner hyperlink once, with a placeholder key, and fills
+        in the key of every row.
+        """
+        placeholder = uuid.uuid4().hex
+        url = reverse('user-detail', kwargs={'pk': placeholder}, request=self.request,
+                      format=self.format_kwarg)
+        prefix, suffix = url.split(placeholder)
+        return wallet_rows(rows, lambda pk: f'{prefix}{pk}{suffix}')
+
+    def retrieve(self, request, *args, **kwargs):
+        wallet = cached_wallet(kwargs[self.lookup_field])
+        if wallet is None:
+            raise Http404
+        return Response(self.get_serializer(wallet).data)
+
+    @action(detail=True, methods=['get'])
+    def statement(self, request, uuid=None):
+        """
+        Streams the transactions of the wallet, oldest first, as CSV or with
+        `?output=ndjson` as NDJSON. `scheduled_from`, `scheduled_to`,
+        `executed_from` and `executed_to` limit the time range. Under ASGI
+        the stream blocks the event loop, see `wallets.statements`.
+        """
+        output = request.query_params.get('output', 'csv')
+        if output not in statements.OUTPUTS:
+            return Response({'output': f"Expected one of {', '.join(statements.OUTPUTS)}."},
+                            status=status.HTTP_400_BAD_REQUEST)
+        filters = statements.parse_filters(request.query_params)
+        wallet = self.get_object()
+        write, content_type = {
+            'csv': (statements.csv_stream, 'text/csv'),
+            'ndjson': (statements.ndjson_stream, 'application/x-ndjson'),
+        }[output]
+        chunks = statements.stream(lambda: write(statements.statement_rows(wallet, filters)))
+        response = StreamingHttpResponse(chunks, content_type=content_type)
+        response['Content-Disposition'] = (
+            f'attachment; filename="statement-{wallet.uuid}.{output}"')
+        return response
+
+
+def load_wallet(pk):
+    fields = (Wallet.objects.with_shard_balance().filter(pk=pk)
+              .values('balance', 'shard_balance', 'owner_id').first())
+    if fields is not None:
+        fields['balance'] += fields.pop('shard_balance')
+    return fields
+
+
+def cached_wallet(pk):
+    """
+    Returns wallet `pk` with the fields `WalletSerializer` reads, from
+    `wallet_cache` when possible, or None if it does not exist.
+    """
+    try:
+        pk = uuid.UUID(str(pk))
+    except ValueError:
+        return None
+    fields = wallet_cache.get(pk, load_wallet)
+    return None if fields is None else Wallet(uuid=pk, **fields)
+
+
+IDEMPOTENCY_KEY_TOO_LONG = {'detail': "Idempotency-Key is too long."}
+
+# responses of transactions created with an Idempotency-Key, by key
+idempotency_cache = TTLCache(maxsize=settings.IDEMPOTENCY['CACHE_SIZE'],
+                             ttl=settings.IDEMPOTENCY['CACHE_TTL'])
 
 
-class TransactionViewSet(mixins.CreateModelMixin,
+def replay_transaction(key):
+    """
+    Returns the serialized transaction created with the Idempotency-Key
+    `key`, or None if no transaction was created with it yet.
+    """
+    data = idempotency_cache.get(key)
+    if data is None:
+        transaction = Transaction.objects.filter(idempotency_key=key).first()
+        if transaction is None:
+            return None
+        data = TransactionSerializer(transaction).data
+        idempotency_cache.set(key, data)
+    return data
+
+
+def save_transaction(serializer, key) -> (dict, bool):
+    """
+    Saves a validated transaction with the Idempotency-Key `key`. Returns
+    its data and whether it is the transaction a concurrent request with the
+    same key created first.
+    """
+    try:
+        with atomic():
+            serializer.save(idempotency_key=key)
+    except IntegrityError:
+        data = replay_transaction(key)
+        if data is None:
+            raise
+        return data, True
+    idempotency_cache.set(key, serializer.data)
+    return serializer.data, False
+
+
+class TransactionViewSet(RowListMixin,
+                         mixins.CreateModelMixin,
                          mixins.RetrieveModelMixin,
                          mixins.ListModelMixin,
                          GenericViewSet):
@@ -42,12 +208,90 @@ class TransactionViewSet(mixins.CreateModelMixin,
     Inherits from CreateModelMixin, RetrieveModelMixin, ListModelMixin, and
     GenericViewSet. The viewset supports the following actions:
 
-    - create: create a new Transaction object.
+    - create: create a new Transaction object. A request carrying an
+      `Idempotency-Key` header creates at most one transaction per key;
+      retries are answered with the first response.
     - retrieve: retrieve an existing Transaction object by its ID.
     - list: list all existing Transaction objects.
+    - bulk: create many Transaction objects from a JSON array or NDJSON.
 
     The queryset attribute is set to Transaction.objects.all() and the
-    serializer_class attribute is set to TransactionSerializer.
+    serializer_class attribute is set to TransactionSerializer. Lists are
+    paginated with a limit and offset, or with a cursor over "id" (see
+    `ListPagination`), newest first, and read as rows, see `RowListMixin`.
     """
     queryset = Transaction.objects.all()
     serializer_class = TransactionSerializer
+    pagination_class = ListPagination
+    list_fields = TRANSACTION_ROW_FIELDS
+
+    def represent_rows(self, rows) -> list:
+        return transaction_rows(rows)
+
+    def create(self, request, *args, **kwargs):
+        key = request.headers.get('Idempotency-Key')
+        if not valid_idempotency_key(key):
+            return Response(IDEMPOTENCY_KEY_TOO_LONG, status=status.HTTP_400_BAD_REQUEST)
+        data, replayed = create_transaction(self.get_serializer(data=request.data), key)
+        if replayed:
+            return Response(data, status=status.HTTP_201_CREATED,
+                            headers={'Idempotent-Replayed': 'true'})
+        return Response(data, status=status.HTTP_201_CREATED,
+                        headers=self.get_success_headers(data))
+
+    @action(detail=False, methods=['post'], parser_classes=[JSONParser, NDJSONParser])
+    def bulk(self, request):
+        """
+        Creates many transactions at once from a JSON array or an NDJSON body.
+
+        Items are validated one by one; the valid ones are created together
+        and the invalid ones are reported without affecting the others. The
+        response holds one result per item, in request order, with either the
+        transaction `id` and `status` or the validation `errors`.
+        """
+        serializer = self.get_serializer(data=request.data, many=True,
+                                         max_length=settings.TRANSACTION_BULK_MAX_ITEMS)
+        serializer.is_valid(raise_exception=True)
+        transactions = serializer.save()
+        results = [{'index': index, 'errors': errors}
+                   for index, errors in serializer.item_errors.items()]
+        labels = dict(Transaction.Status.choices)
+        results += [{'index': index, 'id': transaction.pk, 'status': labels[transaction.status]}
+                    for index, transaction in zip(serializer.valid_indexes, transactions)]
+        results.sort(key=lambda result: result['index'])
+        if not serializer.item_errors:
+            response_status = status.HTTP_201_CREATED
+        elif transactions:
+            response_status = status.HTTP_207_MULTI_STATUS
+        else:
+            response_status = status.HTTP_400_BAD_REQUEST
+        return Response({'created': len(transactions),
+                         'failed': len(serializer.item_errors),
+                         'results': results},
+                        status=response_status)
+
+
+def valid_idempotency_key(key) -> bool:
+    """
+    Returns whether `key`, the Idempotency-Key header of a request or None,
+    fits `Transaction.idempotency_key`.
+    """
+    return key is None or len(key) <= Transaction._meta.get_field('idempotency_key').max_length
+
+
+def create_transaction(serializer, key) -> (dict, bool):
+    """
+    Validates and saves the transaction of `serializer`, raising
+    ValidationError if it is invalid; with an Idempotency-Key `key`, at most
+    one transaction is created per key. Returns its data and whether it was
+    replayed from an earlier request.
+    """
+    if key is not None:
+        data = replay_transaction(key)
+        if data is not None:
+            return data, True
+    serializer.is_valid(raise_exception=True)
+    if key is None:
+        serializer.save()
+        return serializer.data, False
+    return save_transaction(serializer, key)
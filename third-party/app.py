@@ -1,25 +1,60 @@
 import asyncio
 import random
 
-from flask import Flask, jsonify
+from flask import Flask, jsonify, request
+from werkzeug.serving import WSGIRequestHandler
 
 app = Flask(__name__)
 
 ERROR_RATE = 0.1
+# seconds a payout takes, `?delay=` overrides it per call
+DELAY = 1.0
 
+# successful responses by Idempotency-Key, a retried payout is not paid twice
+processed = {}
 
-async def random_status():
-    await asyncio.sleep(1)
+
+def draw_status():
     if random.random() < ERROR_RATE:
         return {'data': 'failed', 'status': 503}
     return {'data': 'success', 'status': 200}
 
 
+async def random_status(delay):
+    await asyncio.sleep(delay)
+    return draw_status()
+
+
 @app.route("/", methods=["POST"])
 async def simple_request():
-    data = await random_status()
+    key = request.headers.get("Idempotency-Key")
+    if key in processed:
+        return jsonify(processed[key])
+    data = await random_status(float(request.args.get("delay", DELAY)))
+    if key and data['status'] == 200:
+        processed[key] = data
     return jsonify(data)
 
 
+# many payouts, each with its own `key`, for the delay of a single one
+@app.route("/batch", methods=["POST"])
+async def batch_request():
+    items = request.get_json()["items"]
+    await asyncio.sleep(float(request.args.get("delay", DELAY)))
+    results = []
+    for item in items:
+        key = item.get("key")
+        if key in processed:
+            data = processed[key]
+        else:
+            data = draw_status()
+            if key and data['status'] == 200:
+                processed[key] = data
+        results.append({'key': key, **data})
+    return jsonify({'data': 'success', 'status': 200, 'items': results})
+
+
 if __name__ == "__main__":
+    # keep connections alive between calls, like a real bank endpoint
+    WSGIRequestHandler.protocol_version = "HTTP/1.1"
     app.run(host="0.0.0.0", port=8010)